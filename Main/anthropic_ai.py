@@ -1,41 +1,238 @@
+from startup import StartupTimer, Lazy
+
+startup_timer = StartupTimer()
+
 import os
 import json
-import socket
 import asyncio
-import sys
-import clr
 import logging
 import traceback
 import re
+import time
+from types import SimpleNamespace
+
+from python_executors import execute_python_command, run_code_in_virtual_env, scrape_website, interpreter_pool_options, crawler_options, VirtualEnvManager
+from browser_pool import BrowserPool
+from page_fetcher import PageFetcher
+from fetch_cache import FetchCache
+from env_cache import EnvironmentCache
+from job_runner import JobRunner
+from server import ChatServer
+from scheduler import LLMScheduler, PRIORITY_INTERACTIVE, PRIORITY_FOLLOW_UP
+from summarizer import ConversationSummarizer
+from context_window import ContextWindow, estimate_tokens
+from chat_journal import ChatJournal
+from response_cache import ResponseCache, cache_key
+from sessions import SessionRegistry
+from memory_store import MemoryStore
+from tools import ToolDispatcher, build_tools, tool_result
+from knowledge_index import KnowledgeIndex
+import vector_memory
+from metrics import registry as metrics
+from protocol import FLAG_NO_CACHE, FLAG_STDERR, FRAME_OUTPUT, MAGIC, FRAME_SESSION, FRAME_REPLY, FRAME_ERROR, FRAME_STREAM_REQUEST, FRAME_DELTA, REQUEST_TYPES, FrameDecoder, ProtocolError, encode_frame, is_framed_preamble
 
-from python_executors import execute_python_command
-from anthropic import AsyncAnthropic
+startup_timer.mark("imports")
+
+# The CLR, the Anthropic SDK and the memory backend are loaded on first use (or
+# by the warm-up that runs once the port is bound), so the server starts
+# accepting connections straight away
 
 def add_clr_reference(dll_name):
+    import clr
+    dll_path = os.path.abspath(dll_name)
+    if not os.path.exists(dll_path):
+        raise FileNotFoundError(f"{dll_name} not found at {dll_path}")
+    clr.AddReference(dll_path)
+
+def load_file_access():
     try:
-        dll_path = os.path.abspath(dll_name)
-        if not os.path.exists(dll_path):
-            raise FileNotFoundError(f"{dll_name} not found at {dll_path}")
-        clr.AddReference(dll_path)
+        add_clr_reference('LocalGPT_FileAccess.dll')
+        from LocalGPT_FileAccess import FileBrowser, ProgramLauncher, MemoryManager
     except Exception as e:
-        print(f"Error adding CLR reference: {e}")
-        sys.exit(1)
+        print(f"Error importing from LocalGPT_FileAccess.dll: {e}")
+        raise
+    print("Successfully imported FileBrowser, ProgramLauncher, and MemoryManager from LocalGPT_FileAccess.dll")
+    return SimpleNamespace(FileBrowser=FileBrowser, ProgramLauncher=ProgramLauncher, MemoryManager=MemoryManager)
 
-add_clr_reference('LocalGPT_FileAccess.dll')
+file_access = Lazy("LocalGPT_FileAccess.dll", load_file_access, startup_timer)
+file_browser = Lazy("FileBrowser", lambda: file_access.get().FileBrowser(), startup_timer)
+program_launcher = Lazy("ProgramLauncher", lambda: file_access.get().ProgramLauncher(), startup_timer)
 
-try:
-    from LocalGPT_FileAccess import FileBrowser, ProgramLauncher, MemoryManager
-    print("Successfully imported FileBrowser, ProgramLauncher, and MemoryManager from LocalGPT_FileAccess.dll")
-except ImportError as e:
-    print(f"Error importing from LocalGPT_FileAccess.dll: {e}")
-    sys.exit(1)
+# "python" selects the pure-Python memory store, "clr" the MemoryManager from the DLL
+MEMORY_BACKEND = os.getenv('DANTALION_MEMORY_BACKEND', 'clr' if os.name == 'nt' else 'python')
+
+def create_memory_manager():
+    if MEMORY_BACKEND == 'python':
+        return MemoryStore()
+    return file_access.get().MemoryManager()
+
+memory_manager = Lazy("memory manager", create_memory_manager, startup_timer)
+
+def env_int(name, default):
+    value = os.getenv(name)
+    return int(value) if value else default
+
+def create_client():
+    from anthropic import AsyncAnthropic
+    anthropic_api_key = os.getenv('ANTHROPIC_API_KEY')
+    # Retries are handled by the scheduler, which knows about every session's calls
+    return AsyncAnthropic(api_key=anthropic_api_key, max_retries=0)
+
+client = Lazy("Anthropic client", create_client, startup_timer)
+scheduler = LLMScheduler(
+    client.get,
+    max_in_flight=env_int('DANTALION_LLM_MAX_IN_FLIGHT', 4),
+    requests_per_minute=env_int('DANTALION_LLM_REQUESTS_PER_MINUTE', 50),
+    tokens_per_minute=env_int('DANTALION_LLM_TOKENS_PER_MINUTE', 40000),
+    max_retries=env_int('DANTALION_LLM_MAX_RETRIES', 5)
+)
+
+# Opt-in cache for repeated identical turns
+response_cache = None
+if env_int('DANTALION_RESPONSE_CACHE', 0):
+    response_cache = ResponseCache(
+        memory_entries=env_int('DANTALION_RESPONSE_CACHE_ENTRIES', 256),
+        ttl=env_int('DANTALION_RESPONSE_CACHE_TTL', 24 * 3600),
+        max_disk_bytes=env_int('DANTALION_RESPONSE_CACHE_BYTES', 64 * 1024 * 1024)
+    )
+
+MODEL = "claude-3-5-sonnet-20240620"
+MAX_TOKENS = 1024
+MAX_PENDING_REQUESTS = 8
+# How long a connection that has sent part of MAGIC is given to send the rest
+PREAMBLE_TIMEOUT = env_int('DANTALION_PREAMBLE_TIMEOUT_MS', 500) / 1000
+CONTEXT_TOKEN_BUDGET = env_int('DANTALION_CONTEXT_TOKENS', 16000)
+# An opening request larger than this isn't pinned, so it can be trimmed or summarized
+PIN_MAX_TOKENS = env_int('DANTALION_PIN_MAX_TOKENS', CONTEXT_TOKEN_BUDGET // 4)
+# Commands are offered to the model as tools; 0 falls back to text commands only
+TOOL_USE = env_int('DANTALION_TOOL_USE', 1)
+MAX_TOOL_ROUNDS = env_int('DANTALION_MAX_TOOL_ROUNDS', 4)
+# Installs run as subprocesses, a few at a time
+job_runner = JobRunner(
+    max_workers=env_int('DANTALION_JOB_WORKERS', 2),
+    timeout=env_int('DANTALION_JOB_TIMEOUT', 300),
+    max_output_bytes=env_int('DANTALION_JOB_OUTPUT_BYTES', 256 * 1024)
+)
+# Warm interpreters that code runs are sent to
+interpreter_pool_options.update(
+    size=env_int('DANTALION_INTERPRETERS', 2),
+    max_runs=env_int('DANTALION_INTERPRETER_MAX_RUNS', 50),
+    max_memory_bytes=env_int('DANTALION_INTERPRETER_MAX_MEMORY', 256 * 1024 * 1024),
+    timeout=env_int('DANTALION_JOB_TIMEOUT', 300),
+    # Output beyond this is dropped in the worker; only a bounded tail is ever held here
+    max_output_bytes=env_int('DANTALION_INTERPRETER_OUTPUT_BYTES', 64 * 1024 * 1024),
+    # What streams to the client, and the tail of it that goes back to the model
+    stream_bytes=env_int('DANTALION_STREAM_OUTPUT_BYTES', 256 * 1024),
+    stream_lines=env_int('DANTALION_STREAM_OUTPUT_LINES', 5000),
+    tail_bytes=env_int('DANTALION_OUTPUT_TAIL_BYTES', 16 * 1024),
+    tail_lines=env_int('DANTALION_OUTPUT_TAIL_LINES', 200)
+)
+# Environments are built once per package set and shared by every session
+environment_cache = EnvironmentCache(
+    VirtualEnvManager,
+    job_runner,
+    directory=os.getenv('DANTALION_ENV_CACHE_DIR', 'venvs'),
+    max_bytes=env_int('DANTALION_ENV_CACHE_BYTES', 4 * 1024 * 1024 * 1024),
+    wheelhouse=os.getenv('DANTALION_WHEELHOUSE'),
+    offline=bool(env_int('DANTALION_PIP_OFFLINE', 0))
+)
+# Scrapes lease one of these headless browsers; a local chromedriver avoids the download lookup
+browser_pool = BrowserPool(
+    size=env_int('DANTALION_BROWSERS', 2),
+    max_pages=env_int('DANTALION_BROWSER_MAX_PAGES', 50),
+    page_load_timeout=env_int('DANTALION_PAGE_LOAD_TIMEOUT', 30),
+    timeout=env_int('DANTALION_SCRAPE_TIMEOUT', 60),
+    driver_path=os.getenv('DANTALION_CHROMEDRIVER'),
+    browser_binary=os.getenv('DANTALION_CHROME_BINARY')
+)
+# Pages are fetched over HTTP first and only rendered in a browser when they need JavaScript.
+# Fetched pages are reused for ttl seconds, then revalidated with conditional requests.
+page_fetcher = PageFetcher(
+    browser_pool,
+    max_connections=env_int('DANTALION_HTTP_CONNECTIONS', 10),
+    timeout=env_int('DANTALION_HTTP_TIMEOUT', 20),
+    cache=FetchCache(
+        directory=os.getenv('DANTALION_FETCH_CACHE_DIR', 'cache/fetch'),
+        ttl=env_int('DANTALION_FETCH_TTL', 3600),
+        max_entries=env_int('DANTALION_FETCH_CACHE_ENTRIES', 10000),
+        max_age=env_int('DANTALION_FETCH_CACHE_MAX_AGE', 30 * 24 * 3600)
+    )
+)
+# Crawls (scrapes with a depth) fetch this many pages at once, politely per host
+crawler_options.update(
+    concurrency=env_int('DANTALION_CRAWL_CONCURRENCY', 8),
+    per_host=env_int('DANTALION_CRAWL_PER_HOST', 2),
+    delay=env_int('DANTALION_CRAWL_DELAY_MS', 500) / 1000,
+    obey_robots=bool(env_int('DANTALION_CRAWL_OBEY_ROBOTS', 1))
+)
+# Upper bounds for the depth and page count the model asks a crawl for
+CRAWL_MAX_DEPTH = env_int('DANTALION_CRAWL_MAX_DEPTH', 3)
+CRAWL_MAX_PAGES = env_int('DANTALION_CRAWL_MAX_PAGES', 500)
+# Program updates arriving within this window are answered by one follow-up request
+PROGRAM_UPDATE_DEBOUNCE = env_int('DANTALION_PROGRAM_UPDATE_DEBOUNCE_MS', 500) / 1000
+
+# Each request carries the passages of knowledge/ and memory most relevant to it
+RETRIEVAL_RESULTS = env_int('DANTALION_RETRIEVAL_RESULTS', 5)
+RETRIEVAL_TOKENS = env_int('DANTALION_RETRIEVAL_TOKENS', 1000)
+knowledge_index = KnowledgeIndex(
+    directory=os.getenv('DANTALION_INDEX_DIR', 'cache/index'),
+    load_memory=lambda: [str(entry) for entry in memory_manager.get().LoadOverallMemory()]
+)
+# Memory entries are also recalled by similarity of their embeddings, when numpy is installed
+RECALL_RESULTS = env_int('DANTALION_RECALL_RESULTS', 3)
+# Weaker recalls are left out; in hundredths of cosine similarity
+RECALL_MIN_SCORE = env_int('DANTALION_RECALL_MIN_SCORE', 15) / 100
+memory_vectors = None
+if vector_memory.available():
+    memory_vectors = vector_memory.VectorMemory(
+        directory=os.getenv('DANTALION_VECTOR_DIR', 'cache/vectors'),
+        embedder=vector_memory.HashingEmbedder(dimensions=env_int('DANTALION_VECTOR_DIMENSIONS', 512)),
+        load_memory=lambda: [str(entry) for entry in memory_manager.get().LoadOverallMemory()],
+        index_threshold=env_int('DANTALION_VECTOR_INDEX_THRESHOLD', 50000),
+        nprobe=env_int('DANTALION_VECTOR_NPROBE', 8)
+    )
+else:
+    logging.info("numpy is not installed; memory is recalled by keywords only")
+
+# Old turns of long conversations are folded into a summary while the session is idle
+summarizer = None
+if env_int('DANTALION_SUMMARIZE', 1):
+    summarizer = ConversationSummarizer(
+        scheduler,
+        MODEL,
+        max_tokens=env_int('DANTALION_SUMMARY_TOKENS', 512),
+        cache=ResponseCache(
+            directory=os.getenv('DANTALION_SUMMARY_CACHE_DIR', 'cache/summaries'),
+            ttl=env_int('DANTALION_SUMMARY_CACHE_TTL', 30 * 24 * 3600)
+        ),
+        idle_delay=env_int('DANTALION_SUMMARY_IDLE', 30),
+        max_queue_depth=env_int('DANTALION_SUMMARY_MAX_QUEUE', 0),
+        compress_at=env_int('DANTALION_SUMMARY_AT_PERCENT', 75) / 100,
+        compress_to=env_int('DANTALION_SUMMARY_TO_PERCENT', 50) / 100
+    )
+
+# Per-stage timings and counters, served in the Prometheus text format on
+# 127.0.0.1:DANTALION_METRICS_PORT/metrics (0 turns the endpoint off)
+METRICS_PORT = env_int('DANTALION_METRICS_PORT', 9998)
+stage_seconds = metrics.histogram("stage_seconds", "Time spent in each stage of serving a request.", labels=("stage",))
+requests_total = metrics.counter("requests_total", "Chat requests received.", labels=("protocol",))
+received_bytes = metrics.counter("received_bytes_total", "Bytes received from clients.")
+llm_tokens = metrics.counter("llm_tokens_total", "Tokens billed for LLM requests.", labels=("kind",))
+errors_total = metrics.counter("errors_total", "Errors, by where they were handled.", labels=("where",))
+
+# Chat histories are persisted as append-only logs, written behind the event loop
+chat_journal = ChatJournal(
+    fsync=os.getenv('DANTALION_JOURNAL_FSYNC', 'interval'),
+    flush_interval=env_int('DANTALION_JOURNAL_FLUSH_MS', 200) / 1000
+)
 
-file_browser = FileBrowser()
-program_launcher = ProgramLauncher()
-memory_manager = MemoryManager()
+# Named session for legacy clients that don't open with a SESSION line ("" gives them
+# a session of their own that ends with the connection)
+LEGACY_SESSION = os.getenv('DANTALION_LEGACY_SESSION', 'default')
 
-anthropic_api_key = os.getenv('ANTHROPIC_API_KEY')
-client = AsyncAnthropic(api_key=anthropic_api_key)
+CONFIG_FILES = ('capabilities.json', 'purpose.json')
+USAGE_FIELDS = ('input_tokens', 'output_tokens', 'cache_creation_input_tokens', 'cache_read_input_tokens')
+CACHE_CONTROL = {"type": "ephemeral"}
 
 def load_capabilities():
     with open('capabilities.json', 'r') as f:
@@ -45,28 +242,13 @@ def load_purpose():
     with open('purpose.json', 'r') as f:
         return json.load(f)
 
-capabilities = load_capabilities()
-purpose = load_purpose()
-
-class ChatSession:
-    def __init__(self):
-        self.capabilities = capabilities
-        self.purpose = purpose
-        self.system_prompt = self.create_system_prompt()
-        self.messages = []
-        try:
-            self.chat_memory_file = memory_manager.CreateChatMemory()
-        except Exception as e:
-            logging.error(f"Failed to create chat memory: {e}")
-            self.chat_memory_file = None
-
-    def create_system_prompt(self):
-        return f"""
+def create_system_prompt(capabilities, purpose):
+    prompt = f"""
         Capabilities:
-        {json.dumps(self.capabilities, indent=2)}
+        {json.dumps(capabilities, indent=2)}
 
         Purpose and Tone:
-        {json.dumps(self.purpose, indent=2)}
+        {json.dumps(purpose, indent=2)}
 
         Please adhere to the above capabilities and purpose in all interactions.
         
@@ -77,163 +259,850 @@ class ChatSession:
 
         For example, you might say: "Certainly! I can open that file for you. Let me launch_program notepad example.txt"
         """
+    if TOOL_USE:
+        prompt += """
+        Each capability is also available as a tool. Prefer calling the tools, and make all
+        independent calls in the same reply; their results come back together.
+        """
+    return prompt
+
+def config_version():
+    return tuple(os.stat(path).st_mtime_ns for path in CONFIG_FILES)
+
+capabilities = None
+purpose = None
+system_prompt = None
+tool_definitions = []
+
+def get_system_prompt():
+    # Built once per version of the config files rather than once per session.
+    # The system block carries a cache breakpoint so the provider can reuse it.
+    global capabilities, purpose, system_prompt, tool_definitions
+    version = config_version()
+    if system_prompt is None or system_prompt[0] != version:
+        capabilities = load_capabilities()
+        purpose = load_purpose()
+        tool_definitions = build_tools(capabilities) if TOOL_USE else []
+        text = create_system_prompt(capabilities, purpose)
+        system_prompt = (version, text, [{"type": "text", "text": text, "cache_control": CACHE_CONTROL}])
+    return system_prompt[1], system_prompt[2]
+
+async def recall_memory(query, k):
+    # Memory entries most similar to the query, best first
+    if memory_vectors is None or not k:
+        return []
+    try:
+        hits = await asyncio.to_thread(memory_vectors.search, query, k, RECALL_MIN_SCORE)
+    except Exception as e:
+        logging.error(f"Memory recall failed: {str(e)}")
+        logging.debug(traceback.format_exc())
+        return []
+    return [hit.text for hit in hits]
+
+def normalize_space(text):
+    return " ".join(text.split())
+
+def window_entries(messages):
+    # The memory entries the turns in messages are saved as (see run_turn), whitespace collapsed
+    turns = []
+    for message in messages:
+        content = message["content"]
+        if message["role"] == "user" and isinstance(content, str):
+            turns.append((content, []))
+        elif message["role"] == "assistant" and turns:
+            text = content if isinstance(content, str) else "".join(block["text"] for block in content if block.get("type") == "text")
+            if text:
+                turns[-1][1].append(text)
+    return [normalize_space(f"User: {user}\nAssistant: " + "\n\n".join(replies)) for user, replies in turns]
+
+async def retrieve_context(query, window=()):
+    # The best passages for the query that fit the token budget, or None
+    with stage_seconds.time(stage="retrieval"):
+        return await search_context(query, window)
+
+async def search_context(query, window=()):
+    # Passages of turns still in the window, and the prompt itself (or an earlier
+    # turn that asked the same), are already in front of the model
+    entries = window_entries(window)
+    prompt = normalize_space(query)
+    repeated = normalize_space(f"User: {query}\nAssistant:")
+
+    def known(text):
+        text = normalize_space(text)
+        return text == prompt or text.startswith(repeated) or any(text in entry for entry in entries)
+
+    hits = []
+    if RETRIEVAL_RESULTS:
+        try:
+            hits = await asyncio.to_thread(knowledge_index.search, query, RETRIEVAL_RESULTS)
+        except Exception as e:
+            logging.error(f"Knowledge search failed: {str(e)}")
+            logging.debug(traceback.format_exc())
+    hits = [hit for hit in hits if not known(hit.text)]
+    # Memory entries the keyword search already found (as "memory #N" passages,
+    # whitespace collapsed) aren't recalled a second time
+    found = [hit.text for hit in hits if hit.source.startswith("memory #")]
+    recalled = [text for text in await recall_memory(query, RECALL_RESULTS)
+                if not known(text) and not any(passage in normalize_space(text) for passage in found)]
+    candidates = [f"[memory] {text}" for text in recalled] + [f"[{hit.source}] {hit.text}" for hit in hits]
+    snippets = []
+    budget = RETRIEVAL_TOKENS
+    for snippet in dict.fromkeys(candidates):
+        budget -= estimate_tokens(snippet)
+        if budget < 0:
+            break
+        snippets.append(snippet)
+    if not snippets:
+        return None
+    return "Possibly relevant notes from scraped knowledge and memory:\n" + "\n".join(snippets)
+
+def with_context(messages, context):
+    # Retrieved notes go in front of the newest user message of this request only,
+    # so the history (and its cached prefix) stays as it was
+    last = dict(messages[-1])
+    content = last["content"]
+    if isinstance(content, str):
+        content = [{"type": "text", "text": content}]
+    last["content"] = [{"type": "text", "text": context}] + list(content)
+    return messages[:-1] + [last]
+
+def with_cache_breakpoint(messages):
+    # Mark the end of the stable history prefix (everything before the newest message)
+    if len(messages) < 2:
+        return messages
+    prefix_end = dict(messages[-2])
+    content = prefix_end["content"]
+    if isinstance(content, str):
+        content = [{"type": "text", "text": content}]
+    else:
+        content = list(content)
+    content[-1] = dict(content[-1], cache_control=CACHE_CONTROL)
+    prefix_end["content"] = content
+    return messages[:-2] + [prefix_end, messages[-1]]
+
+# Tool handlers. The CLR calls block, so they run on worker threads; code runs
+# go to warm interpreters and scrapes to the page fetcher.
+
+async def tool_list_files_in_directory(directory_path):
+    return await asyncio.to_thread(lambda: [str(path) for path in file_browser.get().ListFilesInDirectory(directory_path)])
+
+async def tool_read_file_content(file_path):
+    return await asyncio.to_thread(lambda: str(file_browser.get().ReadFileContent(file_path)))
+
+async def tool_traverse_directory(directory_path):
+    def traverse():
+        tree = file_browser.get().TraverseDirectory(directory_path)
+        return {str(folder): [str(name) for name in tree[folder]] for folder in tree.Keys}
+    return await asyncio.to_thread(traverse)
+
+async def tool_run_code_in_virtual_env(code, packages=None, on_output=None):
+    if isinstance(packages, str):
+        packages = [package.strip() for package in packages.split(",") if package.strip()]
+    with stage_seconds.time(stage="subprocess"):
+        stdout, stderr = await run_code_in_virtual_env(code, packages, environment_cache, on_output)
+    return {"stdout": stdout, "stderr": stderr}
+
+async def tool_launch_program(program_name, file_path=""):
+    await asyncio.to_thread(lambda: program_launcher.get().LaunchProgram(program_name, file_path or ""))
+    return f"Launched program: {program_name}" + (f" with arguments: {file_path}" if file_path else "")
+
+async def tool_scrape_website(domain, subdomain=None, render=False, depth=0, max_pages=100):
+    depth = max(0, min(int(depth or 0), CRAWL_MAX_DEPTH))
+    max_pages = max(1, min(int(max_pages or 1), CRAWL_MAX_PAGES))
+    with stage_seconds.time(stage="scrape"):
+        return await scrape_website(domain, subdomain, page_fetcher, render, depth=depth, max_pages=max_pages)
+
+async def remember(entry):
+    # Makes a new memory entry searchable
+    await asyncio.to_thread(knowledge_index.add_memory, entry)
+    if memory_vectors is not None:
+        await asyncio.to_thread(memory_vectors.add_memory, entry)
+
+async def tool_update_memory(summary):
+    await asyncio.to_thread(lambda: memory_manager.get().UpdateOverallMemory(summary))
+    await remember(summary)
+    return "Overall memory updated."
+
+async def tool_load_memory(query=None, limit=10):
+    # With a query only the most similar entries come back rather than the whole memory
+    if query and memory_vectors is not None:
+        return await recall_memory(query, limit)
+    return await asyncio.to_thread(lambda: [str(entry) for entry in memory_manager.get().LoadOverallMemory()])
+
+async def tool_load_chat(filename):
+    # Chats are kept in the journal; a name with a path or extension still finds its file
+    name = os.path.splitext(os.path.basename(filename))[0]
+    messages, _ = await chat_journal.load_async(name) if name else ([], [])
+    if not messages:
+        return f"No chat named {filename}."
+    return json.dumps(messages)
+
+tool_dispatcher = ToolDispatcher(max_concurrency=env_int('DANTALION_TOOL_CONCURRENCY', 4))
+tool_dispatcher.register("list_files_in_directory", tool_list_files_in_directory)
+tool_dispatcher.register("read_file_content", tool_read_file_content)
+tool_dispatcher.register("traverse_directory", tool_traverse_directory)
+tool_dispatcher.register("run_code_in_virtual_env", tool_run_code_in_virtual_env, streaming=True)
+# Launches report through one shared memory-mapped file, so they go one at a time
+tool_dispatcher.register("launch_program", tool_launch_program, exclusive=True)
+tool_dispatcher.register("scrape_website", tool_scrape_website)
+tool_dispatcher.register("update_memory", tool_update_memory)
+tool_dispatcher.register("load_memory", tool_load_memory)
+tool_dispatcher.register("load_chat", tool_load_chat)
+
+def content_blocks(response):
+    # The assistant's content as it goes back into the history; plain text stays a string
+    blocks = []
+    for block in response.content:
+        if block.type == "text":
+            blocks.append({"type": "text", "text": block.text})
+        elif block.type == "tool_use":
+            blocks.append({"type": "tool_use", "id": block.id, "name": block.name, "input": block.input})
+    if len(blocks) == 1 and blocks[0]["type"] == "text":
+        return blocks[0]["text"]
+    return blocks
+
+def tool_calls(content):
+    if isinstance(content, str):
+        return []
+    return [block for block in content if block["type"] == "tool_use"]
+
+def describe_tool_results(calls, results):
+    lines = ["Tool results:"]
+    for call, result in zip(calls, results):
+        status = "failed" if result.get("is_error") else "ok"
+        lines.append(f"- {call['name']} ({status}): {result['content']}")
+    return "\n".join(lines)
+
+class ChatSession:
+    def __init__(self, session_id=None):
+        self.session_id = session_id
+        self.system_prompt, self.system_blocks = get_system_prompt()
+        self.capabilities = capabilities
+        self.purpose = purpose
+        self.context = ContextWindow(token_budget=CONTEXT_TOKEN_BUDGET)
+        self.usage = dict.fromkeys(USAGE_FIELDS, 0)
+        # Named sessions keep one journal for their whole life; unnamed ones
+        # last only as long as their connection, so nothing is journaled
+        self.journal_name = f"chat_memory_{session_id}" if session_id else None
+        self.context.on_change = self.record_change
+        self.turn_lock = asyncio.Lock()
+        self.pending_updates = []
+        self._update_flush = None
+        # Messages trim() dropped before the summarizer got to them
+        self.aging = []
+
+    def memory_footprint(self):
+        # Approximate size of the history in bytes
+        return self.context.total_tokens * 4
+
+    def suspend(self):
+        # Everything is already journaled; just leave a compact log behind
+        if summarizer:
+            summarizer.cancel(self)
+        self.compact_chat_memory()
+
+    def record_usage(self, usage):
+        for field in USAGE_FIELDS:
+            self.usage[field] += getattr(usage, field, None) or 0
+            llm_tokens.inc(getattr(usage, field, None) or 0, kind=field[:-len("_tokens")])
+        logging.debug(f"Session token usage: {self.usage}")
+
+    @property
+    def messages(self):
+        return self.context.messages
+
+    def add_message(self, role, content, pinned=False):
+        # The opening request of a session sets its task, so it is never trimmed,
+        # unless it is a paste too big to keep the history within its budget
+        if not len(self.context) and role == "user" and estimate_tokens(content) <= PIN_MAX_TOKENS:
+            pinned = True
+        self.context.append({"role": role, "content": content}, pinned)
 
     def cleanup_messages(self):
-        if len(self.messages) > 20:  # Adjust this number as needed
-            self.messages = self.messages[-10:]  # Keep only the last 10 messages
-        self.update_chat_memory()
+        # Keep the history within the token budget instead of a fixed message count
+        dropped = self.context.trim()
+        if dropped:
+            logging.debug(f"Trimmed {len(dropped)} messages, {self.context.total_tokens} tokens remain")
+            if summarizer:
+                # Kept for the next summary, up to a budget's worth
+                self.aging.extend(dropped)
+                while sum(estimate_tokens(message["content"]) for message in self.aging) > self.context.token_budget:
+                    self.aging.pop(0)
+        self.compact_chat_memory()
 
-    def update_chat_memory(self):
-        if self.chat_memory_file:
-            try:
-                memory_content = json.dumps(self.messages)
-                memory_manager.UpdateChatMemory(self.chat_memory_file, memory_content)
-            except Exception as e:
-                logging.error(f"Failed to update chat memory: {e}")
+    def record_change(self, op, **fields):
+        if not self.journal_name:
+            return
+        if op == "snapshot":
+            chat_journal.compact(self.journal_name, fields["messages"], fields["pinned"])
+        else:
+            chat_journal.record(self.journal_name, op, **fields)
+
+    def compact_chat_memory(self):
+        if self.journal_name and chat_journal.needs_compaction(self.journal_name, len(self.context)):
+            chat_journal.compact(self.journal_name, list(self.messages), list(self.context.pinned))
+
+    async def load_chat_memory(self):
+        if not self.journal_name:
+            return
+        try:
+            messages, pinned = await chat_journal.load_async(self.journal_name)
+            if messages:
+                self.context.replace(messages, pinned)
+        except Exception as e:
+            logging.error(f"Failed to load chat memory: {e}")
+
+    async def create_response(self, messages, on_delta=None, priority=PRIORITY_INTERACTIVE, use_cache=False, query=None):
+        # Returns the assistant's text and its full content (text and tool calls).
+        # With a query, notes retrieved for it go in front of the newest message.
+        key = None
+        if use_cache and response_cache:
+            # Keyed on the history alone and looked up before retrieval: the notes pick
+            # up every turn's own memory entry, so a key with them would never repeat
+            key = cache_key(MODEL, self.system_prompt, messages, MAX_TOKENS)
+            cached = await response_cache.get(key)
+            if cached is not None:
+                logging.debug(f"Response cache hit: {key}")
+                if on_delta:
+                    await on_delta(cached)
+                return cached, cached
+        if query:
+            context = await retrieve_context(query, messages)
+            if context:
+                messages = with_context(messages, context)
+
+        request = dict(
+            priority=priority,
+            model=MODEL,
+            max_tokens=MAX_TOKENS,
+            system=self.system_blocks,
+            messages=with_cache_breakpoint(messages)
+        )
+        if tool_definitions:
+            request["tools"] = tool_definitions
+        # Includes the wait for the scheduler; tool rounds count as follow-ups
+        with stage_seconds.time(stage="llm" if priority == PRIORITY_INTERACTIVE else "follow_up"):
+            if on_delta is None:
+                response = await scheduler.create(**request)
+            else:
+                # Forward text deltas as they arrive, then assemble the final message
+                response = await scheduler.stream(on_delta, **request)
+        self.record_usage(response.usage)
+        assistant_message = "".join(block.text for block in response.content if block.type == "text")
+        content = content_blocks(response)
 
-    def load_chat_memory(self):
-        if self.chat_memory_file:
+        # Tool calls depend on the state of the machine, so only plain answers are cached
+        if key and isinstance(content, str):
+            await response_cache.put(key, assistant_message)
+        return assistant_message, content
+
+    async def complete_turn(self, on_delta=None, priority=PRIORITY_INTERACTIVE, use_cache=False, on_output=None, query=None):
+        # Gets the assistant's reply to the history and runs the tool calls it makes.
+        # All calls of a reply run concurrently and their results go back in one
+        # follow-up request. Returns the text for the client, the model's own text
+        # (without the tool results shown to the client) and whether tools ran.
+        replies = []
+        texts = []
+        used_tools = False
+        for round_number in range(MAX_TOOL_ROUNDS + 1):
+            assistant_message, content = await self.create_response(self.context.window(), on_delta, priority, use_cache, query)
+            self.add_message("assistant", content)
+            if assistant_message:
+                replies.append(assistant_message)
+                texts.append(assistant_message)
+            calls = tool_calls(content)
+            if not calls:
+                break
+            used_tools = True
+            if round_number == MAX_TOOL_ROUNDS:
+                # Every call still needs a result or the history can't be sent again
+                results = [{"type": "tool_result", "tool_use_id": call["id"], "content": "Tool call limit reached for this turn.", "is_error": True} for call in calls]
+                self.add_message("user", results)
+                logging.warning(f"Stopped after {MAX_TOOL_ROUNDS} rounds of tool calls")
+                break
             try:
-                memory_content = memory_manager.LoadChatMemory(self.chat_memory_file)
-                if memory_content:
-                    self.messages = json.loads(memory_content)
-            except Exception as e:
-                logging.error(f"Failed to load chat memory: {e}")
+                with stage_seconds.time(stage="tools"):
+                    results = await tool_dispatcher.dispatch(calls, on_output)
+            except asyncio.CancelledError:
+                # The client went away; the calls still need results or the history can't be sent again
+                self.add_message("user", [tool_result(call["id"], "Cancelled.", is_error=True) for call in calls])
+                raise
+            self.add_message("user", results)
+            replies.append(describe_tool_results(calls, results))
+            on_delta, priority, use_cache, query = None, PRIORITY_FOLLOW_UP, False, None
+        return "\n\n".join(replies), "\n\n".join(texts), used_tools
 
-    async def process_message(self, user_message):
-        self.cleanup_messages()
-        
-        self.messages.append({"role": "user", "content": user_message})
+    async def process_message(self, user_message, on_delta=None, use_cache=True, on_output=None):
+        # on_delta gets the reply text as it streams in, on_output(stream, text) the output of code it runs
+        try:
+            with stage_seconds.time(stage="turn"):
+                async with self.turn_lock:
+                    return await self.run_turn(user_message, on_delta, use_cache, on_output)
+        finally:
+            if summarizer and summarizer.due(self):
+                summarizer.schedule(self)
+
+    async def run_turn(self, user_message, on_delta, use_cache, on_output):
+        self.add_message("user", user_message)
+        with stage_seconds.time(stage="cleanup"):
+            self.cleanup_messages()
         
         logging.debug(f"Messages before processing: {json.dumps(self.messages, indent=2)}")
         
-        response = await client.messages.create(
-            model="claude-3-5-sonnet-20240620",
-            max_tokens=1024,
-            system=self.system_prompt,
-            messages=self.messages
-        )
-        assistant_message = response.content[0].text
-        self.messages.append({"role": "assistant", "content": assistant_message})
+        assistant_message, model_text, used_tools = await self.complete_turn(on_delta, use_cache=use_cache, on_output=on_output, query=user_message)
         
         # Update overall memory
         try:
-            memory_manager.UpdateOverallMemory(f"User: {user_message}\nAssistant: {assistant_message}")
+            with stage_seconds.time(stage="memory"):
+                # Only what the model said: tool results (file contents, command output,
+                # memory it loaded) would be stored and indexed again on every turn
+                memory_entry = f"User: {user_message}\nAssistant: {model_text}"
+                await asyncio.to_thread(lambda: memory_manager.get().UpdateOverallMemory(memory_entry))
+                await remember(memory_entry)
         except Exception as e:
+            errors_total.inc(where="memory")
             logging.error(f"Failed to update overall memory: {e}")
         
-        # Check for commands in the assistant's response
-        command_result = await self.check_for_commands(assistant_message)
-        if command_result:
-            return command_result
-        
+        # Replies without tool calls may still spell out commands in the text;
+        # all of their results go back in one follow-up request
+        results = [] if used_tools else await self.check_for_commands(assistant_message, on_output)
+        follow_up = await self.follow_up(results, on_output)
+        if follow_up is None:
+            return assistant_message
+        if not results:
+            return f"{assistant_message}\n\n{follow_up}"
+        return "\n\n".join(results + [f"Assistant response:\n{follow_up}"])
+
+    async def follow_up(self, results, on_output=None):
+        # Command results of the turn plus any program updates that arrived meanwhile
+        events, self.pending_updates = self.pending_updates, []
+        parts = results + [f"Program update received: {update_type}" for update_type in events]
+        if not parts:
+            return None
+        self.add_message("user", "\n\n".join(parts))
+        assistant_message, _, _ = await self.complete_turn(priority=PRIORITY_FOLLOW_UP, on_output=on_output)
         return assistant_message
 
-    async def check_for_commands(self, message):
-        # Check for launch_program command
-        launch_match = re.search(r'launch_program\s+(\S+)(?:\s+(.+))?', message)
-        if launch_match:
-            program = launch_match.group(1)
-            arguments = launch_match.group(2) or ""
-            return await self.handle_program_launch(f"launch_program {program} {arguments}")
+    async def check_for_commands(self, message, on_output=None):
+        # Returns the results of every command found in the message, in order
+        commands = []
+        with stage_seconds.time(stage="command_parsing"):
+            for launch_match in re.finditer(r'launch_program\s+(\S+)(?:[ \t]+(.+))?', message):
+                program = launch_match.group(1)
+                arguments = launch_match.group(2) or ""
+                commands.append(self.handle_program_launch(f"launch_program {program} {arguments}"))
         
-        # Check for run_code_in_virtual_env command
-        if "run_code_in_virtual_env" in message:
-            return await self.handle_python_command(message)
+            # The code runs to the end of the message
+            code_match = re.search(r'run_code_in_virtual_env\b[\s\S]*', message)
+            if code_match:
+                commands.append(self.handle_python_command(code_match.group(0), on_output))
         
-        # Check for scrape_website command
-        if "scrape_website" in message:
-            return await self.handle_python_command(message)
+            for scrape_match in re.finditer(r'scrape_website[ \t]+\S+(?:[ \t]+\S+)?', message):
+                commands.append(self.handle_python_command(scrape_match.group(0)))
         
-        # Add more command checks here as needed
+            # Add more command checks here as needed
         
-        return None
+        return list(await asyncio.gather(*commands))
 
     async def handle_program_launch(self, user_message):
         parts = user_message.split(maxsplit=2)
         program = parts[1]
-        arguments = parts[2] if len(parts) > 2 else ""
+        arguments = parts[2].strip() if len(parts) > 2 else ""
         
         try:
-            # Run LaunchProgram in a separate thread
-            await asyncio.to_thread(program_launcher.LaunchProgram, program, arguments)
+            # Run LaunchProgram in a separate thread, after any launch the model started
+            async with tool_dispatcher.exclusive["launch_program"]:
+                await asyncio.to_thread(lambda: program_launcher.get().LaunchProgram(program, arguments))
             launch_response = f"Launched program: {program}" + (f" with arguments: {arguments}" if arguments else "")
             logging.info(f"Program launch successful: {launch_response}")
         except Exception as e:
             launch_response = f"Failed to launch program: {program}. Error: {str(e)}"
+            errors_total.inc(where="launch")
             logging.error(f"Program launch failed: {launch_response}")
-        
-        response = await client.messages.create(
-            model="claude-3-5-sonnet-20240620",
-            max_tokens=1024,
-            system=self.system_prompt,
-            messages=self.messages + [{"role": "user", "content": launch_response}]
-        )
-        assistant_message = response.content[0].text
-        self.messages.append({"role": "user", "content": launch_response})
-        self.messages.append({"role": "assistant", "content": assistant_message})
-        return launch_response + "\n" + assistant_message
+        return launch_response
 
     async def handle_program_update(self, update_type):
-        update_message = f"Program update received: {update_type}"
-        response = await client.messages.create(
-            model="claude-3-5-sonnet-20240620",
-            max_tokens=1024,
-            system=self.system_prompt,
-            messages=self.messages + [{"role": "user", "content": update_message}]
-        )
-        assistant_message = response.content[0].text
-        self.messages.append({"role": "user", "content": update_message})
-        self.messages.append({"role": "assistant", "content": assistant_message})
-        return assistant_message
+        # Updates that arrive within the debounce window share one follow-up request;
+        # ones that arrive during a turn are folded into that turn's follow-up
+        self.pending_updates.append(update_type)
+        if self._update_flush is None or self._update_flush.done():
+            self._update_flush = asyncio.create_task(self._flush_updates())
+        return await asyncio.shield(self._update_flush)
 
-    async def handle_python_command(self, command):
-        result = execute_python_command(command)
-        result_message = f"Python command result: {result}"
-        response = await client.messages.create(
-            model="claude-3-5-sonnet-20240620",
-            max_tokens=1024,
-            system=self.system_prompt,
-            messages=self.messages + [{"role": "user", "content": result_message}]
-        )
-        assistant_message = response.content[0].text
-        self.messages.append({"role": "user", "content": result_message})
-        self.messages.append({"role": "assistant", "content": assistant_message})
-        return f"Command executed. Result:\n{result}\n\nAssistant response:\n{assistant_message}"
-
-async def handle_client_connection(client_socket):
-    chat_session = ChatSession()
-    chat_session.load_chat_memory()  # Load previous chat memory if it exists
-    while True:
+    async def _flush_updates(self):
+        replies = []
+        while self.pending_updates:
+            await asyncio.sleep(PROGRAM_UPDATE_DEBOUNCE)
+            async with self.turn_lock:
+                assistant_message = await self.follow_up([])
+            if assistant_message:
+                replies.append(assistant_message)
+        return "\n\n".join(replies) or None
+
+    async def handle_python_command(self, command, on_output=None):
         try:
-            request = await asyncio.get_event_loop().sock_recv(client_socket, 4096)
-            request = request.decode().strip()
-            if not request:
+            with stage_seconds.time(stage="scrape" if command.startswith("scrape_website") else "subprocess"):
+                result = await execute_python_command(command, page_fetcher, environment_cache, on_output)
+        except Exception as e:
+            errors_total.inc(where="command")
+            logging.error(f"Python command failed: {str(e)}")
+            result = f"Error: {str(e)}"
+        return f"Python command result: {result}"
+
+async def restore_session(session_id):
+    chat_session = ChatSession(session_id)
+    await chat_session.load_chat_memory()
+    return chat_session
+
+session_registry = SessionRegistry(
+    restore_session,
+    max_resident=env_int('DANTALION_MAX_SESSIONS', 100),
+    max_resident_bytes=env_int('DANTALION_MAX_SESSION_BYTES', 64 * 1024 * 1024),
+    idle_timeout=env_int('DANTALION_SESSION_IDLE_TIMEOUT', 900)
+)
+
+# Unnamed sessions, which live as long as their connection
+connection_sessions = set()
+
+def interpreter_pools():
+    return [manager.pool for manager in list(environment_cache.managers.values()) if manager.pool is not None]
+
+def subsystem_stats():
+    # Everything the subsystems count about themselves, by subsystem and name
+    subsystems = {"jobs": job_runner, "fetch_cache": page_fetcher.cache, "knowledge_index": knowledge_index,
+                  "browsers": browser_pool, "response_cache": response_cache, "vector_memory": memory_vectors,
+                  "summarizer": summarizer}
+    values = {}
+    for name, subsystem in subsystems.items():
+        if subsystem is not None:
+            for stat, value in subsystem.stats().items():
+                values[(name, stat)] = float(value)
+    return values
+
+def session_tokens():
+    # Tokens billed to each resident named session; connection sessions are summed under ""
+    values = {}
+    sessions = [(session_id, entry.session) for session_id, entry in list(session_registry.entries.items())]
+    sessions += [("", chat_session) for chat_session in list(connection_sessions)]
+    for session_id, chat_session in sessions:
+        for field, count in chat_session.usage.items():
+            key = (session_id, field[:-len("_tokens")])
+            values[key] = values.get(key, 0) + count
+    return values
+
+def cache_counts(hits):
+    # Hits, or misses, of each cache by name
+    fetch_cache = page_fetcher.cache
+    counts = {
+        ("fetch",): fetch_cache.hits + fetch_cache.revalidated if hits else fetch_cache.misses + fetch_cache.changed,
+        ("environment",): environment_cache.hits if hits else environment_cache.builds
+    }
+    if response_cache:
+        counts[("response",)] = response_cache.memory_hits + response_cache.disk_hits if hits else response_cache.misses
+    if summarizer:
+        counts[("summary",)] = summarizer.cached if hits else summarizer.summaries
+    return counts
+
+# Read from the subsystems whenever the metrics are scraped
+metrics.counter("cache_hits_total", "Cache hits, by cache.", labels=("cache",), function=lambda: cache_counts(True))
+metrics.counter("cache_misses_total", "Cache misses, by cache.", labels=("cache",), function=lambda: cache_counts(False))
+metrics.counter("llm_retries_total", "LLM requests retried.", function=lambda: scheduler.retries)
+metrics.counter("tool_calls_total", "Tool calls made by the model.", function=lambda: tool_dispatcher.calls)
+metrics.counter("tool_errors_total", "Tool calls that failed.", function=lambda: tool_dispatcher.errors)
+metrics.gauge("sessions", "Chat sessions in memory, named or owned by a connection.", labels=("kind",),
+              function=lambda: {("named",): session_registry.resident, ("connection",): len(connection_sessions)})
+metrics.gauge("llm_queue_depth", "LLM requests waiting for the scheduler.", function=lambda: scheduler.queue_depth)
+metrics.gauge("llm_in_flight", "LLM requests in flight.", function=lambda: scheduler.in_flight)
+metrics.gauge("job_queue_depth", "Subprocess jobs waiting for a worker.", function=lambda: job_runner.queue_depth)
+metrics.gauge("jobs_running", "Subprocess jobs running.", function=lambda: job_runner.running)
+metrics.gauge("code_run_queue_depth", "Code runs waiting for a warm interpreter.",
+              function=lambda: sum(pool.queue_depth for pool in interpreter_pools()))
+metrics.gauge("interpreters_busy", "Warm interpreters running code.", function=lambda: sum(pool.busy for pool in interpreter_pools()))
+metrics.gauge("session_tokens", "Tokens billed so far to each session in memory, including prompt cache writes and reads.",
+              labels=("session", "kind"), function=session_tokens)
+metrics.gauge("subsystem_stats", "Counts each subsystem keeps about itself (stats()).", labels=("subsystem", "stat"),
+              function=subsystem_stats)
+metrics.gauge("browsers_busy", "Headless browsers loading a page.", function=lambda: browser_pool.busy)
+metrics.gauge("journal_pending_records", "Chat journal records not yet written.", function=lambda: chat_journal.pending_records)
+if summarizer:
+    metrics.gauge("summaries_scheduled", "Sessions waiting to be summarized.", function=lambda: len(summarizer.tasks))
+
+def split_session_line(request):
+    # Legacy clients may open with a "SESSION <id>" line to resume a named session
+    if request.startswith("SESSION "):
+        first_line, _, rest = request.partition("\n")
+        return first_line[len("SESSION "):].strip(), rest
+    return None, request
+
+async def handle_client_connection(connection):
+    # The first bytes decide between the framed protocol and the legacy raw mode
+    preamble = b""
+    framed = None
+    try:
+        while framed is None:
+            # Legacy text that happens to start like MAGIC ("D") is settled by a pause
+            chunk = await connection.recv(4096, timeout=PREAMBLE_TIMEOUT if preamble else None)
+            if chunk is None:
+                framed = False
+                break
+            if not chunk:
                 logging.info("Client disconnected")
                 break
-            logging.debug(f"Received request: {request}")
-            
-            response = await chat_session.process_message(request)
-            await asyncio.get_event_loop().sock_sendall(client_socket, response.encode())
+            preamble += chunk
+            framed = is_framed_preamble(preamble)
+        if framed:
+            await handle_framed_connection(connection, preamble[len(MAGIC):])
+        elif framed is False:
+            await handle_legacy_connection(connection, preamble)
+    except Exception as e:
+        errors_total.inc(where="connection")
+        logging.error(f"Error in handle_client_connection: {str(e)}")
+        logging.debug(traceback.format_exc())
+
+async def process_named_message(session_id, request):
+    async with session_registry.lease(session_id) as named_session:
+        return await named_session.process_message(request)
+
+async def run_until_disconnect(connection, work):
+    # Runs a request while watching the socket. If the client goes away the
+    # request is cancelled, along with any job it started. Anything the client
+    # sends in the meantime is returned to be handled as the next request.
+    task = asyncio.ensure_future(work)
+    read_task = asyncio.ensure_future(connection.recv(4096))
+    try:
+        done, _ = await asyncio.wait({task, read_task}, return_when=asyncio.FIRST_COMPLETED)
+        if read_task in done and not read_task.result() and not connection.draining:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            return None, None
+        response = await task
+    finally:
+        for pending_task in (task, read_task):
+            if not pending_task.done():
+                pending_task.cancel()
+        await asyncio.gather(read_task, return_exceptions=True)
+    return response, None if read_task.cancelled() else read_task.result()
+
+async def handle_legacy_connection(connection, initial_data):
+    session_id, request = split_session_line(initial_data.decode())
+    chat_session = None
+    if session_id is None:
+        # The GUI doesn't name a session, so it gets the default one back on every reconnect
+        session_id = LEGACY_SESSION or None
+    if session_id is None:
+        chat_session = ChatSession()
+        connection_sessions.add(chat_session)
+    elif not request.strip():
+        request = None
+    received = time.monotonic()
+    try:
+        while True:
+            try:
+                if request is None:
+                    data = await connection.recv(4096)
+                    received = time.monotonic()
+                    request = data.decode()
+                request = request.strip()
+                if not request:
+                    logging.info("Client disconnected")
+                    break
+                # A legacy request arrives in one read; this is the time to decode it
+                stage_seconds.observe(time.monotonic() - received, stage="receive")
+                logging.debug(f"Received request: {request}")
+                received_bytes.inc(len(request.encode()))
+                requests_total.inc(protocol="legacy")
+                
+                with connection.busy():
+                    if chat_session:
+                        work = chat_session.process_message(request)
+                    else:
+                        work = process_named_message(session_id, request)
+                    response, next_data = await run_until_disconnect(connection, work)
+                    if response is None:
+                        logging.info("Client disconnected, request cancelled")
+                        break
+                    await connection.send(response.encode())
+                request = next_data.decode() if next_data else None
+            except Exception as e:
+                errors_total.inc(where="connection")
+                logging.error(f"Error in handle_legacy_connection: {str(e)}")
+                logging.debug(traceback.format_exc())
+                break
+    finally:
+        # The session goes away with the connection; so does its pending summary
+        if chat_session:
+            connection_sessions.discard(chat_session)
+            if summarizer:
+                summarizer.cancel(chat_session)
+
+async def handle_framed_connection(connection, initial_data):
+    decoder = FrameDecoder()
+    sessions = {}
+    session_locks = {}
+    unloaded = set()
+    bound_sessions = {}
+    write_lock = asyncio.Lock()
+    pending = set()
+
+    async def send_frame(frame_type, channel, request_id, payload, flags=0):
+        async with write_lock:
+            await connection.send(encode_frame(frame_type, channel, request_id, payload, flags))
+
+    async def process_on_channel(frame, on_delta, on_output):
+        # Requests on the same channel share one session and run in order;
+        # different channels run concurrently
+        use_cache = not frame.flags & FLAG_NO_CACHE
+        session_id = bound_sessions.get(frame.channel)
+        if session_id is not None:
+            async with session_registry.lease(session_id) as chat_session:
+                return await chat_session.process_message(frame.text(), on_delta, use_cache=use_cache, on_output=on_output)
+        if frame.channel not in sessions:
+            sessions[frame.channel] = ChatSession()
+            connection_sessions.add(sessions[frame.channel])
+            session_locks[frame.channel] = asyncio.Lock()
+            unloaded.add(frame.channel)
+        async with session_locks[frame.channel]:
+            if frame.channel in unloaded:
+                unloaded.discard(frame.channel)
+                await sessions[frame.channel].load_chat_memory()
+            return await sessions[frame.channel].process_message(frame.text(), on_delta, use_cache=use_cache, on_output=on_output)
+
+    async def serve_request(frame):
+        try:
+            on_delta = None
+            on_output = None
+            if frame.frame_type == FRAME_STREAM_REQUEST:
+                async def on_delta(text):
+                    await send_frame(FRAME_DELTA, frame.channel, frame.request_id, text)
+
+                async def on_output(stream, text):
+                    flags = FLAG_STDERR if stream == "stderr" else 0
+                    await send_frame(FRAME_OUTPUT, frame.channel, frame.request_id, text, flags)
+            with connection.busy():
+                response = await process_on_channel(frame, on_delta, on_output)
+                await send_frame(FRAME_REPLY, frame.channel, frame.request_id, response)
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
-            logging.error(f"Error in handle_client_connection: {str(e)}")
+            errors_total.inc(where="request")
+            logging.error(f"Error serving request {frame.request_id} on channel {frame.channel}: {str(e)}")
             logging.debug(traceback.format_exc())
-            break
-    client_socket.close()
+            try:
+                await send_frame(FRAME_ERROR, frame.channel, frame.request_id, str(e))
+            except OSError:
+                pass
 
-async def start_server():
-    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server.bind(('0.0.0.0', 9999))
-    server.listen(5)
-    logging.info('Server listening on port 9999')
-    while True:
+    async def bind_session(frame):
         try:
-            client_sock, addr = await asyncio.get_event_loop().sock_accept(server)
-            logging.info(f"New connection from {addr}")
-            asyncio.create_task(handle_client_connection(client_sock))
+            _, status = await session_registry.open(frame.text())
+        except ValueError as e:
+            await send_frame(FRAME_ERROR, frame.channel, frame.request_id, str(e))
+            return
+        bound_sessions[frame.channel] = frame.text()
+        logging.info(f"Channel {frame.channel} bound to session {frame.text()} ({status})")
+        await send_frame(FRAME_REPLY, frame.channel, frame.request_id, status)
+
+    data = initial_data
+    receive_started = None
+    try:
+        while True:
+            if data:
+                received_bytes.inc(len(data))
+                receive_started = receive_started or time.monotonic()
+            frames = decoder.feed(data)
+            if frames:
+                # From the first byte of a request to its last
+                stage_seconds.observe(time.monotonic() - receive_started, stage="receive")
+                receive_started = time.monotonic() if decoder.pending else None
+            for frame in frames:
+                if frame.frame_type == FRAME_SESSION:
+                    await bind_session(frame)
+                    continue
+                if frame.frame_type not in REQUEST_TYPES:
+                    raise ProtocolError(f"Unexpected frame type from client: {frame.frame_type}")
+                logging.debug(f"Received {frame!r}")
+                requests_total.inc(protocol="framed")
+                task = asyncio.create_task(serve_request(frame))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+            # Stop reading while this connection already has enough requests in flight
+            while len(pending) >= MAX_PENDING_REQUESTS:
+                await asyncio.wait(set(pending), return_when=asyncio.FIRST_COMPLETED)
+            data = await connection.recv(65536)
+            if not data:
+                logging.info("Client disconnected")
+                break
+    except ProtocolError as e:
+        logging.error(f"Protocol error, closing connection: {str(e)}")
+    finally:
+        # On shutdown let in-flight requests finish; if the client went away, drop them
+        if not connection.draining:
+            for task in pending:
+                task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        # Named sessions live on in the registry; this connection's own don't
+        for chat_session in sessions.values():
+            connection_sessions.discard(chat_session)
+            if summarizer:
+                summarizer.cancel(chat_session)
+
+async def warm_up():
+    # Load what the first requests will need without holding up the listener
+    subsystems = [client.get, memory_manager.get, get_system_prompt, knowledge_index.refresh]
+    if memory_vectors is not None:
+        subsystems.append(memory_vectors.sync)
+    for load in subsystems:
+        try:
+            await asyncio.to_thread(load)
         except Exception as e:
-            logging.error(f"Error in start_server: {str(e)}")
+            logging.error(f"Warm-up failed: {str(e)}")
             logging.debug(traceback.format_exc())
+    # Only start interpreters for an environment that already exists
+    environment = environment_cache.existing()
+    if environment:
+        environment.interpreter_pool().start()
+    logging.info(startup_timer.report())
+
+async def start_server():
+    server = ChatServer(
+        handle_client_connection,
+        port=env_int('DANTALION_PORT', 9999),
+        max_connections=env_int('DANTALION_MAX_CONNECTIONS', 64),
+        backlog=env_int('DANTALION_BACKLOG', 128),
+        read_limit=env_int('DANTALION_READ_LIMIT', 64 * 1024),
+        write_high_water=env_int('DANTALION_WRITE_HIGH_WATER', 256 * 1024),
+        write_low_water=env_int('DANTALION_WRITE_LOW_WATER', 64 * 1024),
+        idle_timeout=env_int('DANTALION_IDLE_TIMEOUT', 600),
+        drain_timeout=env_int('DANTALION_DRAIN_TIMEOUT', 60)
+    )
+    await server.start()
+    startup_timer.mark("bind")
+    metrics.gauge("connections", "Open client connections.", function=lambda: server.active_connections)
+    if METRICS_PORT:
+        try:
+            await metrics.serve(port=METRICS_PORT)
+        except OSError as e:
+            logging.error(f"Failed to start the metrics endpoint: {str(e)}")
+    logging.info(startup_timer.report())
+    session_registry.start()
+    if env_int('DANTALION_WARM_UP', 1):
+        asyncio.create_task(warm_up())
+    try:
+        await server.serve_forever()
+    finally:
+        await metrics.close()
+        if summarizer:
+            await summarizer.close()
+        await session_registry.close()
+        await chat_journal.close()
+        environment_cache.close()
+        await asyncio.to_thread(knowledge_index.close)
+        if memory_vectors is not None:
+            await asyncio.to_thread(memory_vectors.close)
+        await page_fetcher.close()
+        await asyncio.to_thread(browser_pool.close)
+
+startup_timer.mark("configuration")
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.DEBUG)
@@ -0,0 +1,266 @@
+import asyncio
+import logging
+import os
+import signal
+import subprocess
+import threading
+import time
+
+# Pool of headless Chrome browsers that scrapes lease one page load at a time.
+#
+# Starting Chrome and resolving its driver take most of a scrape's time, so up
+# to size browsers stay open between scrapes. A browser is health-checked before
+# it is handed out and replaced if it doesn't answer, after max_pages page
+# loads, or when a load fails or runs past its timeout. The driver is resolved
+# once per pool: driver_path names a local chromedriver and skips the network
+# lookup entirely, otherwise webdriver_manager finds (and if needed downloads)
+# one when the first browser starts. Selenium is only imported at that point.
+# load() blocks, so synchronous callers can use the pool directly; load_async()
+# is for the event loop and kills the browser if the awaiting task is cancelled.
+# It waits for one of size slots on the loop before handing the load to a thread.
+
+
+class Browser:
+    def __init__(self, driver):
+        self.driver = driver
+        self.pages = 0
+
+    @property
+    def process(self):
+        # The chromedriver process; Chrome runs in its process group
+        service = getattr(self.driver, 'service', None)
+        return getattr(service, 'process', None)
+
+    def healthy(self):
+        try:
+            self.driver.execute_script("return 1")
+            return True
+        except Exception:
+            return False
+
+    def load(self, url):
+        self.pages += 1
+        self.driver.get(url)
+        return self.driver.page_source
+
+    def reset(self):
+        # The next lease starts on a blank page without this one's cookies
+        self.driver.delete_all_cookies()
+        self.driver.get("about:blank")
+
+    def quit(self):
+        try:
+            self.driver.quit()
+        except Exception as e:
+            logging.debug(f"Browser did not quit cleanly: {str(e)}")
+            self.kill()
+
+    def kill(self):
+        # For a browser stuck in a page load, which quit() would wait on
+        process = self.process
+        if process is None:
+            return
+        try:
+            if os.name == 'nt':
+                subprocess.run(['taskkill', '/F', '/T', '/PID', str(process.pid)],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            else:
+                os.killpg(process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        try:
+            process.kill()
+            process.wait()
+        except OSError:
+            pass
+
+
+class BrowserLease:
+    # One page load's browser, so a timeout or a cancelled caller can kill it
+    def __init__(self):
+        self.browser = None
+        self.cancelled = False
+        self.lock = threading.Lock()
+
+    def stop(self):
+        with self.lock:
+            self.cancelled = True
+            if self.browser is not None:
+                self.browser.kill()
+
+
+class BrowserPool:
+    def __init__(self, size=2, max_pages=50, page_load_timeout=30, timeout=60, driver_path=None,
+                 browser_binary=None, arguments=(), create_driver=None):
+        # create_driver() returns a new WebDriver; by default a headless Chrome
+        self.size = size
+        self.max_pages = max_pages
+        self.page_load_timeout = page_load_timeout
+        self.timeout = timeout
+        self.driver_path = driver_path
+        self.browser_binary = browser_binary
+        self.arguments = arguments
+        self.create_driver = create_driver or self.create_chrome
+        self.idle = []
+        self.busy = 0
+        self.queued = 0
+        self.slots = None
+        self.closed = False
+        self.pages = 0
+        self.started = 0
+        self.recycled = 0
+        self.failures = 0
+        self.condition = threading.Condition()
+        self._driver_lock = threading.Lock()
+
+    @property
+    def warm(self):
+        return len(self.idle)
+
+    def resolve_driver(self):
+        with self._driver_lock:
+            if self.driver_path is None:
+                from webdriver_manager.chrome import ChromeDriverManager
+                started = time.monotonic()
+                self.driver_path = ChromeDriverManager().install()
+                logging.info(f"Resolved chromedriver {self.driver_path} in {time.monotonic() - started:.1f}s")
+            return self.driver_path
+
+    def create_chrome(self):
+        from selenium import webdriver
+        from selenium.webdriver.chrome.service import Service
+
+        options = webdriver.ChromeOptions()
+        options.add_argument('--headless')
+        for argument in self.arguments:
+            options.add_argument(argument)
+        if self.browser_binary:
+            options.binary_location = self.browser_binary
+        # Its own process group, so killing it takes Chrome down as well
+        popen_kw = {"creationflags": subprocess.CREATE_NEW_PROCESS_GROUP} if os.name == 'nt' else {"start_new_session": True}
+        service = Service(self.resolve_driver(), popen_kw=popen_kw)
+        driver = webdriver.Chrome(service=service, options=options)
+        driver.set_page_load_timeout(self.page_load_timeout)
+        return driver
+
+    def _start(self):
+        started = time.monotonic()
+        browser = Browser(self.create_driver())
+        self.started += 1
+        logging.info(f"Started browser in {time.monotonic() - started:.1f}s")
+        return browser
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            stale, self.idle = self.idle, []
+            self.condition.notify_all()
+        for browser in stale:
+            browser.quit()
+
+    def _acquire(self, lease):
+        with self.condition:
+            while True:
+                if self.closed:
+                    raise RuntimeError("Browser pool is closed")
+                if lease.cancelled:
+                    raise RuntimeError("Page load cancelled")
+                if self.idle or self.busy < self.size:
+                    break
+                self.condition.wait()
+            browser = self.idle.pop() if self.idle else None
+            self.busy += 1
+        try:
+            if browser is not None and not browser.healthy():
+                logging.info("Replacing a browser that stopped responding")
+                self.recycled += 1
+                browser.kill()
+                browser = None
+            if browser is None:
+                browser = self._start()
+        except Exception:
+            with self.condition:
+                self.busy -= 1
+                self.condition.notify()
+            raise
+        return browser
+
+    def _release(self, browser, reusable):
+        with self.condition:
+            self.busy -= 1
+            self.condition.notify()
+            if reusable and not self.closed and browser.pages < self.max_pages:
+                self.idle.append(browser)
+                return
+        if reusable:
+            self.recycled += 1
+            logging.info(f"Recycling browser after {browser.pages} pages")
+            browser.quit()
+        else:
+            browser.kill()
+
+    def load(self, url, lease=None):
+        # Returns the page source of url once it has loaded
+        lease = lease or BrowserLease()
+        browser = self._acquire(lease)
+        with lease.lock:
+            lease.browser = browser
+            if lease.cancelled:
+                browser.kill()
+        reusable = False
+        try:
+            page_source = browser.load(url)
+            browser.reset()
+            reusable = True
+            return page_source
+        except Exception:
+            self.failures += 1
+            raise
+        finally:
+            with lease.lock:
+                lease.browser = None
+                reusable = reusable and not lease.cancelled
+            self.pages += 1
+            self._release(browser, reusable)
+
+    async def load_async(self, url, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        lease = BrowserLease()
+        try:
+            return await asyncio.wait_for(self._load_in_slot(url, lease), timeout)
+        except asyncio.TimeoutError:
+            self._stop(lease)
+            raise RuntimeError(f"Loading {url} timed out after {timeout}s")
+        except asyncio.CancelledError:
+            # The thread can't be interrupted, but killing its browser ends the load
+            self._stop(lease)
+            raise
+
+    async def _load_in_slot(self, url, lease):
+        # Loads queued behind a busy pool wait here rather than in an executor
+        # thread; the slot is held until the thread is done, even after a timeout
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.size)
+        self.queued += 1
+        try:
+            await self.slots.acquire()
+        finally:
+            self.queued -= 1
+        thread = asyncio.ensure_future(asyncio.to_thread(self.load, url, lease))
+        thread.add_done_callback(self._free_slot)
+        return await asyncio.shield(thread)
+
+    def _free_slot(self, thread):
+        self.slots.release()
+        if not thread.cancelled():
+            thread.exception()
+
+    def _stop(self, lease):
+        lease.stop()
+        with self.condition:
+            self.condition.notify_all()
+
+    def stats(self):
+        with self.condition:
+            return {"warm": len(self.idle), "busy": self.busy, "started": self.started,
+                    "recycled": self.recycled, "pages": self.pages, "failures": self.failures}
@@ -0,0 +1,197 @@
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+import traceback
+
+# Append-only, write-behind journal of chat histories.
+#
+# Each conversation has a JSON-lines log. Sessions only queue small records
+# (a message was appended, some messages were dropped, one was pinned); a
+# background task batches them and writes them on a worker thread, so the cost
+# of a turn is proportional to what changed and the event loop never waits on
+# the disk. Replaying the log rebuilds the history; a torn last line from a
+# crash is skipped. Logs that have grown well past their live history are
+# rewritten as a single snapshot record.
+
+FSYNC_ALWAYS = 'always'
+FSYNC_INTERVAL = 'interval'
+FSYNC_NEVER = 'never'
+
+
+def replay(records):
+    messages, pinned = [], []
+    for record in records:
+        op = record["op"]
+        if op == "snapshot":
+            messages, pinned = list(record["messages"]), list(record["pinned"])
+        elif op == "append":
+            messages.append(record["message"])
+            pinned.append(record.get("pinned", False))
+        elif op == "drop":
+            drop = set(record["indices"])
+            messages = [message for i, message in enumerate(messages) if i not in drop]
+            pinned = [flag for i, flag in enumerate(pinned) if i not in drop]
+        elif op == "pin":
+            if record["index"] < len(pinned):
+                pinned[record["index"]] = True
+    return messages, pinned
+
+
+class ChatJournal:
+    def __init__(self, directory='memory/journal', fsync=FSYNC_INTERVAL, fsync_interval=1.0,
+                 flush_interval=0.2, compact_slack=64):
+        self.directory = directory
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.flush_interval = flush_interval
+        self.compact_slack = compact_slack
+        self.records_written = 0
+        self.batches_written = 0
+        self._pending = {}
+        self._writing = {}
+        self._record_counts = {}
+        self._last_fsync = 0.0
+        self._io_lock = threading.Lock()
+        self._wakeup = None
+        self._flusher = None
+        self._flush_lock = None
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, name):
+        return os.path.join(self.directory, f"{name}.jsonl")
+
+    @property
+    def pending_records(self):
+        return sum(len(lines) for lines in self._pending.values())
+
+    def record(self, name, op, **fields):
+        self._pending.setdefault(name, []).append(json.dumps({"op": op, **fields}))
+        self._record_counts[name] = self._record_counts.get(name, 0) + 1
+        self._ensure_flusher()
+
+    def compact(self, name, messages, pinned):
+        # A snapshot makes everything before it redundant; the writer rewrites the file
+        self._pending[name] = [json.dumps({"op": "snapshot", "messages": messages, "pinned": pinned})]
+        self._record_counts[name] = 1
+        self._ensure_flusher()
+
+    def needs_compaction(self, name, live_messages):
+        return self._record_counts.get(name, 0) > 2 * live_messages + self.compact_slack
+
+    def load(self, name):
+        # Replays the log plus anything still waiting to be written
+        return self._replay(name, self._read_lines(name) + self._pending.get(name, []))
+
+    async def load_async(self, name):
+        # Same as load(), reading and parsing on a worker thread. No batch is being
+        # written meanwhile, so every record is either in the file or still pending.
+        async with self._get_flush_lock():
+            lines = await asyncio.to_thread(self._read_lines, name)
+            lines += self._pending.get(name, [])
+            return await asyncio.to_thread(self._replay, name, lines)
+
+    def _read_lines(self, name):
+        with self._io_lock:
+            lines = []
+            try:
+                with open(self.path(name), 'r', encoding='utf-8') as f:
+                    lines = f.read().splitlines()
+            except FileNotFoundError:
+                pass
+            return lines + self._writing.get(name, [])
+
+    def _replay(self, name, lines):
+        records = []
+        for line in lines:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                logging.warning(f"Skipping damaged record in chat journal {name}")
+        self._record_counts[name] = len(records)
+        return replay(records)
+
+    def _ensure_flusher(self):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        if self._flusher is None or self._flusher.done():
+            self._wakeup = asyncio.Event()
+            self._flusher = loop.create_task(self._flush_loop())
+        elif self.flush_interval == 0:
+            self._wakeup.set()
+
+    async def _flush_loop(self):
+        while self._pending:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    def _get_flush_lock(self):
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+        return self._flush_lock
+
+    async def flush(self):
+        async with self._get_flush_lock():
+            if not self._pending:
+                return
+            batch, self._pending = self._pending, {}
+            try:
+                await asyncio.to_thread(self._write_batch, batch)
+            except Exception as e:
+                logging.error(f"Failed to write chat journal: {str(e)}")
+                logging.debug(traceback.format_exc())
+                # Keep the records so the next flush retries them in order
+                for name, lines in batch.items():
+                    self._pending[name] = lines + self._pending.get(name, [])
+
+    def _write_batch(self, batch):
+        with self._io_lock:
+            self._writing = batch
+            try:
+                sync = self.fsync == FSYNC_ALWAYS or (
+                    self.fsync == FSYNC_INTERVAL and time.monotonic() - self._last_fsync >= self.fsync_interval)
+                for name, lines in batch.items():
+                    self._write_lines(name, lines, sync)
+                if sync:
+                    self._last_fsync = time.monotonic()
+                self.records_written += sum(len(lines) for lines in batch.values())
+                self.batches_written += 1
+            finally:
+                self._writing = {}
+
+    def _write_lines(self, name, lines, sync):
+        data = ''.join(line + '\n' for line in lines).encode('utf-8')
+        path = self.path(name)
+        if json.loads(lines[0])["op"] == "snapshot":
+            temp_path = path + '.tmp'
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+                f.flush()
+                if sync:
+                    os.fsync(f.fileno())
+            os.replace(temp_path, path)
+            return
+        with open(path, 'ab+') as f:
+            # Terminate a line torn by a crash so it can't swallow the next record
+            if f.seek(0, os.SEEK_END) > 0:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    data = b'\n' + data
+            f.write(data)
+            f.flush()
+            if sync:
+                os.fsync(f.fileno())
+
+    async def close(self):
+        if self._flusher is not None:
+            self._flusher.cancel()
+            await asyncio.gather(self._flusher, return_exceptions=True)
+        await self.flush()
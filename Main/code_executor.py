@@ -3,10 +3,18 @@ import subprocess
 import sys
 import venv
 
+from interpreter_pool import InterpreterPool
+
 class VirtualEnvManager:
     def __init__(self, env_dir='venv'):
         self.env_dir = env_dir
         self.python_executable = os.path.join(env_dir, 'bin', 'python') if os.name != 'nt' else os.path.join(env_dir, 'Scripts', 'python.exe')
+        self.pool = None
+
+    def interpreter_pool(self):
+        if self.pool is None:
+            self.pool = InterpreterPool(self.python_executable)
+        return self.pool
 
     def create_virtual_env(self):
         if not os.path.exists(self.env_dir):
@@ -16,17 +24,22 @@ class VirtualEnvManager:
 
     def install_packages(self, packages):
         subprocess.check_call([self.python_executable, '-m', 'pip', 'install'] + packages)
+        if self.pool is not None:
+            self.pool.restart()
 
     def run_code(self, code):
-        with open('temp_code.py', 'w') as code_file:
-            code_file.write(code)
-        result = subprocess.run([self.python_executable, 'temp_code.py'], capture_output=True, text=True)
-        os.remove('temp_code.py')
-        return result.stdout, result.stderr
+        # Runs in a warm interpreter, fed over its pipes
+        result = self.interpreter_pool().run(code)
+        stderr = result.stderr
+        if result.timed_out:
+            stderr += f"\nExecution timed out after {result.duration:.0f}s"
+        return result.stdout, stderr
+
+# Shared so its warm interpreters are reused across calls
+manager = VirtualEnvManager()
 
 # Function to run code within a virtual environment
 def run_code_in_virtual_env(code, packages=None):
-    manager = VirtualEnvManager()
     manager.create_virtual_env()
     if packages:
         manager.install_packages(packages)
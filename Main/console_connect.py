@@ -1,16 +1,22 @@
+import itertools
 import socket
 import sys
 
-def connect_to_server(host='localhost', port=9999):
+from protocol import FLAG_NO_CACHE, MAGIC, FRAME_REQUEST, FRAME_ERROR, FRAME_STREAM_REQUEST, FRAME_DELTA, FRAME_OUTPUT, FLAG_STDERR, FRAME_SESSION, FrameDecoder, encode_frame
+
+def connect_to_server(host='localhost', port=9999, framed=True):
     try:
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         sock.connect((host, port))
+        if framed:
+            sock.sendall(MAGIC)
         return sock
     except Exception as e:
         print(f"Error connecting to server: {e}")
         sys.exit(1)
 
 def send_message(sock, message):
+    # Legacy raw mode: one send, one read, replies over 4 KB are cut off
     try:
         sock.sendall(message.encode())
         response = sock.recv(4096).decode()
@@ -19,8 +25,69 @@ def send_message(sock, message):
         print(f"Error communicating with server: {e}")
         return None
 
+class FramedClient:
+    def __init__(self, sock):
+        self.sock = sock
+        self.decoder = FrameDecoder()
+        self.request_ids = itertools.count(1)
+        self.replies = {}
+        self.deltas = {}
+
+    def submit(self, message, channel=0, stream=False, use_cache=True):
+        request_id = next(self.request_ids)
+        frame_type = FRAME_STREAM_REQUEST if stream else FRAME_REQUEST
+        flags = 0 if use_cache else FLAG_NO_CACHE
+        self.sock.sendall(encode_frame(frame_type, channel, request_id, message, flags))
+        return request_id
+
+    def wait_for(self, request_id, on_delta=None, on_output=None):
+        # Frames for other requests are parked until someone asks for them.
+        # on_output(text, is_stderr) gets the output of code the request runs.
+        def deliver(frame):
+            if frame.frame_type == FRAME_DELTA and on_delta:
+                on_delta(frame.text())
+            elif frame.frame_type == FRAME_OUTPUT and on_output:
+                on_output(frame.text(), bool(frame.flags & FLAG_STDERR))
+
+        for frame in self.deltas.pop(request_id, []):
+            deliver(frame)
+        while request_id not in self.replies:
+            data = self.sock.recv(65536)
+            if not data:
+                raise ConnectionError("Server closed the connection")
+            for frame in self.decoder.feed(data):
+                if frame.frame_type not in (FRAME_DELTA, FRAME_OUTPUT):
+                    self.replies[frame.request_id] = frame
+                elif frame.request_id == request_id:
+                    deliver(frame)
+                else:
+                    self.deltas.setdefault(frame.request_id, []).append(frame)
+        self.deltas.pop(request_id, None)
+        frame = self.replies.pop(request_id)
+        if frame.frame_type == FRAME_ERROR:
+            raise RuntimeError(frame.text())
+        return frame.text()
+
+    def open_session(self, session_id, channel=0):
+        # Binds the channel to a named session on the server; returns "resumed" or "loaded"
+        request_id = next(self.request_ids)
+        self.sock.sendall(encode_frame(FRAME_SESSION, channel, request_id, session_id))
+        return self.wait_for(request_id)
+
+    def send_message(self, message, channel=0, on_delta=None, use_cache=True, on_output=None):
+        stream = on_delta is not None or on_output is not None
+        return self.wait_for(self.submit(message, channel, stream=stream, use_cache=use_cache), on_delta, on_output)
+
 def main():
-    sock = connect_to_server()
+    framed = '--legacy' not in sys.argv[1:]
+    use_cache = '--no-cache' not in sys.argv[1:]
+    session_id = sys.argv[sys.argv.index('--session') + 1] if '--session' in sys.argv[1:-1] else None
+    sock = connect_to_server(framed=framed)
+    framed_client = FramedClient(sock) if framed else None
+    if session_id and framed_client:
+        print(f"Session {session_id}: {framed_client.open_session(session_id)}")
+    elif session_id:
+        sock.sendall(f"SESSION {session_id}\n".encode())
     print("Connected to server. Type 'quit' to exit.")
 
     while True:
@@ -28,7 +95,30 @@ def main():
         if user_input.lower() == 'quit':
             break
 
-        response = send_message(sock, user_input)
+        if framed_client:
+            # Print the reply as it streams in; anything beyond the streamed text
+            # (command results and follow-ups) is printed once the reply completes
+            streamed = []
+            def on_delta(text):
+                if not streamed:
+                    print("AI: ", end="")
+                streamed.append(text)
+                print(text, end="", flush=True)
+            def on_output(text, is_stderr):
+                # Output of code the assistant runs, shown as it is produced
+                (sys.stderr if is_stderr else sys.stdout).write(text)
+                (sys.stderr if is_stderr else sys.stdout).flush()
+            try:
+                response = framed_client.send_message(user_input, on_delta=on_delta, use_cache=use_cache, on_output=on_output)
+            except Exception as e:
+                print(f"Error communicating with server: {e}")
+                response = None
+            if streamed:
+                print()
+                if response == "".join(streamed):
+                    response = None
+        else:
+            response = send_message(sock, user_input)
         if response:
             print(f"AI: {response}")
 
@@ -36,4 +126,4 @@ def main():
     print("Disconnected from server.")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
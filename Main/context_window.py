@@ -0,0 +1,153 @@
+import json
+
+# Token-budgeted chat history. Each message is counted once when it is added and
+# the running total is adjusted as messages come and go, so trimming never has
+# to re-count the whole history. on_change, if set, is told about every append,
+# drop and pin so the history can be persisted incrementally, and gets a snapshot
+# when turns are folded into a summary.
+
+MESSAGE_OVERHEAD_TOKENS = 4
+
+def estimate_tokens(content):
+    # Roughly 4 characters per token; good enough for budgeting
+    if not isinstance(content, str):
+        content = json.dumps(content)
+    return len(content) // 4 + MESSAGE_OVERHEAD_TOKENS
+
+
+class ContextWindow:
+    def __init__(self, token_budget=16000, count_tokens=estimate_tokens):
+        self.token_budget = token_budget
+        self.count_tokens = count_tokens
+        self.messages = []
+        self.tokens = []
+        self.pinned = []
+        self.total_tokens = 0
+        self.on_change = None
+
+    def __len__(self):
+        return len(self.messages)
+
+    def append(self, message, pinned=False):
+        tokens = self.count_tokens(message["content"])
+        self.messages.append(message)
+        self.tokens.append(tokens)
+        self.pinned.append(pinned)
+        self.total_tokens += tokens
+        if self.on_change:
+            self.on_change("append", message=message, pinned=pinned)
+
+    def replace(self, messages, pinned=None):
+        # Loads a saved history; not reported to on_change
+        on_change, self.on_change = self.on_change, None
+        self.messages, self.tokens, self.pinned = [], [], []
+        self.total_tokens = 0
+        for i, message in enumerate(messages):
+            self.append(message, bool(pinned and pinned[i]))
+        self.on_change = on_change
+
+    def pin(self, index):
+        self.pinned[index] = True
+        if self.on_change:
+            self.on_change("pin", index=index)
+
+    def _turns(self):
+        # A turn is a user message plus the assistant replies that follow it. Tool
+        # results belong to the turn that made the calls, so they never start one.
+        starts = [i for i, message in enumerate(self.messages)
+                  if (message["role"] == "user" and not is_tool_result(message)) or i == 0]
+        return [(start, end) for start, end in zip(starts, starts[1:] + [len(self.messages)])]
+
+    def trim(self, token_budget=None):
+        # Drop the oldest unpinned turns until the history fits the budget. Whole
+        # turns go at once so user/assistant alternation is preserved; the newest
+        # turn is always kept. Returns the dropped messages, oldest first.
+        budget = self.token_budget if token_budget is None else token_budget
+        if self.total_tokens <= budget:
+            return []
+        over = self.total_tokens - budget
+        drop = set()
+        for start, end in self._turns()[:-1]:
+            if over <= 0:
+                break
+            if any(self.pinned[start:end]):
+                continue
+            drop.update(range(start, end))
+            over -= sum(self.tokens[start:end])
+        if not drop:
+            return []
+        if self.on_change:
+            self.on_change("drop", indices=sorted(drop))
+        return self._remove(drop)
+
+    def _remove(self, drop):
+        dropped = [self.messages[i] for i in sorted(drop)]
+        self.total_tokens -= sum(self.tokens[i] for i in drop)
+        keep = [i for i in range(len(self.messages)) if i not in drop]
+        self.messages = [self.messages[i] for i in keep]
+        self.tokens = [self.tokens[i] for i in keep]
+        self.pinned = [self.pinned[i] for i in keep]
+        return dropped
+
+    def oldest_turns(self, token_target, keep_turns=2):
+        # The oldest unpinned turns to take out for the history to fit token_target,
+        # never touching the newest keep_turns turns. Returns their messages.
+        over = self.total_tokens - token_target
+        messages = []
+        turns = self._turns()
+        for start, end in turns[:max(0, len(turns) - keep_turns)]:
+            if over <= 0:
+                break
+            if any(self.pinned[start:end]):
+                continue
+            messages.extend(self.messages[start:end])
+            over -= sum(self.tokens[start:end])
+        return messages
+
+    def fold(self, messages, summary):
+        # Replaces the given messages (those still present) with one pinned summary
+        # message, placed where the first of them was or after the pinned opening
+        ids = {id(message) for message in messages}
+        drop = {i for i, message in enumerate(self.messages) if id(message) in ids}
+        if drop:
+            position = min(drop)
+        else:
+            position = 0
+            while position < len(self.pinned) and self.pinned[position]:
+                position += 1
+        position -= sum(1 for i in drop if i < position)
+        self._remove(drop)
+        tokens = self.count_tokens(summary["content"])
+        self.messages.insert(position, summary)
+        self.tokens.insert(position, tokens)
+        self.pinned.insert(position, True)
+        self.total_tokens += tokens
+        if self.on_change:
+            self.on_change("snapshot", messages=list(self.messages), pinned=list(self.pinned))
+
+    def window(self, extra=None):
+        # Messages ready to send: starts with a user turn and strictly alternates,
+        # merging neighbours with the same role (e.g. a pinned turn next to a gap)
+        result = []
+        for message in self.messages + (extra or []):
+            if not result and message["role"] != "user":
+                continue
+            if result and result[-1]["role"] == message["role"]:
+                result[-1] = {"role": message["role"], "content": merge_content(result[-1]["content"], message["content"])}
+            else:
+                result.append(message)
+        return result
+
+
+def is_tool_result(message):
+    content = message["content"]
+    return not isinstance(content, str) and any(block.get("type") == "tool_result" for block in content)
+
+
+def merge_content(first, second):
+    if isinstance(first, str) and isinstance(second, str):
+        return f"{first}\n\n{second}"
+    blocks = []
+    for content in (first, second):
+        blocks.extend([{"type": "text", "text": content}] if isinstance(content, str) else content)
+    return blocks
@@ -0,0 +1,175 @@
+import asyncio
+import json
+import logging
+import time
+import traceback
+from urllib import robotparser
+from urllib.parse import urlparse
+
+from webscraper import normalize_url, knowledge_path
+
+# Crawls a site breadth-first from a start page, through a PageFetcher.
+#
+# The frontier holds each normalized URL once. Pages up to max_depth links away
+# from the start are fetched, max_pages at most, by `concurrency` workers; per
+# host no more than per_host requests run at once and requests start at least
+# `delay` seconds apart (longer if robots.txt asks for a Crawl-delay). robots.txt
+# is fetched once per host and its rules are obeyed. Only links on the start
+# page's host, or the host it redirects to, are followed, and only those under
+# prefix when one is given. Each page is written to a JSON Lines file in
+# knowledge/ as soon as it is fetched, so a long crawl can be read while it runs.
+
+SKIPPED_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.svg', '.webp', '.ico', '.pdf', '.zip', '.gz',
+                      '.tar', '.mp3', '.mp4', '.avi', '.mov', '.css', '.js', '.woff', '.woff2', '.exe')
+MAX_TEXT_CHARS = 50000
+
+
+class HostState:
+    def __init__(self, per_host, delay):
+        self.slots = asyncio.Semaphore(per_host)
+        self.lock = asyncio.Lock()
+        self.delay = delay
+        self.next_request = 0
+        self.robots = None
+        self.robots_lock = asyncio.Lock()
+
+    async def wait_turn(self):
+        # Spaces out the start of requests to this host
+        async with self.lock:
+            wait = self.next_request - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            self.next_request = time.monotonic() + self.delay
+
+
+class CrawlResult:
+    def __init__(self, path, pages, failures, blocked, duration):
+        self.path = path
+        self.pages = pages
+        self.failures = failures
+        self.blocked = blocked
+        self.duration = duration
+
+    def __repr__(self):
+        return (f"CrawlResult(path={self.path!r}, pages={self.pages}, failures={self.failures}, "
+                f"blocked={self.blocked}, duration={self.duration:.1f})")
+
+
+class Crawler:
+    def __init__(self, fetcher, max_depth=2, max_pages=100, concurrency=8, per_host=2, delay=0.5,
+                 prefix=None, obey_robots=True, render=False, timeout=None):
+        self.fetcher = fetcher
+        self.max_depth = max_depth
+        self.max_pages = max_pages
+        self.concurrency = concurrency
+        self.per_host = per_host
+        self.delay = delay
+        self.prefix = prefix
+        self.obey_robots = obey_robots
+        self.render = render
+        self.timeout = timeout
+        self.hosts = {}
+        self.seen = set()
+        self.frontier = asyncio.Queue()
+        self.pages = 0
+        self.failures = 0
+        self.blocked = 0
+        self.allowed_hosts = set()
+        self.output = None
+
+    def host(self, url):
+        netloc = urlparse(url).netloc
+        if netloc not in self.hosts:
+            self.hosts[netloc] = HostState(self.per_host, self.delay)
+        return self.hosts[netloc]
+
+    async def robots(self, url, host):
+        # Parsed once per host; a missing or unreadable robots.txt allows everything
+        async with host.robots_lock:
+            if host.robots is None:
+                parsed = urlparse(url)
+                rules = robotparser.RobotFileParser()
+                try:
+                    _, text = await self.fetcher.get(f"{parsed.scheme}://{parsed.netloc}/robots.txt")
+                    rules.parse(text.splitlines())
+                except Exception as e:
+                    logging.debug(f"No robots.txt for {parsed.netloc}: {str(e)}")
+                    rules.parse([])
+                delay = rules.crawl_delay(self.fetcher.user_agent)
+                if delay:
+                    host.delay = max(host.delay, float(delay))
+                host.robots = rules
+        return host.robots
+
+    def in_scope(self, url):
+        parsed = urlparse(url)
+        if parsed.netloc not in self.allowed_hosts or parsed.path.lower().endswith(SKIPPED_EXTENSIONS):
+            return False
+        return not self.prefix or url.startswith(self.prefix) or parsed.path.startswith(self.prefix)
+
+    def enqueue(self, url, depth):
+        if url is None or url in self.seen or len(self.seen) >= self.max_pages:
+            return
+        self.seen.add(url)
+        self.frontier.put_nowait((url, depth))
+
+    async def crawl(self, start_url):
+        started = time.monotonic()
+        start_url = normalize_url(start_url)
+        if start_url is None:
+            raise ValueError("The crawl must start at an http(s) URL")
+        self.allowed_hosts.add(urlparse(start_url).netloc)
+        path = knowledge_path(start_url, "jsonl", unique=True)
+        self.output = open(path, 'w', encoding='utf-8')
+        self.enqueue(start_url, 0)
+        workers = [asyncio.create_task(self.worker()) for _ in range(self.concurrency)]
+        try:
+            await self.frontier.join()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            self.output.close()
+        result = CrawlResult(path, self.pages, self.failures, self.blocked, time.monotonic() - started)
+        logging.info(f"Crawled {start_url}: {result}")
+        return result
+
+    async def worker(self):
+        while True:
+            url, depth = await self.frontier.get()
+            try:
+                await self.visit(url, depth)
+            except Exception as e:
+                self.failures += 1
+                logging.warning(f"Failed to crawl {url}: {str(e)}")
+                logging.debug(traceback.format_exc())
+            finally:
+                self.frontier.task_done()
+
+    async def visit(self, url, depth):
+        host = self.host(url)
+        if self.obey_robots and not (await self.robots(url, host)).can_fetch(self.fetcher.user_agent, url):
+            self.blocked += 1
+            return
+        async with host.slots:
+            await host.wait_turn()
+            page = await self.fetcher.fetch(url, self.render, self.timeout)
+        if depth == 0:
+            # The start page may redirect, e.g. to https or a www. host
+            self.allowed_hosts.add(urlparse(page.url).netloc)
+        links = list(dict.fromkeys(normalize_url(href, page.url) for href in page.parsed.links))
+        links = [link for link in links if link is not None]
+        self.pages += 1
+        self.output.write(json.dumps({
+            "url": url,
+            "depth": depth,
+            "title": page.parsed.title,
+            "rendered": page.rendered,
+            "links": links,
+            "text": page.parsed.text()[:MAX_TEXT_CHARS]
+        }) + "\n")
+        self.output.flush()
+        if depth < self.max_depth:
+            for link in links:
+                if self.in_scope(link):
+                    self.enqueue(link, depth + 1)
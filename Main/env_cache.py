@@ -0,0 +1,272 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import sys
+import time
+import traceback
+import uuid
+from contextlib import asynccontextmanager
+
+# Virtual environments cached by the set of packages they were built with.
+#
+# A request's package list is normalized (names per PEP 503, whitespace removed,
+# sorted, duplicates dropped) and hashed together with the Python version; the
+# hash names the environment's directory. An existing environment is reused as
+# is, so pip only ever runs once per package set. New environments are built in
+# a scratch directory and renamed into place when complete, then their
+# site-packages files are hard-linked into a content-addressed object store, so
+# a package that several environments share takes its disk space once. The
+# least recently used environments are deleted once the cache passes its disk
+# budget; environments in use are never deleted. In offline mode pip installs
+# only from a local wheelhouse.
+
+MARKER = 'dantalion-env.json'
+OBJECTS = '.objects'
+REQUIREMENT_PATTERN = re.compile(r'^([A-Za-z0-9][A-Za-z0-9._-]*)(.*)$')
+
+
+def normalize_requirement(requirement):
+    requirement = requirement.strip()
+    match = REQUIREMENT_PATTERN.match(requirement)
+    if not match:
+        # Also keeps pip options out of the package list
+        raise ValueError(f"Invalid package requirement: {requirement!r}")
+    name = re.sub(r'[-_.]+', '-', match.group(1)).lower()
+    return name + re.sub(r'\s+', '', match.group(2))
+
+
+def normalize_requirements(packages):
+    return sorted({normalize_requirement(package) for package in packages or [] if package.strip()})
+
+
+def environment_key(requirements):
+    python = f"python{sys.version_info.major}.{sys.version_info.minor}"
+    return hashlib.sha256("\n".join([python] + requirements).encode('utf-8')).hexdigest()[:16]
+
+
+def python_executable(env_dir):
+    return os.path.join(env_dir, 'bin', 'python') if os.name != 'nt' else os.path.join(env_dir, 'Scripts', 'python.exe')
+
+
+class EnvironmentCache:
+    def __init__(self, create_manager, runner, directory='venvs', max_bytes=4 * 1024 * 1024 * 1024,
+                 wheelhouse=None, offline=False, share_files=True, install_timeout=900):
+        # create_manager(env_dir) wraps a finished environment; it must provide close()
+        self.create_manager = create_manager
+        self.runner = runner
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.wheelhouse = wheelhouse
+        self.offline = offline
+        self.share_files = share_files
+        self.install_timeout = install_timeout
+        self.managers = {}
+        self.leases = {}
+        self.locks = {}
+        self.building = set()
+        self.hits = 0
+        self.builds = 0
+        self.evictions = 0
+        self.shared_bytes = 0
+
+    def _lock(self, key):
+        return self.locks.setdefault(key, asyncio.Lock())
+
+    def env_dir(self, key):
+        return os.path.join(self.directory, key)
+
+    def pip_options(self):
+        options = []
+        if self.wheelhouse:
+            options += ['--find-links', os.path.abspath(self.wheelhouse)]
+        if self.offline:
+            options.append('--no-index')
+        return options
+
+    @asynccontextmanager
+    async def lease(self, packages=None):
+        # Yields the manager of the environment for these packages, building it if needed
+        requirements = normalize_requirements(packages)
+        key = environment_key(requirements)
+        self.leases[key] = self.leases.get(key, 0) + 1
+        try:
+            built = False
+            async with self._lock(key):
+                marker = os.path.join(self.env_dir(key), MARKER)
+                if os.path.exists(marker):
+                    self.hits += 1
+                    os.utime(marker)
+                else:
+                    await self._build(key, requirements)
+                    built = True
+                manager = self.managers.get(key)
+                if manager is None:
+                    manager = self.managers[key] = self.create_manager(self.env_dir(key))
+            if built:
+                await self.enforce_budget()
+            yield manager
+        finally:
+            self.leases[key] -= 1
+            if not self.leases[key]:
+                del self.leases[key]
+
+    def existing(self, packages=None):
+        # The manager of an environment that is already built, without building one
+        key = environment_key(normalize_requirements(packages))
+        if key not in self.managers and os.path.exists(os.path.join(self.env_dir(key), MARKER)):
+            self.managers[key] = self.create_manager(self.env_dir(key))
+        return self.managers.get(key)
+
+    async def _build(self, key, requirements):
+        env_dir = self.env_dir(key)
+        build_dir = f"{env_dir}.build-{uuid.uuid4().hex[:8]}"
+        started = time.monotonic()
+        logging.info(f"Building environment {key} for {requirements or 'no packages'}")
+        self.building.add(build_dir)
+        os.makedirs(self.directory, exist_ok=True)
+        try:
+            result = await self.runner.run([sys.executable, '-m', 'venv', build_dir], name="venv")
+            if not result.ok:
+                raise RuntimeError(f"Failed to create virtual environment: {result.stderr or result}")
+            if requirements:
+                argv = [python_executable(build_dir), '-m', 'pip', 'install', '--disable-pip-version-check']
+                result = await self.runner.run(argv + self.pip_options() + requirements,
+                                               timeout=self.install_timeout, name="pip install")
+                if not result.ok:
+                    raise RuntimeError(f"Failed to install {' '.join(requirements)}: {result.stderr or result}")
+            if self.share_files:
+                self.shared_bytes += await asyncio.to_thread(self._share_files, build_dir)
+            with open(os.path.join(build_dir, MARKER), 'w') as f:
+                json.dump({"requirements": requirements, "created": time.time()}, f)
+            if os.path.exists(env_dir):
+                # Left behind by an interrupted build or eviction
+                await asyncio.to_thread(shutil.rmtree, env_dir, True)
+            os.replace(build_dir, env_dir)
+        except BaseException:
+            await asyncio.shield(asyncio.to_thread(shutil.rmtree, build_dir, True))
+            raise
+        finally:
+            self.building.discard(build_dir)
+        self.builds += 1
+        logging.info(f"Built environment {key} in {time.monotonic() - started:.1f}s")
+
+    def _share_files(self, env_dir):
+        # Replaces every installed file with a hard link into the object store.
+        # Returns the bytes saved by files another environment already had.
+        saved = 0
+        objects = os.path.join(self.directory, OBJECTS)
+        for root, _, files in os.walk(env_dir):
+            if 'site-packages' not in root:
+                continue
+            for name in files:
+                path = os.path.join(root, name)
+                if os.path.islink(path) or not os.path.isfile(path):
+                    continue
+                digest = hashlib.sha256()
+                with open(path, 'rb') as f:
+                    for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                        digest.update(chunk)
+                digest = digest.hexdigest()
+                stored = os.path.join(objects, digest[:2], digest)
+                try:
+                    if os.path.exists(stored):
+                        temp_path = path + '.link'
+                        os.link(stored, temp_path)
+                        os.replace(temp_path, path)
+                        saved += os.path.getsize(stored)
+                    else:
+                        os.makedirs(os.path.dirname(stored), exist_ok=True)
+                        os.link(path, stored)
+                except OSError as e:
+                    # e.g. a file system without hard links; the copies still work
+                    logging.warning(f"Not sharing environment files: {str(e)}")
+                    return saved
+        return saved
+
+    def disk_usage(self):
+        # Hard-linked files are counted once
+        seen = set()
+        total = 0
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                try:
+                    stat = os.lstat(os.path.join(root, name))
+                except OSError:
+                    continue
+                if (stat.st_dev, stat.st_ino) not in seen:
+                    seen.add((stat.st_dev, stat.st_ino))
+                    total += stat.st_size
+        return total
+
+    def _least_recently_used(self):
+        environments = []
+        for key in os.listdir(self.directory):
+            marker = os.path.join(self.env_dir(key), MARKER)
+            try:
+                environments.append((os.path.getmtime(marker), key))
+            except OSError:
+                continue
+        return [key for _, key in sorted(environments)]
+
+    def _collect_objects(self):
+        # Objects that no environment links to any more
+        for root, _, files in os.walk(os.path.join(self.directory, OBJECTS)):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    if os.stat(path).st_nlink == 1:
+                        os.remove(path)
+                except OSError:
+                    pass
+
+    def _remove_scratch(self):
+        # Builds and evictions interrupted by a crash
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if ('.build-' in name or '.evicted-' in name) and path not in self.building:
+                shutil.rmtree(path, True)
+
+    async def enforce_budget(self):
+        await asyncio.to_thread(self._remove_scratch)
+        usage = await asyncio.to_thread(self.disk_usage)
+        if usage <= self.max_bytes:
+            return
+        for key in await asyncio.to_thread(self._least_recently_used):
+            if usage <= self.max_bytes:
+                break
+            if self.leases.get(key):
+                continue
+            async with self._lock(key):
+                if self.leases.get(key):
+                    continue
+                trash = self._retire(key)
+            if trash is None:
+                continue
+            await asyncio.to_thread(shutil.rmtree, trash, True)
+            await asyncio.to_thread(self._collect_objects)
+            usage = await asyncio.to_thread(self.disk_usage)
+            self.evictions += 1
+            logging.info(f"Evicted environment {key}, cache now uses {usage} bytes")
+
+    def _retire(self, key):
+        # Moves the environment out of the way so a new lease can rebuild it straight away
+        manager = self.managers.pop(key, None)
+        if manager is not None:
+            manager.close()
+        trash = f"{self.env_dir(key)}.evicted-{uuid.uuid4().hex[:8]}"
+        try:
+            os.replace(self.env_dir(key), trash)
+        except OSError as e:
+            logging.error(f"Failed to evict environment {key}: {str(e)}")
+            logging.debug(traceback.format_exc())
+            return None
+        return trash
+
+    def close(self):
+        for manager in self.managers.values():
+            manager.close()
+        self.managers = {}
@@ -0,0 +1,181 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import traceback
+import uuid
+
+# Cache of scraped pages, so re-scraping a site only costs what changed.
+#
+# For every URL the index keeps the validators the server sent (ETag,
+# Last-Modified), a hash of the body, whether the page had to be rendered, and
+# when it was fetched and last confirmed. Within ttl a page is served without
+# any request; after that it is revalidated with a conditional GET, so an
+# unchanged page costs a 304. The parsed form of a page (links, title, text) is
+# stored once per content hash, so an unchanged body, or one another URL already
+# had, is never parsed again. The index is an append-only JSON-lines log that is
+# rewritten as a snapshot once it has grown well past its live entries.
+#
+# The cache holds at most max_entries URLs, none older than max_age: the least
+# recently fetched or confirmed are dropped first, and compaction deletes the
+# parsed pages no remaining URL refers to. Everything here does file I/O, so
+# async callers run it in a thread; a lock keeps those threads apart.
+
+INDEX = 'index.jsonl'
+PAGES = 'pages'
+
+
+def content_hash(text):
+    return hashlib.sha256(text.encode('utf-8', errors='replace')).hexdigest()
+
+
+class FetchCache:
+    def __init__(self, directory='cache/fetch', ttl=3600, compact_slack=256, max_entries=10000,
+                 max_age=30 * 24 * 3600):
+        self.directory = directory
+        self.ttl = ttl
+        self.compact_slack = compact_slack
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.lock = threading.RLock()
+        # Oldest first, by when the entry was last written
+        self.entries = None
+        self.records = 0
+        # Pages stored whose index entry hasn't been written yet
+        self.pending = set()
+        self.evicted = 0
+        self.hits = 0
+        self.revalidated = 0
+        self.changed = 0
+        self.misses = 0
+
+    def stats(self):
+        return {
+            "entries": len(self.entries or {}),
+            "evicted": self.evicted,
+            "hits": self.hits,
+            "revalidated": self.revalidated,
+            "changed": self.changed,
+            "misses": self.misses
+        }
+
+    def _index_path(self):
+        return os.path.join(self.directory, INDEX)
+
+    def _page_path(self, key):
+        return os.path.join(self.directory, PAGES, key[:2], f"{key}.json")
+
+    def _load(self):
+        # Read on first use; the last record for a URL wins and a torn last line is skipped
+        if self.entries is not None:
+            return
+        self.entries = {}
+        os.makedirs(os.path.join(self.directory, PAGES), exist_ok=True)
+        try:
+            with open(self._index_path(), encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.entries.pop(record["url"], None)
+                    self.entries[record["url"]] = record
+                    self.records += 1
+        except FileNotFoundError:
+            pass
+        self._evict()
+
+    def _evict(self):
+        # Dropped entries stay in the log until the next compaction
+        cutoff = time.time() - self.max_age
+        while self.entries:
+            url, entry = next(iter(self.entries.items()))
+            if len(self.entries) <= self.max_entries and entry.get("checked", 0) >= cutoff:
+                break
+            del self.entries[url]
+            self.evicted += 1
+
+    def lookup(self, url):
+        with self.lock:
+            self._load()
+            return self.entries.get(url)
+
+    def is_fresh(self, entry):
+        return time.time() - entry["checked"] < self.ttl
+
+    def validators(self, entry):
+        headers = {}
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def load_page(self, key):
+        try:
+            with open(self._page_path(key), encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def store_page(self, key, snapshot):
+        path = self._page_path(key)
+        with self.lock:
+            self.pending.add(key)
+        if os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(snapshot, f)
+        os.replace(temp_path, path)
+
+    def update(self, url, **fields):
+        with self.lock:
+            self._load()
+            entry = dict(self.entries.pop(url, {"url": url}), **fields)
+            self.entries[url] = entry
+            self.pending.discard(entry.get("page"))
+            self._evict()
+            try:
+                with open(self._index_path(), 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(entry) + "\n")
+                self.records += 1
+                if self.records > len(self.entries) + self.compact_slack:
+                    self.compact()
+            except OSError as e:
+                logging.error(f"Failed to update the fetch cache index: {str(e)}")
+                logging.debug(traceback.format_exc())
+            return entry
+
+    def compact(self):
+        with self.lock:
+            self._load()
+            self._evict()
+            temp_path = f"{self._index_path()}.{uuid.uuid4().hex[:8]}.tmp"
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                for entry in self.entries.values():
+                    f.write(json.dumps(entry) + "\n")
+            os.replace(temp_path, self._index_path())
+            self.records = len(self.entries)
+            self._remove_pages({entry.get("page") for entry in self.entries.values()} | self.pending)
+
+    def _remove_pages(self, live):
+        # Parsed pages no entry refers to any more
+        removed = 0
+        pages = os.path.join(self.directory, PAGES)
+        for prefix in os.listdir(pages):
+            directory = os.path.join(pages, prefix)
+            if not os.path.isdir(directory):
+                continue
+            for name in os.listdir(directory):
+                if name.endswith('.json') and name[:-len('.json')] not in live:
+                    try:
+                        os.remove(os.path.join(directory, name))
+                        removed += 1
+                    except OSError:
+                        pass
+        if removed:
+            logging.info(f"Removed {removed} unused pages from the fetch cache")
@@ -0,0 +1,405 @@
+import asyncio
+import json
+import logging
+import os
+import signal
+import struct
+import subprocess
+import threading
+import time
+import traceback
+from collections import deque
+
+from job_runner import JobResult
+
+# Pool of warm interpreters for one virtual environment.
+#
+# Short snippets spend most of their time starting Python, so each pool keeps
+# up to size interpreter_worker.py processes running with common modules
+# already imported. Code goes to a worker over its pipes and runs there in a
+# fresh namespace. A worker is replaced after max_runs runs, once its memory
+# passes max_memory_bytes, or when it is killed for running past its timeout;
+# the replacement is started in the background so the next run finds it warm.
+# run() blocks, so synchronous callers can use the pool directly; run_async()
+# is for the event loop and kills the worker if the awaiting task is cancelled.
+# It waits for one of size slots on the loop before handing the run to a thread,
+# so runs queued behind a full pool don't tie up the default executor.
+#
+# Workers send output while the code runs. run_async() can forward it to the
+# client as it arrives, up to stream_bytes/stream_lines per run, and the result
+# only keeps a tail of each stream (tail_lines/tail_bytes) for the model.
+
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'interpreter_worker.py')
+LENGTH = struct.Struct(">I")
+DEFAULT_PRELOAD = ("json", "math", "re", "random", "datetime", "collections", "itertools", "functools")
+
+
+class OutputTail:
+    # Ring buffer holding the last lines of a stream, within a line and a byte limit
+
+    def __init__(self, max_lines=200, max_bytes=16 * 1024):
+        self.max_lines = max_lines
+        self.max_bytes = max_bytes
+        self.lines = deque()
+        self.size = 0
+        self.partial = ""
+        self.dropped = 0
+
+    def write(self, text):
+        parts = (self.partial + text).split("\n")
+        self.partial = parts.pop()
+        for line in parts:
+            self._add(line + "\n")
+        if len(self.partial) > self.max_bytes:
+            self.partial = self.partial[-self.max_bytes:]
+
+    def _add(self, line):
+        self.lines.append(line)
+        self.size += len(line.encode('utf-8'))
+        while len(self.lines) > self.max_lines or (self.size > self.max_bytes and len(self.lines) > 1):
+            self.size -= len(self.lines.popleft().encode('utf-8'))
+            self.dropped += 1
+
+    def text(self):
+        body = "".join(self.lines) + self.partial
+        if self.dropped:
+            return f"[{self.dropped} earlier lines omitted]\n{body}"
+        return body
+
+
+class Interpreter:
+    def __init__(self, python_executable, preload=(), generation=0):
+        options = {"creationflags": subprocess.CREATE_NEW_PROCESS_GROUP} if os.name == 'nt' else {"start_new_session": True}
+        self.process = subprocess.Popen(
+            [python_executable, '-I', WORKER_SCRIPT] + list(preload),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            **options
+        )
+        self.generation = generation
+        self.runs = 0
+        self.memory = 0
+        try:
+            ready = self._receive()
+        except Exception:
+            self.kill()
+            raise
+        self.memory = ready.get("memory", 0)
+
+    @property
+    def pid(self):
+        return self.process.pid
+
+    def _send(self, message):
+        data = json.dumps(message).encode('utf-8')
+        self.process.stdin.write(LENGTH.pack(len(data)) + data)
+        self.process.stdin.flush()
+
+    def _receive(self):
+        header = self.process.stdout.read(LENGTH.size)
+        if len(header) < LENGTH.size:
+            raise EOFError(f"Interpreter {self.pid} exited")
+        return json.loads(self.process.stdout.read(LENGTH.unpack(header)[0]).decode('utf-8'))
+
+    def run(self, code, max_output_bytes, on_output=None):
+        # on_output(stream, text) is called for each piece of output as it arrives
+        self._send({"code": code, "max_output_bytes": max_output_bytes})
+        while True:
+            reply = self._receive()
+            if "output" not in reply:
+                break
+            if on_output:
+                on_output(reply["output"], reply["text"])
+        self.runs += 1
+        self.memory = reply.get("memory", 0)
+        return reply
+
+    def kill(self):
+        # Takes down anything the code started as well
+        try:
+            if os.name == 'nt':
+                subprocess.run(['taskkill', '/F', '/T', '/PID', str(self.pid)],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            else:
+                os.killpg(self.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        try:
+            self.process.kill()
+        except OSError:
+            pass
+        self.process.wait()
+        for stream in (self.process.stdin, self.process.stdout):
+            try:
+                stream.close()
+            except OSError:
+                pass
+
+
+class PoolRun:
+    # One run's worker, so a timeout or a cancelled caller can kill it
+    def __init__(self):
+        self.interpreter = None
+        self.timed_out = False
+        self.cancelled = False
+        self.lock = threading.Lock()
+
+    def stop(self, timed_out=False):
+        with self.lock:
+            if timed_out:
+                self.timed_out = True
+            else:
+                self.cancelled = True
+            if self.interpreter is not None:
+                self.interpreter.kill()
+
+
+class InterpreterPool:
+    def __init__(self, python_executable, size=2, max_runs=50, max_memory_bytes=256 * 1024 * 1024,
+                 timeout=120, max_output_bytes=64 * 1024 * 1024, tail_lines=200, tail_bytes=16 * 1024,
+                 stream_bytes=256 * 1024, stream_lines=5000, preload=DEFAULT_PRELOAD):
+        self.python_executable = python_executable
+        self.size = size
+        self.max_runs = max_runs
+        self.max_memory_bytes = max_memory_bytes
+        self.timeout = timeout
+        self.max_output_bytes = max_output_bytes
+        self.tail_lines = tail_lines
+        self.tail_bytes = tail_bytes
+        self.stream_bytes = stream_bytes
+        self.stream_lines = stream_lines
+        self.preload = preload
+        self.idle = []
+        self.busy = 0
+        self.spawning = 0
+        self.waiting = 0
+        self.queued = 0
+        self.slots = None
+        self.generation = 0
+        self.closed = False
+        self.runs = 0
+        self.started = 0
+        self.recycled = 0
+        self.timed_out = 0
+        self.condition = threading.Condition()
+
+    @property
+    def warm(self):
+        return len(self.idle)
+
+    @property
+    def queue_depth(self):
+        # Runs waiting for a worker, on the event loop or in a thread
+        return self.queued + self.waiting
+
+    def start(self):
+        # Fills the pool in the background
+        with self.condition:
+            missing = self.size - self.busy - self.spawning - len(self.idle)
+        for _ in range(missing):
+            self._replenish()
+
+    def restart(self):
+        # After packages change, every worker is replaced before its next run
+        with self.condition:
+            self.generation += 1
+            stale, self.idle = self.idle, []
+        for interpreter in stale:
+            interpreter.kill()
+        self.start()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            stale, self.idle = self.idle, []
+            self.condition.notify_all()
+        for interpreter in stale:
+            interpreter.kill()
+
+    def _spawn(self):
+        interpreter = Interpreter(self.python_executable, self.preload, self.generation)
+        self.started += 1
+        logging.debug(f"Started interpreter {interpreter.pid} for {self.python_executable}")
+        return interpreter
+
+    def _replenish(self):
+        with self.condition:
+            if self.closed or self.busy + self.spawning + len(self.idle) >= self.size:
+                return
+            self.spawning += 1
+        threading.Thread(target=self._spawn_warm, name="interpreter-spawn", daemon=True).start()
+
+    def _spawn_warm(self):
+        interpreter = None
+        try:
+            interpreter = self._spawn()
+        except Exception as e:
+            logging.error(f"Failed to start interpreter for {self.python_executable}: {str(e)}")
+            logging.debug(traceback.format_exc())
+        with self.condition:
+            self.spawning -= 1
+            if interpreter is not None and not self.closed and interpreter.generation == self.generation:
+                self.idle.append(interpreter)
+                self.condition.notify()
+                return
+        if interpreter is not None:
+            # Started before a restart; start a current one instead
+            interpreter.kill()
+            self._replenish()
+
+    def _acquire(self, run):
+        with self.condition:
+            self.waiting += 1
+            try:
+                while True:
+                    if self.closed:
+                        raise RuntimeError("Interpreter pool is closed")
+                    if run.cancelled:
+                        raise RuntimeError("Run cancelled")
+                    if self.idle:
+                        self.busy += 1
+                        return self.idle.pop()
+                    if self.busy + self.spawning < self.size:
+                        # Nothing warm: start one for this run
+                        self.spawning += 1
+                        break
+                    self.condition.wait()
+            finally:
+                self.waiting -= 1
+        try:
+            interpreter = self._spawn()
+        except Exception:
+            with self.condition:
+                self.spawning -= 1
+                self.condition.notify()
+            raise
+        with self.condition:
+            self.spawning -= 1
+            self.busy += 1
+        return interpreter
+
+    def _release(self, interpreter, reusable):
+        with self.condition:
+            self.busy -= 1
+            recycle = (not reusable or self.closed or interpreter.generation != self.generation
+                       or interpreter.runs >= self.max_runs or interpreter.memory > self.max_memory_bytes)
+            if not recycle:
+                self.idle.append(interpreter)
+                self.condition.notify()
+                return
+            self.condition.notify()
+        if reusable:
+            self.recycled += 1
+            logging.info(f"Recycling interpreter {interpreter.pid} after {interpreter.runs} runs ({interpreter.memory} bytes)")
+        interpreter.kill()
+        self._replenish()
+
+    def run(self, code, timeout=None, run=None, on_output=None):
+        timeout = self.timeout if timeout is None else timeout
+        run = run or PoolRun()
+        tails = {"stdout": OutputTail(self.tail_lines, self.tail_bytes), "stderr": OutputTail(self.tail_lines, self.tail_bytes)}
+
+        def collect(stream, text):
+            tails[stream].write(text)
+            if on_output:
+                on_output(stream, text)
+
+        started = time.monotonic()
+        interpreter = self._acquire(run)
+        with run.lock:
+            run.interpreter = interpreter
+            if run.cancelled:
+                interpreter.kill()
+        timer = threading.Timer(timeout, run.stop, kwargs={"timed_out": True})
+        timer.daemon = True
+        timer.start()
+        reply = None
+        try:
+            reply = interpreter.run(code, self.max_output_bytes, collect)
+        except (EOFError, OSError, ValueError) as e:
+            if not (run.timed_out or run.cancelled):
+                logging.error(f"Interpreter {interpreter.pid} failed: {str(e)}")
+        finally:
+            timer.cancel()
+            self._release(interpreter, reusable=reply is not None and not run.timed_out)
+        self.runs += 1
+        duration = time.monotonic() - started
+        stdout, stderr = tails["stdout"].text(), tails["stderr"].text()
+        truncated = bool(tails["stdout"].dropped or tails["stderr"].dropped)
+        if reply is None or run.timed_out:
+            # Whatever the code printed before it was stopped is still worth seeing
+            if run.timed_out:
+                self.timed_out += 1
+                return JobResult(None, stdout, stderr, duration, timed_out=True, truncated=truncated)
+            stderr += ("\n" if stderr and not stderr.endswith("\n") else "") + "The interpreter exited unexpectedly"
+            return JobResult(None, stdout, stderr, duration, truncated=truncated)
+        return JobResult(0 if reply["ok"] else 1, stdout, stderr, duration, truncated=truncated or reply["truncated"])
+
+    async def run_async(self, code, timeout=None, on_output=None):
+        # on_output(stream, text) is a coroutine function that gets the output while the code runs
+        run = PoolRun()
+        forward = None
+        consumer = None
+        if on_output:
+            loop = asyncio.get_running_loop()
+            output = asyncio.Queue()
+
+            def forward(stream, text):
+                loop.call_soon_threadsafe(output.put_nowait, (stream, text))
+            consumer = asyncio.create_task(self._stream_output(output, on_output))
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.size)
+        try:
+            self.queued += 1
+            try:
+                await self.slots.acquire()
+            finally:
+                self.queued -= 1
+            # The slot is held until the thread is done, even if this task is cancelled
+            thread = asyncio.ensure_future(asyncio.to_thread(self.run, code, timeout, run, forward))
+            thread.add_done_callback(self._free_slot)
+            return await asyncio.shield(thread)
+        except asyncio.CancelledError:
+            # The thread can't be interrupted, but killing its worker ends the run
+            run.stop()
+            with self.condition:
+                self.condition.notify_all()
+            if consumer:
+                consumer.cancel()
+                consumer = None
+            raise
+        finally:
+            if consumer:
+                # Everything the run sent is already queued ahead of this
+                output.put_nowait(None)
+                await consumer
+
+    def _free_slot(self, thread):
+        self.slots.release()
+        if not thread.cancelled():
+            # Retrieved here in case the caller was cancelled and never looks
+            thread.exception()
+
+    async def _stream_output(self, output, on_output):
+        sent_bytes = 0
+        sent_lines = 0
+        stopped = False
+        while True:
+            item = await output.get()
+            if item is None:
+                return
+            if stopped:
+                continue
+            stream, text = item
+            size = len(text.encode('utf-8'))
+            if sent_bytes + size > self.stream_bytes or sent_lines + text.count("\n") > self.stream_lines:
+                stopped = True
+                text = "\n[Output stream limit reached; the end of the output comes with the result]\n"
+                stream = "stderr"
+            sent_bytes += size
+            sent_lines += text.count("\n")
+            try:
+                await on_output(stream, text)
+            except (ConnectionError, OSError) as e:
+                logging.info(f"Stopped streaming output: {str(e)}")
+                stopped = True
@@ -0,0 +1,248 @@
+import codecs
+import contextlib
+import importlib
+import io
+import json
+import os
+import struct
+import sys
+import threading
+import traceback
+
+# Long-lived interpreter started by interpreter_pool.InterpreterPool inside a
+# virtual environment. Requests and replies are length-prefixed JSON on the
+# process's original stdin and stdout. Each piece of code runs in a fresh
+# namespace with an empty stdin. Its stdout and stderr are sent back as
+# {"output": stream, "text": ...} messages while it runs, a line (or a chunk of
+# a long line) at a time, up to max_output_bytes per run; the final reply only
+# carries the outcome. Output written straight to file descriptors 1 and 2 (by
+# os.system, subprocesses or C extensions) is read from pipes and sent the same
+# way. Only the standard library may be used here.
+
+LENGTH = struct.Struct(">I")
+CHUNK_CHARS = 4096
+# Threads started by the code may still be printing when the reply goes out
+send_lock = threading.Lock()
+
+
+class StreamedOutput(io.TextIOBase):
+    def __init__(self, name, channel):
+        self.name = name
+        self.channel = channel
+        self.pending = []
+        self.pending_chars = 0
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        if not isinstance(text, str):
+            raise TypeError(f"write() argument must be str, not {type(text).__name__}")
+        self.pending.append(text)
+        self.pending_chars += len(text)
+        if "\n" in text or self.pending_chars >= CHUNK_CHARS:
+            self.flush()
+        return len(text)
+
+    def flush(self):
+        if self.pending:
+            text, self.pending, self.pending_chars = "".join(self.pending), [], 0
+            self.channel.send_output(self.name, text)
+
+
+class OutputChannel:
+    # Sends a run's output, dropping whatever goes past the byte limit
+    def __init__(self, replies, limit):
+        self.replies = replies
+        self.limit = limit
+        self.sent = 0
+        self.truncated = False
+        self.lock = threading.Lock()
+
+    def send_output(self, name, text):
+        data = text.encode('utf-8')
+        with self.lock:
+            room = self.limit - self.sent
+            if len(data) > room:
+                self.truncated = True
+                data = data[:max(room, 0)]
+                if not data:
+                    return
+            self.sent += len(data)
+        send_message(self.replies, {"output": name, "text": data.decode('utf-8', errors='ignore')})
+
+
+class DescriptorCapture:
+    # Points a file descriptor at a pipe and forwards what comes out of it to the
+    # running code's channel, or to `fallback` between runs
+    def __init__(self, fd, name, fallback):
+        self.fd = fd
+        self.name = name
+        self.fallback = fallback
+        self.channel = None
+        self.marker = None
+        self.synced = threading.Event()
+        self.decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self.read_fd, write_fd = os.pipe()
+        os.dup2(write_fd, fd)
+        os.close(write_fd)
+        threading.Thread(target=self._pump, name=f"capture-{name}", daemon=True).start()
+
+    def _forward(self, data):
+        if not data:
+            return
+        channel = self.channel
+        if channel is None:
+            os.write(self.fallback, data)
+            return
+        text = self.decoder.decode(data)
+        if text:
+            channel.send_output(self.name, text)
+
+    def _pump(self):
+        pending = b""
+        while True:
+            data = os.read(self.read_fd, 65536)
+            if not data:
+                return
+            pending += data
+            marker = self.marker
+            if marker is not None:
+                before, found, pending = pending.partition(marker)
+                if not found:
+                    # Hold back what could be the start of the marker
+                    keep = len(marker) - 1
+                    self._forward(before[:-keep])
+                    pending = before[-keep:]
+                    continue
+                self._forward(before)
+                self.marker = None
+                self.synced.set()
+            self._forward(pending)
+            pending = b""
+
+    def sync(self, timeout=5):
+        # Returns once everything written to the descriptor so far has been forwarded
+        self.synced.clear()
+        self.marker = b"\0dantalion-sync-" + os.urandom(8).hex().encode() + b"\0"
+        os.write(self.fd, self.marker)
+        self.synced.wait(timeout)
+
+
+def flush_c_streams():
+    # C stdio buffers output to pipes; fflush(NULL) pushes out what the code left there
+    try:
+        import ctypes
+        ctypes.CDLL(None).fflush(None)
+    except Exception:
+        pass
+
+
+def memory_usage():
+    # Resident set size in bytes, or 0 when it can't be measured
+    try:
+        if os.path.exists('/proc/self/statm'):
+            with open('/proc/self/statm') as f:
+                return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        if os.name == 'nt':
+            import ctypes
+            from ctypes import wintypes
+
+            class ProcessMemoryCounters(ctypes.Structure):
+                _fields_ = [("cb", wintypes.DWORD), ("PageFaultCount", wintypes.DWORD),
+                            ("PeakWorkingSetSize", ctypes.c_size_t), ("WorkingSetSize", ctypes.c_size_t),
+                            ("QuotaPeakPagedPoolUsage", ctypes.c_size_t), ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                            ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t), ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                            ("PagefileUsage", ctypes.c_size_t), ("PeakPagefileUsage", ctypes.c_size_t)]
+
+            counters = ProcessMemoryCounters()
+            counters.cb = ctypes.sizeof(counters)
+            process = ctypes.windll.kernel32.GetCurrentProcess()
+            if ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+                return counters.WorkingSetSize
+            return 0
+        import resource
+        # Peak rather than current, in kilobytes on Linux and bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+    except Exception:
+        return 0
+
+
+def read_message(stream):
+    header = stream.read(LENGTH.size)
+    if len(header) < LENGTH.size:
+        return None
+    return json.loads(stream.read(LENGTH.unpack(header)[0]).decode('utf-8'))
+
+
+def send_message(stream, message):
+    data = json.dumps(message).encode('utf-8')
+    with send_lock:
+        stream.write(LENGTH.pack(len(data)) + data)
+        stream.flush()
+
+
+def run(code, replies, max_output_bytes, captures):
+    channel = OutputChannel(replies, max_output_bytes)
+    stdout = StreamedOutput("stdout", channel)
+    stderr = StreamedOutput("stderr", channel)
+    for capture in captures:
+        capture.channel = channel
+    namespace = {"__name__": "__main__", "__builtins__": __builtins__}
+    ok = True
+    importlib.invalidate_caches()
+    with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+        try:
+            exec(compile(code, "<code>", "exec"), namespace)
+        except SystemExit as e:
+            ok = e.code in (None, 0)
+        except BaseException as e:
+            # Leave this module's frame out of the traceback
+            traceback.print_exception(type(e), e, e.__traceback__.tb_next)
+            ok = False
+        finally:
+            stdout.flush()
+            stderr.flush()
+            flush_c_streams()
+            for capture in captures:
+                capture.sync()
+                capture.channel = None
+    return {"ok": ok, "truncated": channel.truncated}
+
+
+def main():
+    for module in sys.argv[1:]:
+        try:
+            importlib.import_module(module)
+        except ImportError:
+            pass
+
+    # Keep the pipes for the protocol; the code gets an empty stdin, and what is
+    # written straight to file descriptors 1 and 2 is captured. Between runs it
+    # goes to the original stderr.
+    requests = os.fdopen(os.dup(0), 'rb')
+    replies = os.fdopen(os.dup(1), 'wb')
+    devnull = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(devnull, 0)
+    sys.stdin = io.StringIO()
+    original_stderr = os.dup(2)
+    captures = [DescriptorCapture(1, "stdout", original_stderr), DescriptorCapture(2, "stderr", original_stderr)]
+
+    # Like running a script from the working directory
+    home = os.getcwd()
+    sys.path.insert(0, home)
+
+    send_message(replies, {"ready": True, "memory": memory_usage()})
+    while True:
+        request = read_message(requests)
+        if request is None:
+            break
+        reply = run(request["code"], replies, request.get("max_output_bytes", 256 * 1024), captures)
+        os.chdir(home)
+        reply["memory"] = memory_usage()
+        send_message(replies, reply)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+import asyncio
+import logging
+import os
+import signal
+import subprocess
+import time
+from collections import deque
+
+# Runs external jobs (code, package installs, scrapes) as asyncio subprocesses.
+#
+# At most max_workers jobs run at once; the rest wait their turn. A job that
+# runs past its timeout is killed along with any processes it started, and only
+# the first max_output_bytes of each output stream are kept (the rest is read
+# and discarded so the job never blocks on a full pipe). Cancelling the task
+# that awaits a job, e.g. because its client disconnected, kills it too. The
+# event loop never waits on a job.
+
+OUTPUT_DRAIN_TIMEOUT = 5
+
+
+class JobResult:
+    def __init__(self, returncode, stdout, stderr, duration, timed_out=False, truncated=False):
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+        self.duration = duration
+        self.timed_out = timed_out
+        self.truncated = truncated
+
+    @property
+    def ok(self):
+        return self.returncode == 0 and not self.timed_out
+
+    def __repr__(self):
+        return f"JobResult(returncode={self.returncode}, duration={self.duration:.2f}, timed_out={self.timed_out})"
+
+
+class JobRunner:
+    def __init__(self, max_workers=2, timeout=300, max_output_bytes=256 * 1024, history=100):
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.max_output_bytes = max_output_bytes
+        self.waiting = 0
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.timed_out = 0
+        self.cancelled = 0
+        self.durations = deque(maxlen=history)
+        self._slots = None
+
+    @property
+    def queue_depth(self):
+        return self.waiting
+
+    def stats(self):
+        durations = list(self.durations)
+        return {
+            "queue_depth": self.waiting,
+            "running": self.running,
+            "completed": self.completed,
+            "failed": self.failed,
+            "timed_out": self.timed_out,
+            "cancelled": self.cancelled,
+            "mean_duration": sum(durations) / len(durations) if durations else 0.0,
+            "max_duration": max(durations, default=0.0)
+        }
+
+    async def run(self, argv, input=None, timeout=None, cwd=None, env=None, name=None):
+        name = name or os.path.basename(argv[0])
+        timeout = self.timeout if timeout is None else timeout
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_workers)
+        self.waiting += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.waiting -= 1
+        self.running += 1
+        started = time.monotonic()
+        process = None
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *argv,
+                stdin=asyncio.subprocess.PIPE if input is not None else asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                cwd=cwd,
+                env=env,
+                **self._group_options()
+            )
+            readers = [asyncio.create_task(self._read_capped(stream)) for stream in (process.stdout, process.stderr)]
+            if input is not None:
+                await self._feed(process, input)
+            timed_out = False
+            try:
+                await asyncio.wait_for(process.wait(), timeout)
+            except asyncio.TimeoutError:
+                timed_out = True
+                await self._kill(process)
+            # A grandchild can keep the pipes open after the job itself has exited
+            done, not_done = await asyncio.wait(readers, timeout=OUTPUT_DRAIN_TIMEOUT)
+            for reader in not_done:
+                reader.cancel()
+            outputs = [reader.result() if reader in done else (b"", False) for reader in readers]
+            duration = time.monotonic() - started
+            result = JobResult(
+                process.returncode,
+                outputs[0][0].decode('utf-8', errors='replace'),
+                outputs[1][0].decode('utf-8', errors='replace'),
+                duration,
+                timed_out=timed_out,
+                truncated=outputs[0][1] or outputs[1][1]
+            )
+            if timed_out:
+                self.timed_out += 1
+                logging.warning(f"Job {name} timed out after {timeout}s and was killed")
+            elif result.ok:
+                self.completed += 1
+            else:
+                self.failed += 1
+            logging.info(f"Job {name} finished in {duration:.2f}s with exit code {process.returncode} ({self.waiting} queued)")
+            return result
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            logging.info(f"Job {name} cancelled")
+            if process is not None and process.returncode is None:
+                await asyncio.shield(self._kill(process))
+            raise
+        finally:
+            self.durations.append(time.monotonic() - started)
+            self.running -= 1
+            self._slots.release()
+
+    async def _feed(self, process, input):
+        if isinstance(input, str):
+            input = input.encode('utf-8')
+        try:
+            process.stdin.write(input)
+            await process.stdin.drain()
+            process.stdin.close()
+        except (BrokenPipeError, ConnectionResetError):
+            # The job exited without reading all of its input
+            pass
+
+    async def _read_capped(self, stream):
+        kept = bytearray()
+        truncated = False
+        while True:
+            chunk = await stream.read(65536)
+            if not chunk:
+                return bytes(kept), truncated
+            room = self.max_output_bytes - len(kept)
+            if len(chunk) > room:
+                truncated = True
+            kept += chunk[:max(room, 0)]
+
+    def _group_options(self):
+        # Jobs get their own process group so everything they start can be killed with them
+        if os.name == 'nt':
+            return {"creationflags": subprocess.CREATE_NEW_PROCESS_GROUP}
+        return {"start_new_session": True}
+
+    async def _kill(self, process):
+        try:
+            if os.name == 'nt':
+                killer = await asyncio.create_subprocess_exec(
+                    'taskkill', '/F', '/T', '/PID', str(process.pid),
+                    stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL)
+                await killer.wait()
+            else:
+                os.killpg(process.pid, signal.SIGKILL)
+        except (ProcessLookupError, OSError):
+            pass
+        if process.returncode is None:
+            try:
+                process.kill()
+            except ProcessLookupError:
+                pass
+        await process.wait()
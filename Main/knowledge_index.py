@@ -0,0 +1,436 @@
+import hashlib
+import heapq
+import json
+import logging
+import math
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+import traceback
+import uuid
+from collections import Counter
+
+# BM25 search over scraped knowledge and long-term memory.
+#
+# Documents are passages of up to PASSAGE_WORDS words, cut from the files in
+# knowledge/ (a crawl's pages, a scrape's links, plain text notes) and from the
+# overall memory entries. The index is a list of immutable segment files plus an
+# in-memory buffer of recent passages. A segment holds a table of term hashes
+# sorted for binary search, each pointing at its postings (passage, term
+# frequency), then a table of passage lengths and the passage texts. Segments
+# are memory-mapped, so opening the index only reads the manifest and a query
+# only touches the postings of its own terms. The buffer becomes a new segment
+# once it holds buffer_passages passages, and segments are merged into one when
+# there are more than max_segments. The manifest records how far each source
+# has been read, so new scrapes and memory entries are indexed incrementally:
+# .jsonl crawls from the byte offset reached, other files once, memory from the
+# number of entries reached. It is only written together with the segments, so
+# after a crash whatever was still buffered is simply read again.
+
+SEGMENT_MAGIC = b"DTLBM251"
+HEADER = struct.Struct("<8sIIQQQ")     # magic, term_count, passage_count, total_length, passages_offset, text_offset
+TERM = struct.Struct("<QQI")           # term hash, postings offset, postings count
+POSTING = struct.Struct("<IH")         # passage, term frequency
+PASSAGE = struct.Struct("<IQI")        # length in terms, text offset, text length
+MANIFEST = 'manifest.json'
+PASSAGE_WORDS = 150
+INDEXED_EXTENSIONS = ('.json', '.jsonl', '.txt', '.md')
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+STOPWORDS = frozenset("""a an and are as at be but by for from has have how i if in into is it its of on or
+that the their then there these this to was were what when where which who why will with you your""".split())
+
+
+def tokenize(text):
+    return [token for token in TOKEN_PATTERN.findall(text.lower()) if len(token) > 1 and token not in STOPWORDS]
+
+
+def term_hash(term):
+    return int.from_bytes(hashlib.blake2b(term.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def passages(text, words=PASSAGE_WORDS):
+    parts = text.split()
+    for start in range(0, len(parts), words):
+        yield " ".join(parts[start:start + words])
+
+
+class SearchHit:
+    def __init__(self, score, source, text):
+        self.score = score
+        self.source = source
+        self.text = text
+
+    def __repr__(self):
+        return f"SearchHit(score={self.score:.2f}, source={self.source!r})"
+
+
+class Segment:
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.term_count, self.passage_count, self.total_length, self.passages_offset, self.text_offset = \
+            HEADER.unpack_from(self.map, 0)
+        if magic != SEGMENT_MAGIC:
+            self.close()
+            raise ValueError(f"{path} is not an index segment")
+
+    def postings(self, key):
+        # Binary search of the sorted term table
+        low, high = 0, self.term_count
+        while low < high:
+            middle = (low + high) // 2
+            found, offset, count = TERM.unpack_from(self.map, HEADER.size + middle * TERM.size)
+            if found == key:
+                return list(POSTING.iter_unpack(self.map[offset:offset + count * POSTING.size]))
+            if found < key:
+                low = middle + 1
+            else:
+                high = middle
+        return []
+
+    def terms(self):
+        for i in range(self.term_count):
+            key, offset, count = TERM.unpack_from(self.map, HEADER.size + i * TERM.size)
+            yield key, list(POSTING.iter_unpack(self.map[offset:offset + count * POSTING.size]))
+
+    def length(self, passage):
+        return PASSAGE.unpack_from(self.map, self.passages_offset + passage * PASSAGE.size)[0]
+
+    def raw_passage(self, passage):
+        _, offset, size = PASSAGE.unpack_from(self.map, self.passages_offset + passage * PASSAGE.size)
+        return self.map[self.text_offset + offset:self.text_offset + offset + size]
+
+    def passage(self, passage):
+        record = json.loads(self.raw_passage(passage).decode('utf-8'))
+        return record["source"], record["text"]
+
+    def close(self):
+        if getattr(self, 'map', None) is not None:
+            self.map.close()
+            self.map = None
+        self.file.close()
+
+
+class BufferSegment:
+    # Passages not written to a segment yet, with the same interface
+    def __init__(self):
+        self.index = {}
+        self.lengths = []
+        self.texts = []
+        self.total_length = 0
+
+    @property
+    def passage_count(self):
+        return len(self.lengths)
+
+    def add(self, source, text, terms):
+        passage = len(self.lengths)
+        for term, count in Counter(terms).items():
+            self.index.setdefault(term_hash(term), []).append((passage, min(count, 65535)))
+        self.lengths.append(len(terms))
+        self.texts.append(json.dumps({"source": source, "text": text}).encode('utf-8'))
+        self.total_length += len(terms)
+
+    def postings(self, key):
+        return self.index.get(key, [])
+
+    def terms(self):
+        return iter(self.index.items())
+
+    def length(self, passage):
+        return self.lengths[passage]
+
+    def raw_passage(self, passage):
+        return self.texts[passage]
+
+    def passage(self, passage):
+        record = json.loads(self.texts[passage].decode('utf-8'))
+        return record["source"], record["text"]
+
+
+def write_segment(path, segments):
+    # Writes the passages of segments, in order, as one segment file
+    bases, base = [], 0
+    for segment in segments:
+        bases.append(base)
+        base += segment.passage_count
+    postings = {}
+    for segment, first in zip(segments, bases):
+        for key, entries in segment.terms():
+            postings.setdefault(key, []).extend((first + passage, count) for passage, count in entries)
+    keys = sorted(postings)
+    passages_offset = HEADER.size + len(keys) * TERM.size + sum(len(postings[key]) for key in keys) * POSTING.size
+    text_offset = passages_offset + base * PASSAGE.size
+    temp_path = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+    with open(temp_path, 'wb') as f:
+        total_length = sum(segment.total_length for segment in segments)
+        f.write(HEADER.pack(SEGMENT_MAGIC, len(keys), base, total_length, passages_offset, text_offset))
+        offset = HEADER.size + len(keys) * TERM.size
+        for key in keys:
+            f.write(TERM.pack(key, offset, len(postings[key])))
+            offset += len(postings[key]) * POSTING.size
+        for key in keys:
+            f.write(b"".join(POSTING.pack(passage, count) for passage, count in postings[key]))
+        texts = [segment.raw_passage(i) for segment in segments for i in range(segment.passage_count)]
+        lengths = [segment.length(i) for segment in segments for i in range(segment.passage_count)]
+        offset = 0
+        for length, text in zip(lengths, texts):
+            f.write(PASSAGE.pack(length, offset, len(text)))
+            offset += len(text)
+        for text in texts:
+            f.write(text)
+    os.replace(temp_path, path)
+
+
+class KnowledgeIndex:
+    def __init__(self, directory='cache/index', knowledge_dir='knowledge', load_memory=None,
+                 buffer_passages=256, max_segments=8, refresh_interval=5, k1=1.2, b=0.75):
+        # load_memory() returns every overall memory entry; it is only called once
+        self.directory = directory
+        self.knowledge_dir = knowledge_dir
+        self.load_memory = load_memory
+        self.buffer_passages = buffer_passages
+        self.max_segments = max_segments
+        self.refresh_interval = refresh_interval
+        self.k1 = k1
+        self.b = b
+        self.lock = threading.RLock()
+        self.segments = None
+        self.buffer = BufferSegment()
+        self.sources = {}
+        self.memory_count = 0
+        self.memory_synced = False
+        self.committed = {"sources": {}, "memory_count": 0}
+        self.last_refresh = 0
+        self.searches = 0
+
+    def stats(self):
+        with self.lock:
+            segments = self.segments or []
+            return {
+                "segments": len(segments),
+                "passages": sum(segment.passage_count for segment in segments) + self.buffer.passage_count,
+                "buffered": self.buffer.passage_count,
+                "sources": len(self.sources),
+                "searches": self.searches
+            }
+
+    def _manifest_path(self):
+        return os.path.join(self.directory, MANIFEST)
+
+    def open(self):
+        with self.lock:
+            if self.segments is not None:
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            self.segments = []
+            try:
+                with open(self._manifest_path()) as f:
+                    manifest = json.load(f)
+            except FileNotFoundError:
+                manifest = {"segments": [], "sources": {}, "memory_count": 0}
+            for name in manifest["segments"]:
+                self.segments.append(Segment(os.path.join(self.directory, name)))
+            self.sources = dict(manifest["sources"])
+            self.memory_count = manifest["memory_count"]
+            self.committed = {"sources": dict(self.sources), "memory_count": self.memory_count}
+            self._remove_orphans(set(manifest["segments"]))
+
+    def _remove_orphans(self, live):
+        # Segments and temp files left behind by an interrupted flush or merge
+        for name in os.listdir(self.directory):
+            if name != MANIFEST and name not in live:
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass
+
+    def _write_manifest(self):
+        manifest = {
+            "segments": [os.path.basename(segment.path) for segment in self.segments],
+            "sources": self.sources,
+            "memory_count": self.memory_count
+        }
+        temp_path = f"{self._manifest_path()}.{uuid.uuid4().hex[:8]}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(temp_path, self._manifest_path())
+        self.committed = {"sources": dict(self.sources), "memory_count": self.memory_count}
+
+    def add(self, source, text):
+        with self.lock:
+            for passage in passages(text):
+                terms = tokenize(passage)
+                if terms:
+                    self.buffer.add(source, passage, terms)
+
+    def _flush_if_full(self):
+        # Only called between sources, so the manifest never records half a source
+        if self.buffer.passage_count >= self.buffer_passages:
+            self.flush()
+
+    def add_memory(self, entry):
+        # Entries written before the first refresh are picked up from load_memory instead
+        with self.lock:
+            if self.memory_synced:
+                self.add(f"memory #{self.memory_count + 1}", entry)
+                self.memory_count += 1
+                self._flush_if_full()
+
+    def flush(self):
+        with self.lock:
+            if self.segments is None:
+                return
+            if self.buffer.passage_count:
+                path = os.path.join(self.directory, f"segment-{uuid.uuid4().hex[:12]}.idx")
+                write_segment(path, [self.buffer])
+                self.segments.append(Segment(path))
+                self.buffer = BufferSegment()
+            if len(self.segments) > self.max_segments:
+                self._merge()
+            if self.sources != self.committed["sources"] or self.memory_count != self.committed["memory_count"]:
+                self._write_manifest()
+
+    def _merge(self):
+        started = time.monotonic()
+        path = os.path.join(self.directory, f"segment-{uuid.uuid4().hex[:12]}.idx")
+        write_segment(path, self.segments)
+        old, self.segments = self.segments, [Segment(path)]
+        self._write_manifest()
+        for segment in old:
+            segment.close()
+            try:
+                os.remove(segment.path)
+            except OSError:
+                pass
+        logging.info(f"Merged {len(old)} index segments in {time.monotonic() - started:.2f}s")
+
+    def refresh(self, force=False):
+        # Indexes whatever was added to knowledge/ and memory since the last refresh
+        with self.lock:
+            self.open()
+            if not force and time.monotonic() - self.last_refresh < self.refresh_interval:
+                return
+            self.last_refresh = time.monotonic()
+            self._refresh_memory()
+            self._refresh_knowledge()
+
+    def _refresh_memory(self):
+        if self.memory_synced or self.load_memory is None:
+            return
+        try:
+            entries = self.load_memory()
+        except Exception as e:
+            logging.error(f"Failed to load memory for the index: {str(e)}")
+            logging.debug(traceback.format_exc())
+            return
+        if len(entries) < self.memory_count:
+            # The memory was cut back; index its entries from here on
+            self.memory_count = len(entries)
+        for entry in entries[self.memory_count:]:
+            self.memory_count += 1
+            self.add(f"memory #{self.memory_count}", str(entry))
+        self.memory_synced = True
+        self._flush_if_full()
+
+    def _refresh_knowledge(self):
+        try:
+            entries = list(os.scandir(self.knowledge_dir))
+        except FileNotFoundError:
+            return
+        for entry in entries:
+            if not entry.is_file() or not entry.name.endswith(INDEXED_EXTENSIONS):
+                continue
+            size = None
+            try:
+                size = entry.stat().st_size
+                if entry.name.endswith('.jsonl'):
+                    self._index_lines(entry.path, size)
+                elif entry.path not in self.sources:
+                    self._index_file(entry.path)
+                    self.sources[entry.path] = size
+            except (OSError, ValueError) as e:
+                logging.error(f"Failed to index {entry.path}: {str(e)}")
+                logging.debug(traceback.format_exc())
+                # Skipped from now on, unless the file couldn't even be stat'ed
+                if size is not None:
+                    self.sources[entry.path] = size
+            self._flush_if_full()
+
+    def _index_lines(self, path, size):
+        # A crawl appends one page per line; only complete lines are read
+        offset = self.sources.get(path, 0)
+        if size <= offset:
+            return
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            data = f.read(size - offset)
+        end = data.rfind(b"\n") + 1
+        for line in data[:end].splitlines():
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            source = record.get("url", path)
+            title = record.get("title") or ""
+            self.add(source, f"{title} {record.get('text', '')}".strip())
+        self.sources[path] = offset + end
+
+    def _index_file(self, path):
+        name = os.path.basename(path)
+        with open(path, encoding='utf-8', errors='replace') as f:
+            if name.endswith('.json'):
+                data = json.load(f)
+                # A scrape's links; their words are all there is to search
+                text = " ".join(data) if isinstance(data, list) and all(isinstance(item, str) for item in data) \
+                    else json.dumps(data)
+            else:
+                text = f.read()
+        self.add(path, f"{os.path.splitext(name)[0]} {text}")
+
+    def search(self, query, k=5):
+        with self.lock:
+            self.refresh()
+            self.searches += 1
+            segments = self.segments + [self.buffer]
+            passage_count = sum(segment.passage_count for segment in segments)
+            if not passage_count:
+                return []
+            average_length = sum(segment.total_length for segment in segments) / passage_count
+            keys = {term_hash(term) for term in tokenize(query)}
+            postings = {key: [(segment, segment.postings(key)) for segment in segments] for key in keys}
+            scores = {}
+            for key, found in postings.items():
+                frequency = sum(len(entries) for _, entries in found)
+                if not frequency:
+                    continue
+                idf = math.log(1 + (passage_count - frequency + 0.5) / (frequency + 0.5))
+                for segment, entries in found:
+                    for passage, count in entries:
+                        length = segment.length(passage)
+                        score = idf * count * (self.k1 + 1) / (count + self.k1 * (1 - self.b + self.b * length / average_length))
+                        scores[(segment, passage)] = scores.get((segment, passage), 0) + score
+            hits = []
+            seen = set()
+            for (segment, passage), score in heapq.nlargest(k * 2, scores.items(), key=lambda item: item[1]):
+                source, text = segment.passage(passage)
+                if text in seen:
+                    continue
+                seen.add(text)
+                hits.append(SearchHit(score, source, text))
+            return hits[:k]
+
+    def close(self):
+        with self.lock:
+            try:
+                self.flush()
+            except OSError as e:
+                logging.error(f"Failed to save the knowledge index: {str(e)}")
+                logging.debug(traceback.format_exc())
+            for segment in self.segments or []:
+                segment.close()
+            self.segments = None
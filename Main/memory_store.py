@@ -0,0 +1,279 @@
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import traceback
+from bisect import bisect_right
+from datetime import datetime
+
+# Pure-Python replacement for the LocalGPT_FileAccess MemoryManager.
+#
+# Every memory stream is a SegmentedLog: a chain of memory-mapped segment files.
+# A segment starts with a header and a fixed-size index (offset, length and time
+# of each record), followed by the record data. Appending writes the data, then
+# its index entry, then bumps the record count in the header, so a crash leaves
+# at most an invisible half-written record behind. Segments grow by remapping
+# until they reach max_segment_bytes or fill their index, then a new one starts.
+# A small manifest holds the first and last segment numbers, so the tail is
+# found without listing the directory. A background thread compacts sealed
+# segments: it shrinks them to their used size and deletes the ones whose
+# records have all fallen out of the log's retention.
+
+SEGMENT_MAGIC = b"DTLSEG01"
+MANIFEST_MAGIC = b"DTLMAN01"
+HEADER = struct.Struct("<8sQQQQ")       # magic, first_record, count, data_end, index_capacity
+INDEX_ENTRY = struct.Struct("<QId")     # offset, length, timestamp
+MANIFEST = struct.Struct("<8sQQ")       # magic, first_segment, last_segment
+
+
+class Segment:
+    def __init__(self, path, first_record=0, index_capacity=4096, initial_size=64 * 1024, create=False):
+        self.path = path
+        if create:
+            data_start = HEADER.size + index_capacity * INDEX_ENTRY.size
+            with open(path, 'wb') as f:
+                f.truncate(max(initial_size, data_start))
+                f.write(HEADER.pack(SEGMENT_MAGIC, first_record, 0, data_start, index_capacity))
+        self.file = open(path, 'r+b')
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        magic, self.first_record, self.count, self.data_end, self.index_capacity = HEADER.unpack_from(self.map, 0)
+        if magic != SEGMENT_MAGIC:
+            self.close()
+            raise ValueError(f"{path} is not a memory segment")
+        self.data_start = HEADER.size + self.index_capacity * INDEX_ENTRY.size
+
+    @property
+    def size(self):
+        return len(self.map)
+
+    @property
+    def last_record(self):
+        return self.first_record + self.count
+
+    def _remap(self, new_size):
+        self.map.flush()
+        self.map.close()
+        self.file.truncate(new_size)
+        self.map = mmap.mmap(self.file.fileno(), 0)
+
+    def append(self, data, timestamp, max_size):
+        # Returns False when the segment is full and a new one should be started
+        if self.count >= self.index_capacity:
+            return False
+        needed = self.data_end + len(data)
+        if needed > self.size:
+            if needed > max_size and self.count:
+                return False
+            self._remap(max(needed, min(self.size * 2, max_size)))
+        self.map[self.data_end:needed] = data
+        INDEX_ENTRY.pack_into(self.map, HEADER.size + self.count * INDEX_ENTRY.size, self.data_end, len(data), timestamp)
+        self.count += 1
+        self.data_end = needed
+        # The header update is what makes the record visible
+        HEADER.pack_into(self.map, 0, SEGMENT_MAGIC, self.first_record, self.count, self.data_end, self.index_capacity)
+        return True
+
+    def entry(self, i):
+        return INDEX_ENTRY.unpack_from(self.map, HEADER.size + i * INDEX_ENTRY.size)
+
+    def read(self, i):
+        offset, length, timestamp = self.entry(i)
+        return bytes(self.map[offset:offset + length]), timestamp
+
+    def shrink(self):
+        if self.size > self.data_end:
+            self._remap(self.data_end)
+
+    def flush(self):
+        self.map.flush()
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+class SegmentedLog:
+    def __init__(self, directory, name, max_segment_bytes=4 * 1024 * 1024, index_capacity=4096,
+                 initial_segment_bytes=64 * 1024, keep_last=None):
+        self.directory = directory
+        self.name = name
+        self.max_segment_bytes = max_segment_bytes
+        self.index_capacity = index_capacity
+        self.initial_segment_bytes = initial_segment_bytes
+        self.keep_last = keep_last
+        self.lock = threading.RLock()
+        self.segments = []
+        self.compacted = set()
+        os.makedirs(directory, exist_ok=True)
+        self.manifest_path = os.path.join(directory, f"{name}.manifest")
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, 'rb') as f:
+                magic, first_segment, last_segment = MANIFEST.unpack(f.read(MANIFEST.size))
+            if magic != MANIFEST_MAGIC:
+                raise ValueError(f"{self.manifest_path} is not a memory manifest")
+            for number in range(first_segment, last_segment + 1):
+                self.segments.append((number, Segment(self._segment_path(number))))
+        else:
+            self._add_segment(0, 0)
+
+    def _segment_path(self, number):
+        return os.path.join(self.directory, f"{self.name}_{number:08d}.seg")
+
+    def _write_manifest(self):
+        temp_path = self.manifest_path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(MANIFEST.pack(MANIFEST_MAGIC, self.segments[0][0], self.segments[-1][0]))
+        os.replace(temp_path, self.manifest_path)
+
+    def _add_segment(self, number, first_record):
+        segment = Segment(self._segment_path(number), first_record, self.index_capacity,
+                          self.initial_segment_bytes, create=True)
+        self.segments.append((number, segment))
+        self._write_manifest()
+        return segment
+
+    @property
+    def first_record(self):
+        return self.segments[0][1].first_record
+
+    def __len__(self):
+        return self.segments[-1][1].last_record
+
+    def append(self, data, timestamp=None):
+        # Returns the record number; numbers keep counting across segments
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        timestamp = time.time() if timestamp is None else timestamp
+        with self.lock:
+            number, tail = self.segments[-1]
+            if not tail.append(data, timestamp, self.max_segment_bytes):
+                tail.flush()
+                tail = self._add_segment(number + 1, tail.last_record)
+                tail.append(data, timestamp, max(self.max_segment_bytes, tail.data_start + len(data)))
+            return tail.last_record - 1
+
+    def _locate(self, record):
+        firsts = [segment.first_record for _, segment in self.segments]
+        segment = self.segments[bisect_right(firsts, record) - 1][1]
+        return segment, record - segment.first_record
+
+    def get(self, record):
+        with self.lock:
+            if not self.first_record <= record < len(self):
+                raise IndexError(f"Record {record} is not in {self.name}")
+            segment, i = self._locate(record)
+            return segment.read(i)[0].decode('utf-8')
+
+    def tail(self, n=1):
+        with self.lock:
+            start = max(self.first_record, len(self) - n)
+            return [self.get(record) for record in range(start, len(self))]
+
+    def records(self):
+        with self.lock:
+            return [self.get(record) for record in range(self.first_record, len(self))]
+
+    def compact(self):
+        with self.lock:
+            sealed = self.segments[:-1]
+            cutoff = len(self) - self.keep_last if self.keep_last is not None else None
+            dropped = 0
+            for number, segment in sealed:
+                if cutoff is not None and segment.last_record <= cutoff:
+                    segment.close()
+                    os.remove(segment.path)
+                    self.compacted.discard(number)
+                    dropped += 1
+                    continue
+                if number not in self.compacted:
+                    segment.shrink()
+                    self.compacted.add(number)
+            if dropped:
+                self.segments = self.segments[dropped:]
+                self._write_manifest()
+            return dropped
+
+    def flush(self):
+        with self.lock:
+            self.segments[-1][1].flush()
+
+    def close(self):
+        with self.lock:
+            for _, segment in self.segments:
+                segment.close()
+
+
+class MemoryStore:
+    # Same interface as LocalGPT_FileAccess.MemoryManager, without its 5000 byte limit
+
+    def __init__(self, directory='memory/store', max_segment_bytes=4 * 1024 * 1024, compaction_interval=300):
+        self.directory = directory
+        self.max_segment_bytes = max_segment_bytes
+        self.compaction_interval = compaction_interval
+        self.logs = {}
+        self.lock = threading.Lock()
+        self.overall = self._log("overall_memory")
+        self._stop = threading.Event()
+        self._compactor = None
+        if compaction_interval:
+            self._compactor = threading.Thread(target=self._compaction_loop, name="memory-compaction", daemon=True)
+            self._compactor.start()
+
+    def _log(self, name, keep_last=None, initial_segment_bytes=64 * 1024):
+        with self.lock:
+            log = self.logs.get(name)
+            if log is None:
+                log = SegmentedLog(self.directory, name, self.max_segment_bytes,
+                                   initial_segment_bytes=initial_segment_bytes, keep_last=keep_last)
+                self.logs[name] = log
+            return log
+
+    def _chat_log(self, file_name):
+        # Only the latest version of a chat memory matters, so older ones can be compacted away
+        name = os.path.splitext(os.path.basename(file_name))[0]
+        return self._log(name, keep_last=1, initial_segment_bytes=16 * 1024)
+
+    def CreateChatMemory(self):
+        file_name = f"chat_memory_{datetime.now():%Y%m%d%H%M%S%f}.mmap"
+        self._chat_log(file_name)
+        return file_name
+
+    def UpdateChatMemory(self, file_name, content):
+        self._chat_log(file_name).append(content)
+
+    def LoadChatMemory(self, file_name):
+        latest = self._chat_log(file_name).tail(1)
+        return latest[0] if latest else ""
+
+    def UpdateOverallMemory(self, summary):
+        self.overall.append(summary)
+
+    def LoadOverallMemory(self):
+        return self.overall.records()
+
+    def RecentOverallMemory(self, n):
+        return self.overall.tail(n)
+
+    def compact(self):
+        with self.lock:
+            logs = list(self.logs.values())
+        for log in logs:
+            try:
+                log.compact()
+            except OSError as e:
+                logging.error(f"Failed to compact memory log {log.name}: {e}")
+                logging.debug(traceback.format_exc())
+
+    def _compaction_loop(self):
+        while not self._stop.wait(self.compaction_interval):
+            self.compact()
+
+    def close(self):
+        self._stop.set()
+        with self.lock:
+            logs = list(self.logs.values())
+        for log in logs:
+            log.flush()
+            log.close()
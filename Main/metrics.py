@@ -0,0 +1,222 @@
+import asyncio
+import bisect
+import logging
+import math
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+
+# In-process metrics in the Prometheus text exposition format.
+#
+# Counters and histograms are updated where things happen; gauges, and counters
+# that a subsystem already keeps (cache hits, retries), can instead be given a
+# function that is read when the metrics are rendered, so nothing has to be
+# kept in sync. Metrics may have labels; a labelled metric keeps one series per
+# combination of label values. serve() answers GET /metrics on a local port so
+# Prometheus can scrape it; render() gives the same text to other callers.
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# Seconds, from a cache hit to a long code run or crawl
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if value == -math.inf:
+        return "-Inf"
+    if value != value:
+        return "NaN"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(names, values, extra=None):
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(f'{extra[0]}="{escape(extra[1])}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=(), function=None):
+        # function() returns the value, or for a labelled metric a dict of
+        # label value tuples to values, each time the metrics are rendered
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.function = function
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError(f"{self.name} takes the labels {self.labels}, not {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def samples(self):
+        # (suffix, label values, extra label, value) for each line
+        if self.function is None:
+            with self.lock:
+                values = dict(self.series)
+        else:
+            values = self.function()
+            if not isinstance(values, dict):
+                values = {(): values}
+        return [("", key, None, value) for key, value in sorted(values.items())]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, key, extra, value in self.samples():
+            lines.append(f"{self.name}{suffix}{format_labels(self.labels, key, extra)} {format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.series[key] = self.series.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.series[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.series[key] = self.series.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                # Per-bucket counts, then the sum and the count
+                series = self.series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        # Observes the time spent in the block, including when it raises
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started, **labels)
+
+    def samples(self):
+        with self.lock:
+            series = {key: (list(counts), total, count) for key, (counts, total, count) in self.series.items()}
+        samples = []
+        for key, (counts, total, count) in sorted(series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (math.inf,), counts):
+                cumulative += bucket_count
+                samples.append(("_bucket", key, ("le", format_value(bound)), cumulative))
+            samples.append(("_sum", key, None, total))
+            samples.append(("_count", key, None, count))
+        return samples
+
+
+class MetricsRegistry:
+    def __init__(self, prefix="dantalion_"):
+        self.prefix = prefix
+        self.metrics = {}
+        self.lock = threading.Lock()
+        self.server = None
+
+    def _get(self, cls, name, *args, **kwargs):
+        # The same name always gives back the same metric
+        name = self.prefix + name
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, *args, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError(f"{name} is already registered as a {metric.kind}")
+            return metric
+
+    def counter(self, name, help, labels=(), function=None):
+        return self._get(Counter, name, help, labels, function)
+
+    def gauge(self, name, help, labels=(), function=None):
+        return self._get(Gauge, name, help, labels, function)
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, help, labels, buckets)
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        blocks = []
+        for metric in metrics:
+            try:
+                blocks.append(metric.render())
+            except Exception as e:
+                # One broken collector shouldn't take the whole page down
+                logging.error(f"Failed to collect {metric.name}: {str(e)}")
+                logging.debug(traceback.format_exc())
+        return "\n".join(blocks) + "\n"
+
+    async def serve(self, host='127.0.0.1', port=9998):
+        # A minimal HTTP endpoint: GET /metrics, anything else is a 404
+        self.server = await asyncio.start_server(self._handle_http, host, port)
+        logging.info(f"Metrics available at http://{host}:{self.server.sockets[0].getsockname()[1]}/metrics")
+
+    async def _handle_http(self, reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 10)
+            while (await asyncio.wait_for(reader.readline(), 10)).strip():
+                pass
+            parts = request_line.decode('latin-1').split()
+            if len(parts) >= 2 and parts[0] in ("GET", "HEAD") and parts[1].split("?")[0] == "/metrics":
+                # Collectors may wait on subsystem locks, so they don't run on the loop
+                status, content_type, body = "200 OK", CONTENT_TYPE, (await asyncio.to_thread(self.render)).encode('utf-8')
+            else:
+                status, content_type, body = "404 Not Found", "text/plain", b"Not found\n"
+            head = (f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+                    f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n")
+            writer.write(head.encode('latin-1') + (body if parts[:1] != ["HEAD"] else b""))
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError) as e:
+            logging.debug(f"Metrics request failed: {str(e)}")
+        finally:
+            writer.close()
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+
+registry = MetricsRegistry()
@@ -0,0 +1,166 @@
+import asyncio
+import logging
+import time
+
+from fetch_cache import content_hash
+from webscraper import PageParser, parse_page
+
+# Fetches pages over plain HTTP first and renders them in a browser only when
+# they need it.
+#
+# Most pages we scrape are static documentation, for which a GET is far cheaper
+# than driving Chrome. Requests go through one pooled HTTP client that keeps
+# connections alive between fetches and accepts compressed responses. The page
+# is parsed once; if it looks script-rendered (see needs_rendering) or the
+# caller asks for rendering, it is loaded again through the browser pool.
+# With a FetchCache, fresh pages are served from it, stale ones are revalidated
+# with conditional GETs and unchanged bodies are not parsed again. The cache's
+# file I/O runs in threads, off the event loop.
+
+APP_ROOT_IDS = ("root", "app", "__next", "__nuxt", "___gatsby", "svelte")
+MIN_TEXT_CHARS = 200
+USER_AGENT = "Mozilla/5.0 (compatible; Dantalion/1.0)"
+
+
+def needs_rendering(page):
+    # page is a webscraper.PageParser for the HTML as served
+    if page.text_chars >= MIN_TEXT_CHARS:
+        return False
+    # Little text: an app shell if it asks for JavaScript, mounts into an empty
+    # root element or is nothing but scripts
+    if page.noscript_warning or any(element_id in APP_ROOT_IDS for element_id in page.ids):
+        return True
+    return page.scripts > 0 and not page.links
+
+
+class FetchedPage:
+    def __init__(self, url, html, parsed, rendered, duration, cached=False):
+        # html is None for pages served from the cache
+        self.url = url
+        self.html = html
+        self.parsed = parsed
+        self.rendered = rendered
+        self.duration = duration
+        self.cached = cached
+
+
+class PageFetcher:
+    def __init__(self, browsers, max_connections=10, timeout=20, user_agent=USER_AGENT, cache=None):
+        self.browsers = browsers
+        self.cache = cache
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.user_agent = user_agent
+        self._client = None
+        self.fetched = 0
+        self.rendered = 0
+
+    def client(self):
+        if self._client is None:
+            # Imported here so the module loads without httpx until a page is fetched
+            import httpx
+            self._client = httpx.AsyncClient(
+                follow_redirects=True,
+                timeout=self.timeout,
+                limits=httpx.Limits(max_connections=self.max_connections,
+                                    max_keepalive_connections=self.max_connections),
+                headers={"User-Agent": self.user_agent, "Accept": "text/html,application/xhtml+xml,*/*;q=0.8"}
+            )
+        return self._client
+
+    def page_text(self, url, response):
+        # The response body as text, after redirects and decompression
+        if response.status_code >= 400:
+            raise RuntimeError(f"Fetching {url} failed with HTTP {response.status_code}")
+        content_type = response.headers.get("content-type", "")
+        if content_type and not any(kind in content_type for kind in ("html", "xml", "text/")):
+            raise RuntimeError(f"{url} is not a web page ({content_type})")
+        return str(response.url), response.text
+
+    async def get(self, url):
+        return self.page_text(url, await self.client().get(url))
+
+    async def fetch(self, url, render=False, timeout=None):
+        started = time.monotonic()
+        entry = await asyncio.to_thread(self.cache.lookup, url) if self.cache else None
+        if entry and (entry["rendered"] or not render):
+            if self.cache.is_fresh(entry):
+                page = await self.cached_page(entry, started)
+                if page:
+                    self.cache.hits += 1
+                    return page
+        else:
+            # A plain copy doesn't answer a request for the rendered page
+            entry = None
+        response = None
+        digest = None
+        if not render:
+            headers = self.cache.validators(entry) if entry else {}
+            response = await self.client().get(url, headers=headers)
+            if response.status_code == 304 and entry:
+                page = await self.revalidated(entry, started)
+                if page:
+                    return page
+                # The parsed copy is gone; fetch the page in full
+                response = await self.client().get(url)
+            final_url, html = self.page_text(url, response)
+            self.fetched += 1
+            digest = content_hash(html)
+            if entry and entry["hash"] == digest:
+                # Same body from a server without validators
+                page = await self.revalidated(entry, started)
+                if page:
+                    return page
+            parsed = await asyncio.to_thread(parse_page, html)
+            if not needs_rendering(parsed):
+                await self.remember(url, response, digest, digest, parsed, rendered=False)
+                return FetchedPage(final_url, html, parsed, False, time.monotonic() - started)
+            logging.info(f"{url} looks script-rendered, loading it in a browser")
+        html = await self.browsers.load_async(url, timeout)
+        parsed = await asyncio.to_thread(parse_page, html)
+        self.rendered += 1
+        await self.remember(url, response, digest, content_hash(html), parsed, rendered=True)
+        return FetchedPage(url, html, parsed, True, time.monotonic() - started)
+
+    async def cached_page(self, entry, started):
+        snapshot = await asyncio.to_thread(self.cache.load_page, entry["page"])
+        if snapshot is None:
+            return None
+        return FetchedPage(entry.get("final_url", entry["url"]), None, PageParser.restore(snapshot),
+                           entry["rendered"], time.monotonic() - started, cached=True)
+
+    async def revalidated(self, entry, started):
+        page = await self.cached_page(entry, started)
+        if page:
+            self.cache.revalidated += 1
+            await asyncio.to_thread(self.cache.update, entry["url"], checked=time.time())
+        return page
+
+    async def remember(self, url, response, digest, page_key, parsed, rendered):
+        # digest is the hash of the body as served, page_key that of what was parsed
+        if not self.cache:
+            return
+        entry = await asyncio.to_thread(self.cache.lookup, url)
+        if entry is None:
+            self.cache.misses += 1
+        else:
+            self.cache.changed += 1
+        await asyncio.to_thread(self.cache.store_page, page_key, parsed.snapshot())
+        now = time.time()
+        await asyncio.to_thread(
+            self.cache.update,
+            url,
+            final_url=str(response.url) if response is not None else url,
+            etag=response.headers.get("etag") if response is not None else None,
+            last_modified=response.headers.get("last-modified") if response is not None else None,
+            hash=digest,
+            page=page_key,
+            rendered=rendered,
+            fetched=now,
+            checked=now
+        )
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
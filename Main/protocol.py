@@ -0,0 +1,110 @@
+import struct
+
+# Framed wire protocol for the chat server.
+#
+# A framed client opens the connection by sending MAGIC. Every frame after that is
+# a fixed header followed by a UTF-8 payload of exactly `length` bytes:
+#
+#   flags|frame_type (1 byte) | channel (4 bytes) | request_id (4 bytes) | length (4 bytes)
+#
+# The low four bits of the first byte are the frame type, the high four bits are
+# flags (FLAG_NO_CACHE on a request bypasses the response cache).
+#
+# The channel selects an independent chat session on the server, so one TCP
+# connection can carry several conversations. The request id is echoed back on
+# every frame that belongs to the reply, so replies can arrive in any order.
+# A FRAME_STREAM_REQUEST is answered with FRAME_DELTA frames carrying the text
+# as the model produces it, followed by the usual FRAME_REPLY with the full reply.
+# While a streamed request runs code, the code's output arrives as FRAME_OUTPUT
+# frames (FLAG_STDERR marks stderr); the reply itself only quotes its tail.
+# A FRAME_SESSION binds its channel to the client-chosen session id in the payload,
+# so the conversation survives reconnects; it is answered with a FRAME_REPLY of
+# "resumed" or "loaded". Unbound channels get a fresh session per connection.
+# Clients that don't send MAGIC are served in the legacy raw mode.
+
+MAGIC = b"DTL1"
+HEADER = struct.Struct(">BIII")
+MAX_PAYLOAD = 16 * 1024 * 1024
+
+FRAME_REQUEST = 1
+FRAME_REPLY = 2
+FRAME_ERROR = 3
+FRAME_STREAM_REQUEST = 4
+FRAME_DELTA = 5
+FRAME_SESSION = 6
+FRAME_OUTPUT = 7
+
+TYPE_MASK = 0x0F
+FLAG_NO_CACHE = 0x10
+FLAG_STDERR = 0x20
+
+FRAME_TYPES = (FRAME_REQUEST, FRAME_REPLY, FRAME_ERROR, FRAME_STREAM_REQUEST, FRAME_DELTA, FRAME_SESSION, FRAME_OUTPUT)
+REQUEST_TYPES = (FRAME_REQUEST, FRAME_STREAM_REQUEST)
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def encode_frame(frame_type, channel, request_id, payload, flags=0):
+    if isinstance(payload, str):
+        payload = payload.encode()
+    if len(payload) > MAX_PAYLOAD:
+        raise ProtocolError(f"Payload of {len(payload)} bytes exceeds limit of {MAX_PAYLOAD}")
+    return HEADER.pack(frame_type | flags, channel, request_id, len(payload)) + payload
+
+
+def is_framed_preamble(data):
+    # True/False once enough bytes are known, None while the prefix is still ambiguous
+    if len(data) >= len(MAGIC):
+        return data.startswith(MAGIC)
+    if MAGIC.startswith(data):
+        return None
+    return False
+
+
+class Frame:
+    __slots__ = ("frame_type", "channel", "request_id", "payload", "flags")
+
+    def __init__(self, frame_type, channel, request_id, payload, flags=0):
+        self.frame_type = frame_type
+        self.flags = flags
+        self.channel = channel
+        self.request_id = request_id
+        self.payload = payload
+
+    def text(self):
+        return self.payload.decode()
+
+    def __repr__(self):
+        return f"Frame(type={self.frame_type}, channel={self.channel}, request_id={self.request_id}, length={len(self.payload)})"
+
+
+class FrameDecoder:
+    # Incremental decoder: feed it whatever the socket returned and collect complete frames
+
+    def __init__(self, max_payload=MAX_PAYLOAD):
+        self.max_payload = max_payload
+        self._buffer = bytearray()
+
+    def feed(self, data):
+        self._buffer += data
+        frames = []
+        while len(self._buffer) >= HEADER.size:
+            type_byte, channel, request_id, length = HEADER.unpack_from(self._buffer)
+            frame_type = type_byte & TYPE_MASK
+            if frame_type not in FRAME_TYPES:
+                raise ProtocolError(f"Unknown frame type: {frame_type}")
+            if length > self.max_payload:
+                raise ProtocolError(f"Frame of {length} bytes exceeds limit of {self.max_payload}")
+            end = HEADER.size + length
+            if len(self._buffer) < end:
+                break
+            payload = bytes(self._buffer[HEADER.size:end])
+            del self._buffer[:end]
+            frames.append(Frame(frame_type, channel, request_id, payload, type_byte & ~TYPE_MASK))
+        return frames
+
+    @property
+    def pending(self):
+        return len(self._buffer)
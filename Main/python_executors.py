@@ -1,39 +1,70 @@
-import os
-import json
-import subprocess
-import venv
-from webscraper import scrape_website
+import asyncio
+
+from interpreter_pool import InterpreterPool
+from env_cache import python_executable
+from crawler import Crawler
+from webscraper import extract_links, normalize_domain, save_links
+
+# Nothing here blocks the event loop, and everything can time out or be
+# cancelled. Installs are one-off JobRunner subprocesses; code runs go to a pool
+# of warm interpreter subprocesses in the cached environment for their package
+# set. Scrapes run in this process: plain HTTP requests over httpx, escalated to
+# a pool of open browsers for pages that need JavaScript.
+
+# The environment cache and page fetcher are passed in by the caller, which
+# owns and configures them.
+
+# Settings for the interpreter pools, applied when a pool is first created
+interpreter_pool_options = {}
+# Concurrency and politeness settings for crawls
+crawler_options = {}
 
 class VirtualEnvManager:
+    # A built environment from the cache and its interpreters
     def __init__(self, env_dir='venv'):
         self.env_dir = env_dir
-        self.python_executable = os.path.join(env_dir, 'bin', 'python') if os.name != 'nt' else os.path.join(env_dir, 'Scripts', 'python.exe')
-
-    def create_virtual_env(self):
-        if not os.path.exists(self.env_dir):
-            venv.create(self.env_dir, with_pip=True)
-        else:
-            print(f"Virtual environment already exists at {self.env_dir}")
-
-    def install_packages(self, packages):
-        subprocess.check_call([self.python_executable, '-m', 'pip', 'install'] + packages)
-
-    def run_code(self, code):
-        with open('temp_code.py', 'w') as code_file:
-            code_file.write(code)
-        result = subprocess.run([self.python_executable, 'temp_code.py'], capture_output=True, text=True)
-        os.remove('temp_code.py')
-        return result.stdout, result.stderr
-
-def run_code_in_virtual_env(code, packages=None):
-    manager = VirtualEnvManager()
-    manager.create_virtual_env()
-    if packages:
-        manager.install_packages(packages)
-    stdout, stderr = manager.run_code(code)
+        self.python_executable = python_executable(env_dir)
+        self.pool = None
+
+    def interpreter_pool(self):
+        if self.pool is None:
+            self.pool = InterpreterPool(self.python_executable, **interpreter_pool_options)
+        return self.pool
+
+    async def run_code(self, code, timeout=None, on_output=None):
+        # The code goes to a warm worker over its pipes, so there is no temp file to share.
+        # on_output(stream, text) gets the output as it is produced.
+        result = await self.interpreter_pool().run_async(code, timeout, on_output)
+        stderr = result.stderr
+        if result.timed_out:
+            stderr += f"\nExecution timed out after {result.duration:.0f}s"
+        if result.truncated:
+            stderr += "\nOutput was truncated to its last lines"
+        return result.stdout, stderr
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+
+async def run_code_in_virtual_env(code, packages, environments, on_output=None):
+    async with environments.lease(packages) as environment:
+        stdout, stderr = await environment.run_code(code, on_output=on_output)
     return stdout, stderr
 
-def execute_python_command(command):
+async def scrape_website(domain, subdomain, fetcher, render=False, timeout=None, depth=0, max_pages=100):
+    # render=True skips the HTTP attempt and loads the page in a browser straight away.
+    # With depth > 0 the links are followed that many levels deep, staying on the site.
+    domain = normalize_domain(domain)
+    if depth > 0:
+        crawler = Crawler(fetcher, max_depth=depth, max_pages=max_pages, prefix=subdomain,
+                          render=render, timeout=timeout, **crawler_options)
+        result = await crawler.crawl(domain)
+        return result.path
+    page = await fetcher.fetch(domain, render, timeout)
+    resources = extract_links(page.parsed, domain, subdomain)
+    return await asyncio.to_thread(save_links, domain, resources)
+
+async def execute_python_command(command, fetcher, environments, on_output=None):
     if command.startswith("run_code_in_virtual_env"):
         # Extract code and packages from the command
         parts = command.split(" ", 2)
@@ -41,19 +72,35 @@ def execute_python_command(command):
             return "Invalid command format. Use: run_code_in_virtual_env [packages] code"
         packages = parts[1].strip("[]").split(",") if parts[1] != "[]" else None
         code = parts[2]
-        return run_code_in_virtual_env(code, packages)
+        return await run_code_in_virtual_env(code, packages, environments, on_output)
     elif command.startswith("scrape_website"):
         parts = command.split(" ")
         if len(parts) < 2:
             return "Invalid command format. Use: scrape_website domain [subdomain]"
         domain = parts[1]
         subdomain = parts[2] if len(parts) > 2 else None
-        return scrape_website(domain, subdomain)
+        return await scrape_website(domain, subdomain, fetcher)
     else:
         return "Unknown Python command."
 
 # Example usage
 if __name__ == "__main__":
     # This part is for testing the functions standalone
-    print(execute_python_command("run_code_in_virtual_env [] print('Hello, World!')"))
-    print(execute_python_command("scrape_website example.com"))
\ No newline at end of file
+    from browser_pool import BrowserPool
+    from env_cache import EnvironmentCache
+    from job_runner import JobRunner
+    from page_fetcher import PageFetcher
+
+    async def main():
+        browsers = BrowserPool(size=1)
+        fetcher = PageFetcher(browsers)
+        environments = EnvironmentCache(VirtualEnvManager, JobRunner())
+        try:
+            print(await execute_python_command("run_code_in_virtual_env [] print('Hello, World!')", fetcher, environments))
+            print(await execute_python_command("scrape_website example.com", fetcher, environments))
+        finally:
+            await fetcher.close()
+            environments.close()
+            browsers.close()
+
+    asyncio.run(main())
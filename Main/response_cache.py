@@ -0,0 +1,148 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# Two-tier cache of assistant replies. The key is a stable hash of everything
+# that determines the reply (model, system prompt, message window, max_tokens),
+# so a hit is only possible for an identical request.
+
+def cache_key(model, system, messages, max_tokens):
+    payload = json.dumps({
+        "model": model,
+        "system": system,
+        "messages": messages,
+        "max_tokens": max_tokens
+    }, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, directory='cache/responses', memory_entries=256, ttl=24 * 3600, max_disk_bytes=64 * 1024 * 1024):
+        self.directory = directory
+        self.memory_entries = memory_entries
+        self.ttl = ttl
+        self.max_disk_bytes = max_disk_bytes
+        self.memory = OrderedDict()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self._disk_files = None
+        self._disk_bytes = 0
+        self._disk_lock = threading.Lock()
+
+    def stats(self):
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "stores": self.stores,
+            "evictions": self.evictions,
+            "memory_entries": len(self.memory),
+            "disk_bytes": self._disk_bytes
+        }
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def _remember(self, key, created, response):
+        self.memory[key] = (created, response)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_entries:
+            self.memory.popitem(last=False)
+
+    def _scan_disk(self):
+        # Built once, then kept up to date so eviction never has to list the directory
+        if self._disk_files is not None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and entry.name.endswith('.json'):
+                stat = entry.stat()
+                files.append((stat.st_mtime, entry.name[:-5], stat.st_size))
+        files.sort()
+        self._disk_files = OrderedDict((key, size) for _, key, size in files)
+        self._disk_bytes = sum(self._disk_files.values())
+
+    def _drop_disk(self, key):
+        size = self._disk_files.pop(key, None)
+        if size is not None:
+            self._disk_bytes -= size
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def _read_disk(self, key):
+        with self._disk_lock:
+            return self._read_disk_locked(key)
+
+    def _write_disk(self, key, created, response):
+        with self._disk_lock:
+            self._write_disk_locked(key, created, response)
+
+    def _read_disk_locked(self, key):
+        self._scan_disk()
+        if key not in self._disk_files:
+            return None
+        try:
+            with open(self._path(key), 'r') as f:
+                entry = json.load(f)
+        except (OSError, ValueError) as e:
+            logging.error(f"Failed to read cached response {key}: {e}")
+            self._drop_disk(key)
+            return None
+        if time.time() - entry["created"] > self.ttl:
+            self._drop_disk(key)
+            return None
+        self._disk_files.move_to_end(key)
+        return entry["created"], entry["response"]
+
+    def _write_disk_locked(self, key, created, response):
+        self._scan_disk()
+        data = json.dumps({"created": created, "response": response}).encode()
+        temp_path = self._path(key) + '.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, self._path(key))
+        if key in self._disk_files:
+            self._disk_bytes -= self._disk_files[key]
+        self._disk_files[key] = len(data)
+        self._disk_files.move_to_end(key)
+        self._disk_bytes += len(data)
+        while self._disk_bytes > self.max_disk_bytes and len(self._disk_files) > 1:
+            oldest = next(iter(self._disk_files))
+            self._drop_disk(oldest)
+            self.evictions += 1
+
+    async def get(self, key):
+        entry = self.memory.get(key)
+        if entry is not None:
+            if time.time() - entry[0] <= self.ttl:
+                self.memory.move_to_end(key)
+                self.memory_hits += 1
+                return entry[1]
+            del self.memory[key]
+        entry = await asyncio.to_thread(self._read_disk, key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.disk_hits += 1
+        self._remember(key, *entry)
+        return entry[1]
+
+    async def put(self, key, response):
+        created = time.time()
+        self._remember(key, created, response)
+        self.stores += 1
+        try:
+            await asyncio.to_thread(self._write_disk, key, created, response)
+        except OSError as e:
+            logging.error(f"Failed to write cached response {key}: {e}")
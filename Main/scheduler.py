@@ -0,0 +1,195 @@
+import asyncio
+import heapq
+import itertools
+import json
+import logging
+import random
+import time
+
+# Every LLM call goes through one LLMScheduler so that all sessions share one
+# in-flight limit and one request/token budget. Waiting calls are served by
+# priority (lower value first), FIFO within a priority.
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_FOLLOW_UP = 10
+PRIORITY_BACKGROUND = 20
+
+RETRYABLE_STATUS_CODES = (408, 409, 429, 500, 502, 503, 504, 529)
+
+
+def api_errors():
+    # Imported on demand so the SDK isn't loaded before the first LLM call
+    from anthropic import APIConnectionError, APIStatusError
+    return APIConnectionError, APIStatusError
+
+
+class TokenBucket:
+    def __init__(self, capacity, refill_per_second):
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.refill_per_second)
+        self.updated = now
+
+    def delay_for(self, amount):
+        # Seconds until `amount` can be taken (0 if it can be taken now)
+        self._refill()
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.refill_per_second
+
+    def consume(self, amount):
+        self._refill()
+        self.tokens -= amount
+
+    def refund(self, amount):
+        # Negative amounts charge extra when the estimate was too low
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class LLMScheduler:
+    def __init__(self, get_client, max_in_flight=4, requests_per_minute=50, tokens_per_minute=40000,
+                 max_retries=5, base_delay=1.0, max_delay=60.0):
+        self.get_client = get_client
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.request_bucket = TokenBucket(requests_per_minute, requests_per_minute / 60)
+        self.token_bucket = TokenBucket(tokens_per_minute, tokens_per_minute / 60)
+        self.in_flight = 0
+        self.retries = 0
+        self._waiters = []
+        self._sequence = itertools.count()
+        self._paused_until = 0.0
+        self._wake_handle = None
+
+    @property
+    def queue_depth(self):
+        return sum(1 for _, _, _, future in self._waiters if not future.done())
+
+    def estimate_tokens(self, kwargs):
+        # Rough count (4 characters per token) of everything billed for the request
+        size = len(json.dumps(kwargs.get('system', ''), default=str)) + len(json.dumps(kwargs.get('messages', []), default=str))
+        return size // 4 + kwargs.get('max_tokens', 0)
+
+    def _wake(self):
+        self._wake_handle = None
+        loop = asyncio.get_running_loop()
+        while self._waiters and self.in_flight < self.max_in_flight:
+            priority, sequence, cost, future = self._waiters[0]
+            if future.done():
+                heapq.heappop(self._waiters)
+                continue
+            delay = max(self._paused_until - time.monotonic(),
+                        self.request_bucket.delay_for(1),
+                        self.token_bucket.delay_for(cost))
+            if delay > 0:
+                self._wake_handle = loop.call_later(delay, self._wake)
+                return
+            heapq.heappop(self._waiters)
+            self.request_bucket.consume(1)
+            self.token_bucket.consume(cost)
+            self.in_flight += 1
+            future.set_result(None)
+
+    async def _acquire(self, priority, cost):
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._sequence), cost, future))
+        if self._wake_handle is not None:
+            self._wake_handle.cancel()
+        self._wake()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self._release()
+            raise
+
+    def _release(self):
+        self.in_flight -= 1
+        if self._wake_handle is None:
+            self._wake()
+
+    def _settle(self, estimate, message):
+        usage = getattr(message, 'usage', None)
+        if usage is not None:
+            # Writing the prompt cache is billed against the limit like any other input
+            actual = ((usage.input_tokens or 0) + (usage.output_tokens or 0)
+                      + (getattr(usage, 'cache_creation_input_tokens', None) or 0))
+            self.token_bucket.refund(estimate - actual)
+
+    def _retry_delay(self, error, attempt):
+        APIConnectionError, APIStatusError = api_errors()
+        if isinstance(error, APIStatusError):
+            if error.status_code not in RETRYABLE_STATUS_CODES:
+                return None
+        elif not isinstance(error, APIConnectionError):
+            return None
+        if attempt >= self.max_retries:
+            return None
+        backoff = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        retry_after = None
+        response = getattr(error, 'response', None)
+        if response is not None:
+            try:
+                retry_after = float(response.headers.get('retry-after'))
+            except (TypeError, ValueError):
+                retry_after = None
+        if retry_after is not None:
+            # The server told us when to come back: hold every caller until then
+            delay = min(self.max_delay, retry_after) + backoff * 0.1
+            self._paused_until = max(self._paused_until, time.monotonic() + delay)
+            return delay
+        return backoff
+
+    async def _run(self, call, priority, kwargs):
+        estimate = self.estimate_tokens(kwargs)
+        attempt = 0
+        while True:
+            await self._acquire(priority, estimate)
+            try:
+                message = await call()
+                self._settle(estimate, message)
+                return message
+            except Exception as e:
+                delay = self._retry_delay(e, attempt)
+                if delay is None:
+                    raise
+                attempt += 1
+                self.retries += 1
+                logging.warning(f"LLM request failed ({str(e)}), retry {attempt}/{self.max_retries} in {delay:.1f}s")
+            finally:
+                self._release()
+            await asyncio.sleep(delay)
+
+    async def create(self, priority=PRIORITY_INTERACTIVE, **kwargs):
+        return await self._run(lambda: self.get_client().messages.create(**kwargs), priority, kwargs)
+
+    async def stream(self, on_delta, priority=PRIORITY_INTERACTIVE, **kwargs):
+        # Retries are only safe until the first delta has been forwarded
+        forwarded = False
+
+        async def call():
+            nonlocal forwarded
+            async with self.get_client().messages.stream(**kwargs) as stream:
+                async for text in stream.text_stream:
+                    forwarded = True
+                    await on_delta(text)
+                return await stream.get_final_message()
+
+        async def guarded():
+            try:
+                return await call()
+            except api_errors() as e:
+                if forwarded:
+                    raise RuntimeError(f"Stream interrupted after output was sent: {str(e)}") from e
+                raise
+
+        return await self._run(guarded, priority, kwargs)
@@ -0,0 +1,200 @@
+import asyncio
+import logging
+import signal
+import socket
+import traceback
+from contextlib import contextmanager
+
+# Connection-level server for the chat handlers.
+#
+# Backpressure comes from three places: a cap on concurrent connections (excess
+# clients wait in the kernel accept backlog instead of being accepted and left
+# to pile up work), a bounded read buffer per connection (the transport stops
+# reading from the socket once it is full) and write buffer watermarks (send()
+# blocks once the high watermark is crossed until the low one is reached).
+
+class Connection:
+    def __init__(self, reader, writer, idle_timeout, closing):
+        self.reader = reader
+        self.writer = writer
+        self.idle_timeout = idle_timeout
+        self.peer = writer.get_extra_info('peername')
+        self.in_flight = 0
+        self._closing = closing
+
+    @property
+    def draining(self):
+        return self._closing.is_set()
+
+    @contextmanager
+    def busy(self):
+        # Marks a request as in flight: idle timeouts don't apply and shutdown waits for it
+        self.in_flight += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+
+    async def recv(self, n=65536, timeout=None):
+        # Returns b"" on disconnect, idle timeout or server shutdown, and None if
+        # nothing arrived within timeout (unread data stays buffered)
+        if self.draining:
+            return b""
+        read_task = asyncio.ensure_future(self.reader.read(n))
+        closing_task = asyncio.ensure_future(self._closing.wait())
+        try:
+            while True:
+                wait = self.idle_timeout if timeout is None else min(timeout, self.idle_timeout)
+                done, _ = await asyncio.wait({read_task, closing_task}, timeout=wait, return_when=asyncio.FIRST_COMPLETED)
+                if read_task in done:
+                    return read_task.result()
+                if closing_task in done:
+                    return b""
+                if timeout is not None:
+                    return None
+                if self.in_flight == 0:
+                    logging.info(f"Closing idle connection from {self.peer}")
+                    return b""
+        finally:
+            for task in (read_task, closing_task):
+                if not task.done():
+                    task.cancel()
+            # Let a cancelled read settle so the next recv() can wait on the stream
+            await asyncio.gather(read_task, closing_task, return_exceptions=True)
+
+    async def send(self, data):
+        self.writer.write(data)
+        await self.writer.drain()
+
+    async def close(self):
+        if not self.writer.is_closing():
+            self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except (ConnectionError, OSError):
+            pass
+
+
+class ChatServer:
+    def __init__(self, handler, host='0.0.0.0', port=9999, max_connections=64, backlog=128,
+                 read_limit=64 * 1024, write_high_water=256 * 1024, write_low_water=64 * 1024,
+                 idle_timeout=600, drain_timeout=60):
+        self.handler = handler
+        self.host = host
+        self.port = port
+        self.max_connections = max_connections
+        self.backlog = backlog
+        self.read_limit = read_limit
+        self.write_high_water = write_high_water
+        self.write_low_water = write_low_water
+        self.idle_timeout = idle_timeout
+        self.drain_timeout = drain_timeout
+        self.connections = {}
+        self._listener = None
+        self._accept_task = None
+        self._slots = None
+        self._closing = None
+        self._stopped = None
+
+    @property
+    def active_connections(self):
+        return len(self.connections)
+
+    async def start(self):
+        self._slots = asyncio.Semaphore(self.max_connections)
+        self._closing = asyncio.Event()
+        self._stopped = asyncio.Event()
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((self.host, self.port))
+        listener.listen(self.backlog)
+        listener.setblocking(False)
+        self._listener = listener
+        self.port = listener.getsockname()[1]
+        self._accept_task = asyncio.create_task(self._accept_loop())
+        logging.info(f"Server listening on port {self.port} (max {self.max_connections} connections, backlog {self.backlog})")
+
+    async def _accept_loop(self):
+        loop = asyncio.get_running_loop()
+        while not self._closing.is_set():
+            # Only accept when a slot is free; everyone else waits in the backlog
+            await self._slots.acquire()
+            try:
+                client_sock, addr = await loop.sock_accept(self._listener)
+            except asyncio.CancelledError:
+                self._slots.release()
+                raise
+            except OSError as e:
+                self._slots.release()
+                logging.error(f"Error accepting connection: {str(e)}")
+                logging.debug(traceback.format_exc())
+                await asyncio.sleep(0.1)
+                continue
+            logging.info(f"New connection from {addr}")
+            task = asyncio.create_task(self._serve(client_sock))
+            self.connections[task] = None
+
+    async def _serve(self, client_sock):
+        loop = asyncio.get_running_loop()
+        task = asyncio.current_task()
+        connection = None
+        try:
+            reader = asyncio.StreamReader(limit=self.read_limit)
+            protocol = asyncio.StreamReaderProtocol(reader)
+            transport, _ = await loop.connect_accepted_socket(lambda: protocol, client_sock)
+            transport.set_write_buffer_limits(high=self.write_high_water, low=self.write_low_water)
+            writer = asyncio.StreamWriter(transport, protocol, reader, loop)
+            connection = Connection(reader, writer, self.idle_timeout, self._closing)
+            self.connections[task] = connection
+            await self.handler(connection)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logging.error(f"Error in connection handler: {str(e)}")
+            logging.debug(traceback.format_exc())
+        finally:
+            if connection:
+                await connection.close()
+            else:
+                client_sock.close()
+            self.connections.pop(task, None)
+            self._slots.release()
+
+    async def shutdown(self):
+        if self._closing.is_set():
+            await self._stopped.wait()
+            return
+        logging.info("Server shutting down, draining connections")
+        self._closing.set()
+        self._accept_task.cancel()
+        await asyncio.gather(self._accept_task, return_exceptions=True)
+        self._listener.close()
+
+        # Idle connections return from recv() straight away; busy ones get
+        # drain_timeout to finish their in-flight requests
+        tasks = list(self.connections)
+        if tasks:
+            _, still_running = await asyncio.wait(tasks, timeout=self.drain_timeout)
+            for task in still_running:
+                task.cancel()
+            await asyncio.gather(*still_running, return_exceptions=True)
+            if still_running:
+                logging.warning(f"Cancelled {len(still_running)} connections that did not drain in {self.drain_timeout}s")
+        logging.info("Server stopped")
+        self._stopped.set()
+
+    async def serve_forever(self):
+        if self._listener is None:
+            await self.start()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, lambda: asyncio.create_task(self.shutdown()))
+            except (NotImplementedError, RuntimeError):
+                # Not supported on Windows event loops
+                pass
+        try:
+            await self._stopped.wait()
+        except asyncio.CancelledError:
+            await asyncio.shield(self.shutdown())
+            raise
@@ -0,0 +1,134 @@
+import asyncio
+import logging
+import re
+import time
+import traceback
+from contextlib import asynccontextmanager
+
+# Server-side registry of chat sessions keyed by a client-supplied session id.
+#
+# Reconnecting clients get their resident session back as-is. Sessions that sit
+# idle longer than idle_timeout are written out and dropped from memory, as are
+# the least recently used ones whenever the resident count or footprint goes over
+# its cap; they are restored from disk the next time their id is used. Sessions
+# with a request in flight are never evicted.
+
+SESSION_ID_PATTERN = re.compile(r'^[A-Za-z0-9_.-]{1,64}$')
+
+
+def valid_session_id(session_id):
+    return bool(SESSION_ID_PATTERN.match(session_id))
+
+
+class SessionEntry:
+    __slots__ = ("session", "lock", "leases", "last_used")
+
+    def __init__(self, session):
+        self.session = session
+        self.lock = asyncio.Lock()
+        self.leases = 0
+        self.last_used = time.monotonic()
+
+
+class SessionRegistry:
+    def __init__(self, create_session, max_resident=100, max_resident_bytes=64 * 1024 * 1024,
+                 idle_timeout=900, sweep_interval=60):
+        # create_session(session_id) is a coroutine function that builds a session,
+        # restoring it from disk if it was saved before.
+        # Sessions must provide memory_footprint() and suspend().
+        self.create_session = create_session
+        self.max_resident = max_resident
+        self.max_resident_bytes = max_resident_bytes
+        self.idle_timeout = idle_timeout
+        self.sweep_interval = sweep_interval
+        self.entries = {}
+        self.created = 0
+        self.resumed = 0
+        self.evicted = 0
+        self._loading = {}
+        self._sweeper = None
+
+    @property
+    def resident(self):
+        return len(self.entries)
+
+    def start(self):
+        self._sweeper = asyncio.create_task(self._sweep_loop())
+
+    async def close(self):
+        if self._sweeper:
+            self._sweeper.cancel()
+            await asyncio.gather(self._sweeper, return_exceptions=True)
+        for session_id in list(self.entries):
+            self._evict(session_id)
+
+    async def open(self, session_id):
+        # Returns the entry and "resumed" if it was resident or "loaded" if it had to be built
+        if not valid_session_id(session_id):
+            raise ValueError(f"Invalid session id: {session_id!r}")
+        entry = self.entries.get(session_id)
+        if entry is not None:
+            self.resumed += 1
+            entry.last_used = time.monotonic()
+            return entry, "resumed"
+        # Concurrent opens of the same id share one load
+        loading = self._loading.get(session_id)
+        if loading is None:
+            loading = self._loading[session_id] = asyncio.ensure_future(self.create_session(session_id))
+            loading.add_done_callback(lambda _: self._loading.pop(session_id, None))
+        session = await asyncio.shield(loading)
+        entry = self.entries.get(session_id)
+        if entry is not None:
+            entry.last_used = time.monotonic()
+            return entry, "loaded"
+        entry = SessionEntry(session)
+        self.entries[session_id] = entry
+        self.created += 1
+        self._enforce_limits(keep=session_id)
+        return entry, "loaded"
+
+    @asynccontextmanager
+    async def lease(self, session_id):
+        # Requests for one session run one at a time, whichever connection they come from
+        entry, _ = await self.open(session_id)
+        entry.leases += 1
+        try:
+            async with entry.lock:
+                yield entry.session
+        finally:
+            entry.leases -= 1
+            entry.last_used = time.monotonic()
+            self._enforce_limits()
+
+    def _evict(self, session_id):
+        entry = self.entries.pop(session_id)
+        try:
+            entry.session.suspend()
+        except Exception as e:
+            logging.error(f"Failed to save session {session_id}: {str(e)}")
+            logging.debug(traceback.format_exc())
+        self.evicted += 1
+        logging.info(f"Evicted session {session_id}")
+
+    def _enforce_limits(self, keep=None):
+        idle = sorted(
+            (entry.last_used, session_id) for session_id, entry in self.entries.items()
+            if entry.leases == 0 and session_id != keep
+        )
+        footprint = sum(entry.session.memory_footprint() for entry in self.entries.values())
+        for _, session_id in idle:
+            if len(self.entries) <= self.max_resident and footprint <= self.max_resident_bytes:
+                break
+            footprint -= self.entries[session_id].session.memory_footprint()
+            self._evict(session_id)
+
+    def sweep(self):
+        cutoff = time.monotonic() - self.idle_timeout
+        for session_id, entry in list(self.entries.items()):
+            if entry.leases == 0 and entry.last_used < cutoff:
+                self._evict(session_id)
+
+    async def _sweep_loop(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            self.sweep()
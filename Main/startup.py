@@ -0,0 +1,64 @@
+import logging
+import threading
+import time
+
+# Startup timing and lazily loaded subsystems.
+#
+# StartupTimer.mark() closes a phase and starts the next one; report() gives the
+# per-phase breakdown, including subsystems that were loaded later on first use.
+
+class StartupTimer:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = []
+        self.deferred = []
+        self._last = self.started
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        self.phases.append((phase, now - self._last))
+        self._last = now
+
+    def record(self, name, seconds):
+        self.deferred.append((name, seconds))
+
+    @property
+    def total(self):
+        return self._last - self.started
+
+    def report(self):
+        lines = [f"Startup took {self.total:.3f}s"]
+        lines += [f"  {phase}: {seconds:.3f}s" for phase, seconds in self.phases]
+        if self.deferred:
+            lines.append("Loaded on first use:")
+            lines += [f"  {name}: {seconds:.3f}s" for name, seconds in self.deferred]
+        return "\n".join(lines)
+
+
+class Lazy:
+    # Builds its value on the first get(); thread-safe so a background warm-up can race a request
+
+    def __init__(self, name, factory, timer=None):
+        self.name = name
+        self.factory = factory
+        self.timer = timer
+        self._value = None
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self):
+        return self._loaded
+
+    def get(self):
+        if not self._loaded:
+            with self._lock:
+                if not self._loaded:
+                    started = time.perf_counter()
+                    self._value = self.factory()
+                    self._loaded = True
+                    seconds = time.perf_counter() - started
+                    if self.timer:
+                        self.timer.record(self.name, seconds)
+                    logging.info(f"Loaded {self.name} in {seconds:.3f}s")
+        return self._value
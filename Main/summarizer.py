@@ -0,0 +1,168 @@
+import asyncio
+import json
+import logging
+import traceback
+
+from response_cache import cache_key
+from scheduler import PRIORITY_BACKGROUND
+
+# Folds the old turns of long conversations into a rolling summary.
+#
+# Once a session's history passes compress_at of its token budget, its oldest
+# unpinned turns are condensed by the model, together with the previous summary
+# and any turns trim() had to drop before they could be summarized, into one
+# pinned summary message that takes their place. This is kept off the request
+# path: a session is summarized only after idle_delay seconds without a turn and
+# while no more than max_queue_depth LLM requests are waiting, and the request
+# goes in at PRIORITY_BACKGROUND. Summaries are cached under a hash of the range
+# they cover, so the same turns are never summarized twice.
+
+SUMMARY_PREFIX = "[Summary of the earlier conversation]\n"
+SUMMARY_PROMPT = (
+    "You maintain the running summary of a long conversation between a user and an assistant. "
+    "Merge the previous summary and the transcript that follows it into one concise summary. "
+    "Keep the user's goals, decisions, facts about their system, files and programs mentioned, "
+    "code that was run and its outcome, and anything left to do. Drop pleasantries. "
+    "Reply with the summary only."
+)
+MAX_BLOCK_CHARS = 2000
+
+
+def is_summary(message):
+    return message["role"] == "user" and isinstance(message["content"], str) and message["content"].startswith(SUMMARY_PREFIX)
+
+
+def transcript(messages):
+    # Plain-text rendering of messages, tool calls and results included
+    lines = []
+    for message in messages:
+        content = message["content"]
+        blocks = [{"type": "text", "text": content}] if isinstance(content, str) else content
+        for block in blocks:
+            kind = block.get("type")
+            if kind == "text":
+                text = block["text"]
+            elif kind == "tool_use":
+                text = f"[called {block['name']} with {json.dumps(block.get('input', {}))}]"
+            elif kind == "tool_result":
+                text = f"[tool result: {block.get('content') if isinstance(block.get('content'), str) else json.dumps(block.get('content'))}]"
+            else:
+                continue
+            lines.append(f"{message['role'].capitalize()}: {text[:MAX_BLOCK_CHARS]}")
+    return "\n".join(lines)
+
+
+class ConversationSummarizer:
+    def __init__(self, scheduler, model, max_tokens=512, cache=None, idle_delay=30, max_queue_depth=0,
+                 compress_at=0.75, compress_to=0.5, keep_turns=2):
+        # Sessions provide context (a ContextWindow), turn_lock, aging (messages trim()
+        # dropped that no summary covers yet) and record_usage(usage)
+        self.scheduler = scheduler
+        self.model = model
+        self.max_tokens = max_tokens
+        self.cache = cache
+        self.idle_delay = idle_delay
+        self.max_queue_depth = max_queue_depth
+        self.compress_at = compress_at
+        self.compress_to = compress_to
+        self.keep_turns = keep_turns
+        self.tasks = {}
+        self.working = set()
+        self.summaries = 0
+        self.cached = 0
+        self.failures = 0
+
+    def stats(self):
+        return {
+            "scheduled": len(self.tasks),
+            "summaries": self.summaries,
+            "cached": self.cached,
+            "failures": self.failures
+        }
+
+    def due(self, session):
+        context = session.context
+        return bool(session.aging) or context.total_tokens > context.token_budget * self.compress_at
+
+    def schedule(self, session):
+        # Called after every turn; the idle timer restarts unless a summary is being made
+        task = self.tasks.get(session)
+        if task is not None:
+            if session in self.working:
+                return
+            task.cancel()
+        self.tasks[session] = asyncio.create_task(self._run(session))
+
+    def cancel(self, session):
+        task = self.tasks.pop(session, None)
+        if task is not None:
+            task.cancel()
+
+    async def close(self):
+        tasks = list(self.tasks.values())
+        self.tasks.clear()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def busy(self):
+        return (self.scheduler.queue_depth > self.max_queue_depth
+                or self.scheduler.in_flight >= self.scheduler.max_in_flight)
+
+    async def _run(self, session):
+        try:
+            await asyncio.sleep(self.idle_delay)
+            while self.busy() or session.turn_lock.locked():
+                # A turn that starts meanwhile schedules a new run when it ends
+                await asyncio.sleep(self.idle_delay)
+            if self.due(session):
+                self.working.add(session)
+                await self.summarize(session)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.failures += 1
+            logging.error(f"Failed to summarize the conversation: {str(e)}")
+            logging.debug(traceback.format_exc())
+        finally:
+            self.working.discard(session)
+            if self.tasks.get(session) is asyncio.current_task():
+                del self.tasks[session]
+
+    async def summarize(self, session):
+        context = session.context
+        previous = next((message for message in context.messages if is_summary(message)), None)
+        turns = context.oldest_turns(int(context.token_budget * self.compress_to), self.keep_turns)
+        covered = list(session.aging) + turns
+        if not covered:
+            return False
+        text = SUMMARY_PREFIX + await self.condense(session, previous["content"][len(SUMMARY_PREFIX):] if previous else "", covered)
+        # Applied between turns; turns trimmed meanwhile are covered all the same
+        async with session.turn_lock:
+            ids = {id(message) for message in covered}
+            session.aging = [message for message in session.aging if id(message) not in ids]
+            context.fold(([previous] if previous else []) + turns, {"role": "user", "content": text})
+        logging.info(f"Summarized {len(covered)} messages, {context.total_tokens} tokens remain")
+        return True
+
+    async def condense(self, session, previous, messages):
+        request = f"Previous summary:\n{previous or '(none)'}\n\nTranscript:\n{transcript(messages)}"
+        key = cache_key(self.model, SUMMARY_PROMPT, [request], self.max_tokens)
+        if self.cache:
+            cached = await self.cache.get(key)
+            if cached is not None:
+                self.cached += 1
+                return cached
+        response = await self.scheduler.create(
+            priority=PRIORITY_BACKGROUND,
+            model=self.model,
+            max_tokens=self.max_tokens,
+            system=SUMMARY_PROMPT,
+            messages=[{"role": "user", "content": request}]
+        )
+        session.record_usage(response.usage)
+        summary = "".join(block.text for block in response.content if block.type == "text").strip()
+        self.summaries += 1
+        if self.cache:
+            await self.cache.put(key, summary)
+        return summary
@@ -0,0 +1,120 @@
+import asyncio
+import json
+import logging
+import traceback
+
+# Structured tool use for the assistant's commands.
+#
+# Each entry in capabilities.json becomes a tool definition for the Messages
+# API. Its parameters come from the "usage" string ("name param [optional]"),
+# or from an explicit "input_schema" on the entry. The dispatcher runs every
+# tool call of one assistant turn concurrently, up to max_concurrency at a
+# time, and returns all their results together so they go back to the model in
+# a single follow-up request. Handlers that share state between calls can be
+# registered as exclusive, which makes their calls run one after another, and
+# handlers that produce output as they go can be registered as streaming, which
+# gives them the caller's on_output callback.
+
+MAX_RESULT_CHARS = 20000
+
+
+def usage_parameters(capability):
+    # "launch_program program_name [file_path]" -> [("program_name", True), ("file_path", False)]
+    words = capability.get("usage", "").split()
+    if not words or words[0] != capability["name"]:
+        return []
+    return [(word.strip("[]"), not word.startswith("[")) for word in words[1:]]
+
+
+def build_tool(capability):
+    schema = capability.get("input_schema")
+    if schema is None:
+        parameters = usage_parameters(capability)
+        schema = {
+            "type": "object",
+            "properties": {name: {"type": "string"} for name, _ in parameters},
+            "required": [name for name, required in parameters if required]
+        }
+    return {"name": capability["name"], "description": capability["description"], "input_schema": schema}
+
+
+def build_tools(capabilities):
+    return [build_tool(capability) for capability in capabilities.get("capabilities", [])]
+
+
+def format_result(result):
+    if isinstance(result, str):
+        text = result
+    else:
+        try:
+            text = json.dumps(result, default=str)
+        except (TypeError, ValueError):
+            text = str(result)
+    if len(text) > MAX_RESULT_CHARS:
+        text = text[:MAX_RESULT_CHARS] + f"\n[truncated {len(text) - MAX_RESULT_CHARS} characters]"
+    return text
+
+
+def tool_result(tool_use_id, content, is_error=False):
+    result = {"type": "tool_result", "tool_use_id": tool_use_id, "content": content}
+    if is_error:
+        result["is_error"] = True
+    return result
+
+
+class ToolDispatcher:
+    def __init__(self, max_concurrency=4):
+        self.max_concurrency = max_concurrency
+        self.handlers = {}
+        self.exclusive = {}
+        self.streaming = set()
+        self.calls = 0
+        self.errors = 0
+        self._slots = None
+
+    def register(self, name, handler, exclusive=False, streaming=False):
+        # handler(**input) is a coroutine function returning the result;
+        # streaming handlers also get on_output=
+        self.handlers[name] = handler
+        if exclusive:
+            self.exclusive[name] = asyncio.Lock()
+        if streaming:
+            self.streaming.add(name)
+
+    async def call(self, tool_use, on_output=None):
+        name = tool_use["name"]
+        handler = self.handlers.get(name)
+        if handler is None:
+            self.errors += 1
+            return tool_result(tool_use["id"], f"Unknown tool: {name}", is_error=True)
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_concurrency)
+        lock = self.exclusive.get(name)
+        self.calls += 1
+        try:
+            if lock:
+                # Wait for the tool before taking a slot, so queued calls don't hold slots
+                async with lock:
+                    result = await self._run(handler, tool_use, on_output)
+            else:
+                result = await self._run(handler, tool_use, on_output)
+            logging.info(f"Tool {name} finished")
+            return tool_result(tool_use["id"], format_result(result))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.errors += 1
+            logging.error(f"Tool {name} failed: {str(e)}")
+            logging.debug(traceback.format_exc())
+            return tool_result(tool_use["id"], f"Error: {str(e)}", is_error=True)
+
+    async def _run(self, handler, tool_use, on_output):
+        arguments = dict(tool_use.get("input", {}))
+        if tool_use["name"] in self.streaming:
+            arguments["on_output"] = on_output
+        async with self._slots:
+            return await handler(**arguments)
+
+    async def dispatch(self, tool_uses, on_output=None):
+        # Results come back in the order of the calls, whatever order they finish in
+        return list(await asyncio.gather(*(self.call(tool_use, on_output) for tool_use in tool_uses)))
@@ -0,0 +1,323 @@
+import hashlib
+import importlib.util
+import json
+import logging
+import os
+import threading
+import time
+import traceback
+
+from knowledge_index import tokenize
+
+# Semantic long-term memory: every overall memory entry as a vector.
+#
+# Entries are embedded by a pluggable embedder (anything with `dimensions` and
+# embed(texts) returning unit-length float32 rows); the default hashes words
+# and word pairs into a fixed number of dimensions, so it needs no model and
+# runs on the CPU. The vectors live in one contiguous float32 matrix in a
+# memory-mapped file that grows by doubling, next to a map of (offset, length)
+# pairs into an append-only file of the entries' texts. Cosine similarity is a
+# single matrix product over the unit vectors. Once a store has index_threshold
+# entries, a coarse quantizer (k-means centroids, entries grouped by nearest
+# centroid) limits each search to the nprobe closest groups; it is rebuilt when
+# the store has doubled since. NumPy is optional: without it there is no vector
+# memory and available() is False. It is imported when a store is first opened,
+# so loading this module costs nothing until memory is searched.
+
+VECTORS = 'vectors.f32'
+OFFSETS = 'offsets.u64'
+TEXTS = 'texts.jsonl'
+META = 'meta.json'
+QUANTIZER = 'quantizer.npz'
+
+np = None
+
+
+def available():
+    return importlib.util.find_spec("numpy") is not None
+
+
+def load_numpy():
+    global np
+    if np is None:
+        import numpy
+        np = numpy
+    return np
+
+
+class HashingEmbedder:
+    name = "hashing"
+
+    def __init__(self, dimensions=512):
+        self.dimensions = dimensions
+
+    def _features(self, text):
+        terms = tokenize(text)
+        return terms + [f"{first} {second}" for first, second in zip(terms, terms[1:])]
+
+    def embed(self, texts):
+        load_numpy()
+        matrix = np.zeros((len(texts), self.dimensions), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for feature in self._features(text):
+                digest = int.from_bytes(hashlib.blake2b(feature.encode('utf-8'), digest_size=8).digest(), 'little')
+                # The sign bit keeps colliding features from always adding up
+                matrix[row, digest % self.dimensions] += 1.0 if digest >> 63 else -1.0
+        # Sublinear term frequency, then unit length so a dot product is the cosine
+        np.copysign(np.log1p(np.abs(matrix)), matrix, out=matrix)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return matrix / norms
+
+
+class MemoryHit:
+    def __init__(self, score, entry, text):
+        self.score = score
+        self.entry = entry
+        self.text = text
+
+    def __repr__(self):
+        return f"MemoryHit(score={self.score:.3f}, entry={self.entry})"
+
+
+class VectorMemory:
+    def __init__(self, directory='cache/vectors', embedder=None, load_memory=None, initial_capacity=1024,
+                 index_threshold=50000, nprobe=8):
+        # load_memory() returns every overall memory entry; entries beyond those
+        # already stored are embedded on first use
+        if not available():
+            raise RuntimeError("Vector memory needs numpy")
+        self.directory = directory
+        self.embedder = embedder or HashingEmbedder()
+        self.load_memory = load_memory
+        self.initial_capacity = initial_capacity
+        self.index_threshold = index_threshold
+        self.nprobe = nprobe
+        self.lock = threading.RLock()
+        self.count = None
+        self.vectors = None
+        self.offsets = None
+        self.quantizer = None
+        self.synced = False
+        self.searches = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": self.count or 0,
+                "capacity": 0 if self.vectors is None else len(self.vectors),
+                "quantized": self.quantizer is not None,
+                "searches": self.searches
+            }
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _map(self, capacity):
+        mode = 'r+' if os.path.exists(self._path(VECTORS)) else 'w+'
+        self.vectors = np.memmap(self._path(VECTORS), dtype=np.float32, mode=mode,
+                                 shape=(capacity, self.embedder.dimensions))
+        self.offsets = np.memmap(self._path(OFFSETS), dtype=np.uint64, mode=mode, shape=(capacity, 2))
+
+    def open(self):
+        with self.lock:
+            if self.count is not None:
+                return
+            load_numpy()
+            os.makedirs(self.directory, exist_ok=True)
+            try:
+                with open(self._path(META)) as f:
+                    meta = json.load(f)
+            except FileNotFoundError:
+                meta = None
+            if meta and (meta["embedder"], meta["dimensions"]) != (self.embedder.name, self.embedder.dimensions):
+                # Vectors from another embedder can't be compared with new ones
+                logging.info(f"Rebuilding vector memory for the {self.embedder.name} embedder")
+                for name in (VECTORS, OFFSETS, TEXTS, META, QUANTIZER):
+                    if os.path.exists(self._path(name)):
+                        os.remove(self._path(name))
+                meta = None
+            self.count = meta["count"] if meta else 0
+            self._map(meta["capacity"] if meta else self.initial_capacity)
+            self._load_quantizer()
+
+    def _write_meta(self):
+        meta = {"embedder": self.embedder.name, "dimensions": self.embedder.dimensions,
+                "count": self.count, "capacity": len(self.vectors)}
+        temp_path = self._path(META) + ".tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(meta, f)
+        os.replace(temp_path, self._path(META))
+
+    def _grow(self, needed):
+        capacity = len(self.vectors)
+        if needed <= capacity:
+            return
+        while capacity < needed:
+            capacity *= 2
+        self.vectors.flush()
+        self.offsets.flush()
+        self.vectors = self.offsets = None
+        for name, row_bytes in ((VECTORS, self.embedder.dimensions * 4), (OFFSETS, 16)):
+            with open(self._path(name), 'r+b') as f:
+                f.truncate(capacity * row_bytes)
+        self._map(capacity)
+
+    def add(self, texts):
+        # Appends entries; the count is written last, so a crash leaves at most unused rows
+        if isinstance(texts, str):
+            texts = [texts]
+        if not texts:
+            return
+        with self.lock:
+            self.open()
+            vectors = self.embedder.embed(texts)
+            self._grow(self.count + len(texts))
+            with open(self._path(TEXTS), 'ab') as f:
+                offset = f.tell()
+                for i, text in enumerate(texts):
+                    data = (json.dumps({"text": text, "time": time.time()}) + "\n").encode('utf-8')
+                    f.write(data)
+                    self.offsets[self.count + i] = (offset, len(data))
+                    offset += len(data)
+            self.vectors[self.count:self.count + len(texts)] = vectors
+            if self.quantizer is not None:
+                self._assign(self.count, vectors)
+            self.vectors.flush()
+            self.offsets.flush()
+            self.count += len(texts)
+            self._write_meta()
+            if self.count >= self.index_threshold and (self.quantizer is None or self.count >= 2 * self.quantizer["built_at"]):
+                self.build_quantizer()
+
+    def sync(self):
+        # Embeds memory entries written before the store existed or while it was closed
+        with self.lock:
+            self.open()
+            if self.synced or self.load_memory is None:
+                return
+            try:
+                entries = self.load_memory()
+            except Exception as e:
+                logging.error(f"Failed to load memory for the vector store: {str(e)}")
+                logging.debug(traceback.format_exc())
+                return
+            missing = entries[self.count:]
+            for start in range(0, len(missing), 256):
+                self.add([str(entry) for entry in missing[start:start + 256]])
+            self.synced = True
+
+    def add_memory(self, entry):
+        # Entries written before the first sync are picked up from load_memory instead
+        with self.lock:
+            if self.synced:
+                self.add(entry)
+
+    def text(self, entry):
+        offset, length = (int(value) for value in self.offsets[entry])
+        with open(self._path(TEXTS), 'rb') as f:
+            f.seek(offset)
+            return json.loads(f.read(length).decode('utf-8'))["text"]
+
+    def search(self, query, k=5, min_score=0.0):
+        return self.search_batch([query], k, min_score)[0]
+
+    def search_batch(self, queries, k=5, min_score=0.0):
+        # One list of hits per query, best first
+        with self.lock:
+            self.sync()
+            self.searches += len(queries)
+            if not self.count:
+                return [[] for _ in queries]
+            query_vectors = self.embedder.embed(queries)
+            results = []
+            for query_vector, (rows, scores) in zip(query_vectors, self._score(query_vectors)):
+                top = min(k, len(scores))
+                best = np.argpartition(-scores, top - 1)[:top]
+                best = best[np.argsort(-scores[best])]
+                results.append([MemoryHit(float(scores[i]), int(rows[i]), self.text(int(rows[i])))
+                                for i in best if scores[i] > min_score])
+            return results
+
+    def _score(self, query_vectors):
+        # (rows, cosine scores) for each query
+        matrix = self.vectors[:self.count]
+        if self.quantizer is None:
+            scores = query_vectors @ matrix.T
+            rows = np.arange(self.count)
+            return [(rows, row_scores) for row_scores in scores]
+        centroids = self.quantizer["centroids"]
+        assignments = self.quantizer["assignments"][:self.count]
+        nprobe = min(self.nprobe, len(centroids))
+        probes = np.argpartition(-(query_vectors @ centroids.T), nprobe - 1, axis=1)[:, :nprobe]
+        results = []
+        for query_vector, probe in zip(query_vectors, probes):
+            rows = np.flatnonzero(np.isin(assignments, probe))
+            results.append((rows, matrix[rows] @ query_vector))
+        return results
+
+    def build_quantizer(self, iterations=8, sample_size=20000):
+        # k-means over a sample, with about sqrt(n) centroids
+        with self.lock:
+            started = time.monotonic()
+            matrix = self.vectors[:self.count]
+            clusters = max(1, int(np.sqrt(self.count)))
+            generator = np.random.default_rng(0)
+            sample = matrix[np.sort(generator.choice(self.count, min(sample_size, self.count), replace=False))]
+            centroids = sample[generator.choice(len(sample), clusters, replace=False)].copy()
+            for _ in range(iterations):
+                nearest = np.argmax(sample @ centroids.T, axis=1)
+                for cluster in range(clusters):
+                    members = sample[nearest == cluster]
+                    if len(members):
+                        centroid = members.mean(axis=0)
+                        norm = np.linalg.norm(centroid)
+                        if norm:
+                            centroids[cluster] = centroid / norm
+            assignments = np.empty(len(self.vectors), dtype=np.int32)
+            for start in range(0, self.count, 65536):
+                block = matrix[start:start + 65536]
+                assignments[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+            self.quantizer = {"centroids": centroids, "assignments": assignments, "built_at": self.count}
+            np.savez(self._path(QUANTIZER), centroids=centroids, assignments=assignments[:self.count],
+                     built_at=self.count)
+            logging.info(f"Built a {clusters}-cluster quantizer over {self.count} memory vectors "
+                         f"in {time.monotonic() - started:.2f}s")
+
+    def _assign(self, start, vectors):
+        assignments = self.quantizer["assignments"]
+        if len(assignments) < start + len(vectors):
+            grown = np.empty(max(len(assignments) * 2, start + len(vectors)), dtype=np.int32)
+            grown[:len(assignments)] = assignments
+            self.quantizer["assignments"] = assignments = grown
+        assignments[start:start + len(vectors)] = np.argmax(vectors @ self.quantizer["centroids"].T, axis=1)
+
+    def _load_quantizer(self):
+        # Entries added after the quantizer was saved are assigned again here
+        path = self._path(QUANTIZER)
+        if not os.path.exists(path):
+            return
+        try:
+            with np.load(path) as saved:
+                centroids = saved["centroids"]
+                built = saved["assignments"]
+                built_at = int(saved["built_at"])
+        except (OSError, ValueError, KeyError) as e:
+            logging.error(f"Ignoring the saved memory quantizer: {str(e)}")
+            return
+        if centroids.shape[1] != self.embedder.dimensions:
+            return
+        assignments = np.empty(len(self.vectors), dtype=np.int32)
+        known = min(len(built), self.count)
+        assignments[:known] = built[:known]
+        self.quantizer = {"centroids": centroids, "assignments": assignments, "built_at": built_at}
+        if known < self.count:
+            self._assign(known, np.asarray(self.vectors[known:self.count]))
+
+    def close(self):
+        with self.lock:
+            if self.vectors is not None:
+                self.vectors.flush()
+                self.offsets.flush()
+                self.vectors = self.offsets = None
+            self.count = None
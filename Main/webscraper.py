@@ -1,67 +1,190 @@
 import os
+import sys
 import json
-from selenium import webdriver
-from selenium.webdriver.chrome.service import Service
-from webdriver_manager.chrome import ChromeDriverManager
-from bs4 import BeautifulSoup
-from urllib.parse import urlparse
+from html.parser import HTMLParser
+from urllib.parse import urljoin, urlparse, urlunparse, parse_qsl, urlencode
 from datetime import datetime
 
-# Create the knowledge directory if it doesn't exist
-if not os.path.exists("knowledge"):
-    os.makedirs("knowledge")
+from browser_pool import BrowserPool
 
-def scrape_website(domain, subdomain=None):
+def normalize_domain(domain):
     # Ensure the domain starts with http:// or https://
     if not domain.startswith('http://') and not domain.startswith('https://'):
         domain = 'http://' + domain
+    return domain
 
-    # Set up Selenium WebDriver
-    service = Service(ChromeDriverManager().install())
-    options = webdriver.ChromeOptions()
-    options.add_argument('--headless')
-    driver = webdriver.Chrome(service=service, options=options)
+DEFAULT_PORTS = {'http': 80, 'https': 443}
 
-    # Start scraping
-    url = domain
-    driver.get(url)
-    page_source = driver.page_source
-    soup = BeautifulSoup(page_source, 'html.parser')
+def normalize_url(url, base=None):
+    # Absolute form used to tell pages apart: lower-case scheme and host, no
+    # default port, no fragment, sorted query. None for links that aren't web pages.
+    if base:
+        url = urljoin(base, url)
+    parsed = urlparse(url.strip())
+    scheme = parsed.scheme.lower()
+    if scheme not in DEFAULT_PORTS or not parsed.hostname:
+        return None
+    host = parsed.hostname.lower()
+    try:
+        port = parsed.port
+    except ValueError:
+        return None
+    netloc = host if port in (None, DEFAULT_PORTS[scheme]) else f"{host}:{port}"
+    query = urlencode(sorted(parse_qsl(parsed.query, keep_blank_values=True)))
+    # Joining to the root also resolves . and .. segments
+    return urlunparse((scheme, netloc, urljoin('/', parsed.path), parsed.params, query, ''))
 
-    # Extract all links
-    links = soup.find_all('a', href=True)
+class PageParser(HTMLParser):
+    # One pass over the HTML for its links and for what tells a static page from
+    # a script-rendered one: visible text, script tags, app root elements and
+    # <noscript> pleas to enable JavaScript
+    HIDDEN = {'script', 'style', 'noscript', 'template'}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.links = []
+        self.text_chars = 0
+        self.scripts = 0
+        self.ids = set()
+        self.noscript_warning = False
+        self.title = ""
+        self.text_parts = []
+        self.hidden = []
+        self.in_title = False
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'a':
+            href = dict(attrs).get('href')
+            if href:
+                self.links.append(href)
+        elif tag == 'script':
+            self.scripts += 1
+        elif tag == 'title':
+            self.in_title = True
+        elif tag == 'div':
+            element_id = dict(attrs).get('id')
+            if element_id:
+                self.ids.add(element_id)
+        if tag in self.HIDDEN:
+            self.hidden.append(tag)
+
+    def handle_endtag(self, tag):
+        if tag == 'title':
+            self.in_title = False
+        if tag in self.hidden:
+            while self.hidden.pop() != tag:
+                pass
+
+    def handle_data(self, data):
+        if not self.hidden:
+            text = data.strip()
+            if self.in_title:
+                self.title += text
+            elif text:
+                self.text_chars += len(text)
+                self.text_parts.append(text)
+        elif self.hidden[-1] == 'noscript' and 'javascript' in data.lower():
+            self.noscript_warning = True
+
+    def text(self):
+        return " ".join(self.text_parts)
+
+    def snapshot(self):
+        # What the fetch cache keeps instead of the HTML
+        return {
+            "title": self.title,
+            "links": self.links,
+            "text": self.text(),
+            "text_chars": self.text_chars,
+            "scripts": self.scripts,
+            "ids": sorted(self.ids),
+            "noscript_warning": self.noscript_warning
+        }
+
+    @classmethod
+    def restore(cls, snapshot):
+        page = cls()
+        page.title = snapshot["title"]
+        page.links = list(snapshot["links"])
+        page.text_parts = [snapshot["text"]] if snapshot["text"] else []
+        page.text_chars = snapshot["text_chars"]
+        page.scripts = snapshot["scripts"]
+        page.ids = set(snapshot["ids"])
+        page.noscript_warning = snapshot["noscript_warning"]
+        return page
+
+def parse_page(page_source):
+    parser = PageParser()
+    parser.feed(page_source)
+    parser.close()
+    return parser
+
+def extract_links(page, domain, subdomain=None):
+    # page is the PageParser of the page's HTML; links are resolved against domain
     resources = []
-    for link in links:
-        href = link['href']
-        if subdomain and not href.startswith(subdomain):
+    for href in page.links:
+        url = urljoin(domain, href)
+        if subdomain and not (href.startswith(subdomain) or url.startswith(subdomain)):
             continue
-        if href.startswith('/'):
-            href = domain + href
-        resources.append(href)
+        resources.append(url)
+    return resources
+
+def knowledge_path(domain, extension="json", unique=False):
+    # Create the knowledge directory if it doesn't exist
+    if not os.path.exists("knowledge"):
+        os.makedirs("knowledge")
 
     # Generate a filename based on the domain and date
     parsed_url = urlparse(domain)
-    base_domain = parsed_url.netloc.replace('.', '_')
+    base_domain = parsed_url.netloc.replace('.', '_').replace(':', '_')
     date_str = datetime.now().strftime("%d_%m_%Y")
     
-    if parsed_url.path:
+    if parsed_url.path.strip('/'):
         path_part = parsed_url.path.strip('/').replace('/', '_')
-        filename = f"{base_domain}_{path_part}_{date_str}.json"
+        filename = f"{base_domain}_{path_part}_{date_str}.{extension}"
     else:
-        filename = f"{base_domain}_{date_str}.json"
+        filename = f"{base_domain}_{date_str}.{extension}"
     
     filepath = os.path.join("knowledge", filename)
+    if unique:
+        # Another scrape of the same page on the same day gets its own file
+        stem = filepath[:-len(extension) - 1]
+        counter = 2
+        while os.path.exists(filepath):
+            filepath = f"{stem}_{counter}.{extension}"
+            counter += 1
+    return filepath
+
+def save_links(domain, resources):
+    filepath = knowledge_path(domain)
+    if os.path.exists(filepath):
+        try:
+            with open(filepath) as f:
+                if json.load(f) == resources:
+                    # Nothing changed since the last scrape today
+                    return filepath
+        except (OSError, ValueError):
+            pass
+        filepath = knowledge_path(domain, unique=True)
 
     # Save to JSON
     with open(filepath, 'w') as f:
         json.dump(resources, f, indent=4)
-
-    driver.quit()
     return filepath
 
+def scrape_website(domain, subdomain, browsers):
+    # Loads the page with a browser from the pool
+    domain = normalize_domain(domain)
+    page_source = browsers.load(domain)
+    return save_links(domain, extract_links(parse_page(page_source), domain, subdomain))
+
 # Example usage
 if __name__ == "__main__":
-    # This part is for testing the function standalone
-    domain = "http://example.com"
-    subdomain = None
-    scrape_website(domain, subdomain)
+    # Standalone: webscraper.py domain [subdomain]
+    domain = sys.argv[1] if len(sys.argv) > 1 else "http://example.com"
+    subdomain = sys.argv[2] if len(sys.argv) > 2 else None
+    browsers = BrowserPool(size=1)
+    try:
+        print(scrape_website(domain, subdomain, browsers))
+    finally:
+        browsers.close()
@@ -0,0 +1,77 @@
+import asyncio
+import json
+
+from chat_journal import ChatJournal, replay
+
+
+def message(role, text):
+    return {"role": role, "content": text}
+
+
+def test_replay_applies_operations_in_order():
+    records = [
+        {"op": "append", "message": message("user", "a"), "pinned": True},
+        {"op": "append", "message": message("assistant", "b")},
+        {"op": "append", "message": message("user", "c")},
+        {"op": "drop", "indices": [1]},
+        {"op": "pin", "index": 1},
+    ]
+    assert replay(records) == ([message("user", "a"), message("user", "c")], [True, True])
+
+
+def test_replay_restarts_from_snapshot():
+    records = [
+        {"op": "append", "message": message("user", "old")},
+        {"op": "snapshot", "messages": [message("user", "kept")], "pinned": [True]},
+        {"op": "append", "message": message("assistant", "new")},
+    ]
+    assert replay(records) == ([message("user", "kept"), message("assistant", "new")], [True, False])
+
+
+def test_torn_last_line_is_skipped(tmp_path):
+    journal = ChatJournal(directory=str(tmp_path))
+    with open(journal.path("chat"), 'w', encoding='utf-8') as f:
+        f.write(json.dumps({"op": "append", "message": message("user", "hello")}) + "\n")
+        f.write('{"op": "append", "message": {"role": "assist')
+    assert journal.load("chat") == ([message("user", "hello")], [False])
+
+
+def test_records_after_a_torn_line_are_kept(tmp_path):
+    async def scenario():
+        journal = ChatJournal(directory=str(tmp_path), flush_interval=0)
+        with open(journal.path("chat"), 'w', encoding='utf-8') as f:
+            f.write(json.dumps({"op": "append", "message": message("user", "hello")}) + "\n")
+            f.write('{"op": "app')
+        journal.record("chat", "append", message=message("assistant", "hi"), pinned=False)
+        await journal.close()
+        return await ChatJournal(directory=str(tmp_path)).load_async("chat")
+
+    assert asyncio.run(scenario()) == ([message("user", "hello"), message("assistant", "hi")], [False, False])
+
+
+def test_compaction_rewrites_the_log_as_one_snapshot(tmp_path):
+    async def scenario():
+        journal = ChatJournal(directory=str(tmp_path))
+        for i in range(5):
+            journal.record("chat", "append", message=message("user", str(i)), pinned=False)
+        await journal.flush()
+        journal.compact("chat", [message("user", "4")], [True])
+        await journal.close()
+        with open(journal.path("chat"), encoding='utf-8') as f:
+            lines = f.read().splitlines()
+        return lines, await ChatJournal(directory=str(tmp_path)).load_async("chat")
+
+    lines, loaded = asyncio.run(scenario())
+    assert [json.loads(line)["op"] for line in lines] == ["snapshot"]
+    assert loaded == ([message("user", "4")], [True])
+
+
+def test_pending_records_are_loaded(tmp_path):
+    async def scenario():
+        journal = ChatJournal(directory=str(tmp_path), flush_interval=60)
+        journal.record("chat", "append", message=message("user", "unwritten"), pinned=False)
+        loaded = await journal.load_async("chat")
+        await journal.close()
+        return loaded
+
+    assert asyncio.run(scenario()) == ([message("user", "unwritten")], [False])
@@ -0,0 +1,138 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+from env_cache import EnvironmentCache, environment_key, normalize_requirements
+from job_runner import JobResult
+
+PACKAGE_BYTES = 4096
+
+
+class StubManager:
+    def __init__(self, env_dir):
+        self.env_dir = env_dir
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class StubRunner:
+    # Stands in for JobRunner: "venv" makes the directory layout, "pip install"
+    # writes one file per package, the same bytes for the same package
+    def __init__(self, failing=()):
+        self.failing = set(failing)
+        self.calls = []
+
+    async def run(self, argv, timeout=None, name=None):
+        self.calls.append(argv)
+        if name == "venv":
+            os.makedirs(site_packages(argv[-1]))
+            return JobResult(0, "", "", 0.0)
+        env_dir = os.path.dirname(os.path.dirname(os.path.abspath(argv[0])))
+        packages = [arg for arg in argv[argv.index('--disable-pip-version-check') + 1:] if not arg.startswith('-')]
+        for package in packages:
+            if package in self.failing:
+                return JobResult(1, "", f"No matching distribution found for {package}", 0.0)
+            with open(os.path.join(site_packages(env_dir), f"{package}.py"), 'wb') as f:
+                f.write(package.encode('utf-8').ljust(PACKAGE_BYTES, b"#"))
+        return JobResult(0, "", "", 0.0)
+
+
+def site_packages(env_dir):
+    return os.path.join(env_dir, 'lib', 'site-packages')
+
+
+def make_cache(tmp_path, runner=None, **kwargs):
+    return EnvironmentCache(StubManager, runner or StubRunner(), directory=str(tmp_path / "venvs"), **kwargs)
+
+
+async def lease(cache, packages):
+    async with cache.lease(packages) as manager:
+        return manager
+
+
+def test_requirements_are_normalized():
+    assert normalize_requirements(["Requests ", "numpy>=1.0", "requests", ""]) == ["numpy>=1.0", "requests"]
+    assert normalize_requirements(["Foo_Bar.baz == 2"]) == ["foo-bar-baz==2"]
+    assert environment_key(["a", "b"]) != environment_key(["a"])
+    with pytest.raises(ValueError):
+        normalize_requirements(["--index-url=http://evil"])
+
+
+def test_same_package_set_reuses_the_environment(tmp_path):
+    runner = StubRunner()
+    cache = make_cache(tmp_path, runner, share_files=False)
+
+    async def scenario():
+        first = await lease(cache, ["Requests", "numpy"])
+        second = await lease(cache, ["numpy", "requests"])
+        other = await lease(cache, ["numpy"])
+        return first, second, other
+    first, second, other = asyncio.run(scenario())
+    assert first is second
+    assert other is not first
+    assert (cache.builds, cache.hits) == (2, 1)
+    assert len([call for call in runner.calls if "pip" in call]) == 2
+    # A new cache finds the finished environment on disk
+    assert make_cache(tmp_path).existing(["requests", "numpy"]).env_dir == first.env_dir
+
+
+def test_installed_files_are_hard_linked_once(tmp_path):
+    cache = make_cache(tmp_path)
+
+    async def scenario():
+        return await lease(cache, ["requests", "numpy"]), await lease(cache, ["requests"])
+    both, single = asyncio.run(scenario())
+    shared = os.path.join(site_packages(single.env_dir), "requests.py")
+    assert os.stat(shared).st_nlink == 3
+    assert os.path.samefile(shared, os.path.join(site_packages(both.env_dir), "requests.py"))
+    assert cache.shared_bytes == PACKAGE_BYTES
+    # The shared file is counted once
+    assert cache.disk_usage() < 4 * PACKAGE_BYTES + 2048
+
+
+def test_least_recently_used_environments_are_evicted(tmp_path):
+    cache = make_cache(tmp_path, max_bytes=10 * PACKAGE_BYTES)
+
+    async def scenario():
+        managers = {}
+        for name in ("alpha", "bravo", "charlie"):
+            managers[name] = await lease(cache, [name])
+            # Markers are compared by mtime
+            os.utime(os.path.join(managers[name].env_dir, "dantalion-env.json"), (len(managers), len(managers)))
+        async with cache.lease(["alpha"]):
+            cache.max_bytes = 2 * PACKAGE_BYTES
+            await cache.enforce_budget()
+        return managers
+    managers = asyncio.run(scenario())
+    # alpha is the oldest but is leased; the others go, least recently used first
+    assert os.path.exists(managers["alpha"].env_dir)
+    assert not os.path.exists(managers["bravo"].env_dir)
+    assert not os.path.exists(managers["charlie"].env_dir)
+    assert managers["bravo"].closed and managers["charlie"].closed
+    assert cache.evictions == 2
+    # Objects only the evicted environments linked to are gone as well
+    objects = [name for _, _, names in os.walk(os.path.join(cache.directory, ".objects")) for name in names]
+    assert len(objects) == 1
+    assert sorted(os.listdir(cache.directory)) == sorted([".objects", os.path.basename(managers["alpha"].env_dir)])
+
+
+def test_failed_install_leaves_nothing_behind(tmp_path):
+    cache = make_cache(tmp_path, StubRunner(failing=["missing"]))
+    with pytest.raises(RuntimeError, match="missing"):
+        asyncio.run(lease(cache, ["missing"]))
+    assert os.listdir(cache.directory) == []
+    assert cache.builds == 0
+
+
+def test_offline_installs_use_the_wheelhouse(tmp_path):
+    runner = StubRunner()
+    cache = make_cache(tmp_path, runner, wheelhouse=str(tmp_path / "wheels"), offline=True)
+    asyncio.run(lease(cache, ["requests"]))
+    pip = next(call for call in runner.calls if 'pip' in call)
+    assert pip[0] != sys.executable
+    assert pip[pip.index('--find-links') + 1] == str(tmp_path / "wheels")
+    assert '--no-index' in pip
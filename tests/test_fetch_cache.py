@@ -0,0 +1,54 @@
+import os
+import time
+
+from fetch_cache import FetchCache
+
+
+def page_files(directory):
+    return sorted(name for _, _, names in os.walk(os.path.join(directory, "pages")) for name in names)
+
+
+def test_entries_survive_a_reload(tmp_path):
+    cache = FetchCache(str(tmp_path))
+    cache.update("https://a.example", hash="1", page="aa11", checked=time.time())
+    cache.update("https://b.example", hash="2", page="bb22", checked=time.time())
+    cache.update("https://a.example", etag='"v2"')
+    reloaded = FetchCache(str(tmp_path))
+    assert reloaded.lookup("https://a.example")["etag"] == '"v2"'
+    assert reloaded.lookup("https://a.example")["page"] == "aa11"
+    assert list(reloaded.entries) == ["https://b.example", "https://a.example"]
+
+
+def test_least_recently_updated_entries_are_evicted(tmp_path):
+    cache = FetchCache(str(tmp_path), max_entries=2)
+    for url in ("https://a.example", "https://b.example"):
+        cache.update(url, checked=time.time())
+    cache.update("https://a.example", checked=time.time())
+    cache.update("https://c.example", checked=time.time())
+    assert cache.lookup("https://b.example") is None
+    assert sorted(cache.entries) == ["https://a.example", "https://c.example"]
+    assert cache.evicted == 1
+    assert FetchCache(str(tmp_path), max_entries=2).lookup("https://b.example") is None
+
+
+def test_old_entries_are_dropped_on_load(tmp_path):
+    cache = FetchCache(str(tmp_path))
+    cache.update("https://old.example", checked=time.time() - 7200)
+    cache.update("https://new.example", checked=time.time())
+    reloaded = FetchCache(str(tmp_path), max_age=3600)
+    assert reloaded.lookup("https://old.example") is None
+    assert reloaded.lookup("https://new.example") is not None
+
+
+def test_compaction_removes_unreferenced_pages(tmp_path):
+    cache = FetchCache(str(tmp_path), compact_slack=0, max_entries=1)
+    cache.store_page("aa11", {"title": "A"})
+    cache.update("https://a.example", page="aa11", checked=time.time())
+    # Stored but not indexed yet, as between PageFetcher.remember's two steps
+    cache.store_page("cc33", {"title": "C"})
+    cache.store_page("bb22", {"title": "B"})
+    cache.update("https://b.example", page="bb22", checked=time.time())
+    assert page_files(str(tmp_path)) == ["bb22.json", "cc33.json"]
+    assert cache.load_page("bb22") == {"title": "B"}
+    with open(os.path.join(str(tmp_path), "index.jsonl")) as f:
+        assert len(f.readlines()) == 1
@@ -0,0 +1,118 @@
+import json
+import os
+
+from knowledge_index import KnowledgeIndex, Segment, BufferSegment, tokenize, write_segment
+
+
+def segment_files(directory):
+    return sorted(f for f in os.listdir(directory) if f.endswith('.idx'))
+
+
+def make_index(tmp_path, **kwargs):
+    knowledge = tmp_path / "knowledge"
+    knowledge.mkdir(exist_ok=True)
+    return KnowledgeIndex(directory=str(tmp_path / "index"), knowledge_dir=str(knowledge), **kwargs)
+
+
+def test_written_segment_matches_buffer(tmp_path):
+    buffer = BufferSegment()
+    for source, text in [("a", "python packaging with pip"), ("b", "virtual environments for python"), ("c", "chrome headless")]:
+        buffer.add(source, text, tokenize(text))
+    path = str(tmp_path / "segment.idx")
+    write_segment(path, [buffer])
+    segment = Segment(path)
+    assert segment.passage_count == 3
+    assert segment.total_length == buffer.total_length
+    assert [segment.passage(i) for i in range(3)] == [buffer.passage(i) for i in range(3)]
+    assert dict(segment.terms()) == {key: entries for key, entries in buffer.terms()}
+    segment.close()
+
+
+def test_search_ranks_matching_passages(tmp_path):
+    index = make_index(tmp_path)
+    index.open()
+    index.add("pip.md", "pip installs python packages from the package index")
+    index.add("chrome.md", "chrome renders pages that need javascript")
+    index.add("venv.md", "python virtual environments keep packages apart")
+    hits = index.search("install python packages")
+    assert [hit.source for hit in hits][:2] == ["pip.md", "venv.md"]
+    assert index.search("nothing matches this") == []
+    index.close()
+
+
+def test_segments_are_merged(tmp_path):
+    index = make_index(tmp_path, buffer_passages=1, max_segments=2)
+    index.open()
+    for i in range(3):
+        index.add(f"note-{i}", f"note number{i} about scraping")
+        index.flush()
+    assert len(index.segments) == 1
+    assert len(segment_files(index.directory)) == 1
+    assert index.segments[0].passage_count == 3
+    assert [hit.source for hit in index.search("number1")] == ["note-1"]
+    index.close()
+
+
+def test_reopened_index_keeps_passages_and_progress(tmp_path):
+    memory = ["user likes pytest", "server listens on port 9999"]
+    (tmp_path / "knowledge").mkdir()
+    (tmp_path / "knowledge" / "notes.txt").write_text("selenium drives the browser pool")
+    with open(tmp_path / "knowledge" / "crawl.jsonl", 'w') as f:
+        f.write(json.dumps({"url": "https://example.com", "title": "Example", "text": "example domain"}) + "\n")
+        f.write('{"url": "https://example.com/partial"')
+    index = make_index(tmp_path, load_memory=lambda: memory)
+    index.refresh(force=True)
+    index.close()
+
+    reopened = make_index(tmp_path, load_memory=lambda: memory)
+    reopened.open()
+    assert reopened.memory_count == 2
+    assert reopened.sources[str(tmp_path / "knowledge" / "notes.txt")] > 0
+    assert [hit.source for hit in reopened.search("pytest")] == ["memory #1"]
+    assert [hit.source for hit in reopened.search("browser pool")] == [str(tmp_path / "knowledge" / "notes.txt")]
+    assert [hit.source for hit in reopened.search("example domain")] == ["https://example.com"]
+
+    # Only what was added since is indexed again
+    memory.append("chat journal compaction")
+    reopened.add_memory(memory[-1])
+    with open(tmp_path / "knowledge" / "crawl.jsonl", 'a') as f:
+        f.write(', "text": "partial page"}\n')
+    reopened.refresh(force=True)
+    assert [hit.source for hit in reopened.search("compaction")] == ["memory #3"]
+    assert [hit.source for hit in reopened.search("partial page")] == ["https://example.com/partial"]
+    assert len(reopened.search("selenium")) == 1
+    reopened.close()
+
+
+def test_memory_added_after_sync_is_searchable(tmp_path):
+    index = make_index(tmp_path, load_memory=lambda: [])
+    index.refresh(force=True)
+    index.add_memory("the summarizer folds old turns")
+    assert [hit.source for hit in index.search("summarizer")] == ["memory #1"]
+    index.close()
+
+
+def test_unreadable_file_is_retried(tmp_path, monkeypatch):
+    index = make_index(tmp_path)
+    (tmp_path / "knowledge" / "notes.txt").write_text("retried later")
+    real_scandir = os.scandir
+
+    class Entry:
+        def __init__(self, entry):
+            self.entry = entry
+            self.name = entry.name
+            self.path = entry.path
+
+        def is_file(self):
+            return True
+
+        def stat(self):
+            raise PermissionError("denied")
+
+    monkeypatch.setattr(os, "scandir", lambda path: [Entry(entry) for entry in real_scandir(path)])
+    index.refresh(force=True)
+    assert index.sources == {}
+    monkeypatch.setattr(os, "scandir", real_scandir)
+    index.refresh(force=True)
+    assert [hit.source for hit in index.search("retried")] == [str(tmp_path / "knowledge" / "notes.txt")]
+    index.close()
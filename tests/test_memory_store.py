@@ -0,0 +1,96 @@
+import os
+
+import pytest
+
+from memory_store import MemoryStore, SegmentedLog
+
+
+def segment_files(directory, name):
+    return sorted(f for f in os.listdir(directory) if f.startswith(name) and f.endswith('.seg'))
+
+
+def test_records_roll_over_into_new_segments(tmp_path):
+    log = SegmentedLog(str(tmp_path), "log", max_segment_bytes=4096, index_capacity=8, initial_segment_bytes=1024)
+    numbers = [log.append(f"record {i} " + "x" * 100) for i in range(30)]
+    assert numbers == list(range(30))
+    assert len(log.segments) > 1
+    assert [segment.first_record for _, segment in log.segments] == [8 * i for i in range(len(log.segments))]
+    assert log.get(17) == "record 17 " + "x" * 100
+    assert log.tail(2) == [f"record {i} " + "x" * 100 for i in (28, 29)]
+    log.close()
+
+
+def test_oversized_record_gets_its_own_segment(tmp_path):
+    log = SegmentedLog(str(tmp_path), "log", max_segment_bytes=2048, index_capacity=8, initial_segment_bytes=1024)
+    log.append("small")
+    big = "y" * 10000
+    assert log.append(big) == 1
+    assert log.get(1) == big
+    assert log.records() == ["small", big]
+    log.close()
+
+
+def test_reload_from_manifest(tmp_path):
+    log = SegmentedLog(str(tmp_path), "log", max_segment_bytes=2048, index_capacity=4, initial_segment_bytes=1024)
+    for i in range(10):
+        log.append(f"entry {i}")
+    log.flush()
+    log.close()
+    reopened = SegmentedLog(str(tmp_path), "log", max_segment_bytes=2048, index_capacity=4, initial_segment_bytes=1024)
+    assert len(reopened) == 10
+    assert reopened.records() == [f"entry {i}" for i in range(10)]
+    assert reopened.append("entry 10") == 10
+    reopened.close()
+
+
+def test_damaged_manifest_is_rejected(tmp_path):
+    SegmentedLog(str(tmp_path), "log").close()
+    with open(tmp_path / "log.manifest", 'r+b') as f:
+        f.write(b"NOTMAGIC")
+    with pytest.raises(ValueError):
+        SegmentedLog(str(tmp_path), "log")
+
+
+def test_compaction_shrinks_sealed_segments(tmp_path):
+    log = SegmentedLog(str(tmp_path), "log", max_segment_bytes=64 * 1024, index_capacity=4, initial_segment_bytes=16 * 1024)
+    for i in range(9):
+        log.append(f"entry {i}")
+    sealed = log.segments[0][1]
+    assert sealed.size == 16 * 1024
+    assert log.compact() == 0
+    assert sealed.size == sealed.data_end
+    assert log.records() == [f"entry {i}" for i in range(9)]
+    log.close()
+
+
+def test_compaction_drops_segments_past_retention(tmp_path):
+    log = SegmentedLog(str(tmp_path), "log", index_capacity=4, initial_segment_bytes=1024, keep_last=1)
+    for i in range(10):
+        log.append(f"version {i}")
+    assert log.compact() == 2
+    assert segment_files(str(tmp_path), "log") == ["log_00000002.seg"]
+    assert log.first_record == 8
+    assert log.tail(1) == ["version 9"]
+    with pytest.raises(IndexError):
+        log.get(0)
+    log.close()
+    reopened = SegmentedLog(str(tmp_path), "log", index_capacity=4, initial_segment_bytes=1024)
+    assert reopened.records() == ["version 8", "version 9"]
+    reopened.close()
+
+
+def test_memory_store_interface(tmp_path):
+    store = MemoryStore(directory=str(tmp_path), compaction_interval=0)
+    store.UpdateOverallMemory("first")
+    store.UpdateOverallMemory("second")
+    chat = store.CreateChatMemory()
+    store.UpdateChatMemory(chat, "draft")
+    store.UpdateChatMemory(chat, "final")
+    assert store.LoadOverallMemory() == ["first", "second"]
+    assert store.RecentOverallMemory(1) == ["second"]
+    assert store.LoadChatMemory(chat) == "final"
+    store.close()
+    reopened = MemoryStore(directory=str(tmp_path), compaction_interval=0)
+    assert reopened.LoadOverallMemory() == ["first", "second"]
+    assert reopened.LoadChatMemory(chat) == "final"
+    reopened.close()
@@ -0,0 +1,143 @@
+import asyncio
+import functools
+import http.server
+import json
+import threading
+
+import pytest
+
+from crawler import Crawler
+from page_fetcher import PageFetcher, needs_rendering
+from webscraper import parse_page
+
+STATIC_TEXT = "<p>" + "Plain documentation text. " * 20 + "</p>"
+APP_SHELL = '<html><body><div id="root"></div><script src="/app.js"></script></body></html>'
+
+
+def page(*links, text=STATIC_TEXT):
+    anchors = "".join(f'<a href="{link}">{link}</a>' for link in links)
+    return f"<html><head><title>Test</title></head><body>{text}{anchors}</body></html>"
+
+
+class StubBrowsers:
+    # Stands in for BrowserPool; "renders" a page by returning canned HTML
+    def __init__(self, html):
+        self.html = html
+        self.loads = []
+
+    async def load_async(self, url, timeout=None):
+        self.loads.append(url)
+        return self.html
+
+
+@pytest.fixture
+def site(tmp_path):
+    root = tmp_path / "site"
+    root.mkdir()
+    handler = functools.partial(QuietHandler, directory=str(root))
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield root, f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def fetch(fetcher, url, render=False):
+    async def scenario():
+        try:
+            return await fetcher.fetch(url, render)
+        finally:
+            await fetcher.close()
+    return asyncio.run(scenario())
+
+
+def test_needs_rendering():
+    assert not needs_rendering(parse_page(page("/a")))
+    assert needs_rendering(parse_page(APP_SHELL))
+    assert needs_rendering(parse_page('<html><body><noscript>Please enable JavaScript</noscript></body></html>'))
+    assert not needs_rendering(parse_page('<html><body><p>Short page</p><a href="/next">next</a></body></html>'))
+
+
+def test_static_page_is_fetched_over_http(site):
+    root, base = site
+    (root / "index.html").write_text(page("/a.html", "b.html"))
+    browsers = StubBrowsers(page())
+    result = fetch(PageFetcher(browsers), f"{base}/index.html")
+    assert not result.rendered
+    assert result.parsed.title == "Test"
+    assert set(result.parsed.links) == {"/a.html", "b.html"}
+    assert browsers.loads == []
+
+
+def test_app_shell_falls_back_to_the_browser(site):
+    root, base = site
+    (root / "app.html").write_text(APP_SHELL)
+    browsers = StubBrowsers(page("/rendered.html"))
+    fetcher = PageFetcher(browsers)
+    result = fetch(fetcher, f"{base}/app.html")
+    assert result.rendered
+    assert browsers.loads == [f"{base}/app.html"]
+    assert result.parsed.links == ["/rendered.html"]
+    assert (fetcher.fetched, fetcher.rendered) == (1, 1)
+
+
+def test_render_skips_the_http_request(site):
+    _, base = site
+    browsers = StubBrowsers(page())
+    fetcher = PageFetcher(browsers)
+    result = fetch(fetcher, f"{base}/missing.html", render=True)
+    assert result.rendered
+    assert fetcher.fetched == 0
+
+
+def test_http_errors_are_raised(site):
+    _, base = site
+    with pytest.raises(RuntimeError, match="404"):
+        fetch(PageFetcher(StubBrowsers(page())), f"{base}/missing.html")
+
+
+def make_tree(root):
+    # index -> a, b; a -> c; c -> d
+    (root / "index.html").write_text(page("a.html", "b.html", "https://elsewhere.example/"))
+    (root / "a.html").write_text(page("c.html"))
+    (root / "b.html").write_text(page())
+    (root / "c.html").write_text(page("d.html"))
+    (root / "d.html").write_text(page())
+
+
+def crawl(base, monkeypatch, tmp_path, **options):
+    monkeypatch.chdir(tmp_path)
+
+    async def scenario():
+        fetcher = PageFetcher(StubBrowsers(page()))
+        try:
+            return await Crawler(fetcher, delay=0, concurrency=2, **options).crawl(f"{base}/index.html")
+        finally:
+            await fetcher.close()
+    result = asyncio.run(scenario())
+    with open(result.path) as f:
+        return result, {record["url"].rsplit("/", 1)[1]: record["depth"] for record in map(json.loads, f)}
+
+
+def test_crawl_stops_at_max_depth(site, monkeypatch, tmp_path):
+    root, base = site
+    make_tree(root)
+    result, pages = crawl(base, monkeypatch, tmp_path, max_depth=1)
+    assert pages == {"index.html": 0, "a.html": 1, "b.html": 1}
+    assert result.pages == 3
+    _, pages = crawl(base, monkeypatch, tmp_path, max_depth=3)
+    assert pages == {"index.html": 0, "a.html": 1, "b.html": 1, "c.html": 2, "d.html": 3}
+
+
+def test_crawl_stops_at_max_pages(site, monkeypatch, tmp_path):
+    root, base = site
+    make_tree(root)
+    result, pages = crawl(base, monkeypatch, tmp_path, max_depth=3, max_pages=2)
+    assert result.pages == 2
+    assert set(pages) == {"index.html", "a.html"}
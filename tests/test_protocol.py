@@ -0,0 +1,53 @@
+import pytest
+
+from protocol import (FLAG_NO_CACHE, FRAME_DELTA, FRAME_REQUEST, HEADER, MAGIC, FrameDecoder, ProtocolError,
+                      encode_frame, is_framed_preamble)
+
+
+def test_round_trip():
+    data = encode_frame(FRAME_REQUEST, 3, 7, "héllo", FLAG_NO_CACHE) + encode_frame(FRAME_DELTA, 4, 8, b"")
+    frames = FrameDecoder().feed(data)
+    assert [(f.frame_type, f.channel, f.request_id, f.payload, f.flags) for f in frames] == [
+        (FRAME_REQUEST, 3, 7, "héllo".encode(), FLAG_NO_CACHE),
+        (FRAME_DELTA, 4, 8, b"", 0),
+    ]
+    assert frames[0].text() == "héllo"
+
+
+def test_partial_frames_are_buffered():
+    data = encode_frame(FRAME_REQUEST, 1, 1, "first") + encode_frame(FRAME_REQUEST, 1, 2, "second")
+    decoder = FrameDecoder()
+    frames = []
+    for i in range(len(data)):
+        frames += decoder.feed(data[i:i + 1])
+    assert [frame.text() for frame in frames] == ["first", "second"]
+    assert decoder.pending == 0
+
+
+def test_header_split_across_reads():
+    data = encode_frame(FRAME_REQUEST, 1, 1, "payload")
+    decoder = FrameDecoder()
+    assert decoder.feed(data[:HEADER.size - 1]) == []
+    assert decoder.feed(data[HEADER.size - 1:HEADER.size + 2]) == []
+    assert decoder.pending == HEADER.size + 2
+    assert [frame.text() for frame in decoder.feed(data[HEADER.size + 2:])] == ["payload"]
+
+
+def test_unknown_frame_type_is_rejected():
+    with pytest.raises(ProtocolError):
+        FrameDecoder().feed(HEADER.pack(0x0F, 1, 1, 0))
+
+
+def test_oversized_payload_is_rejected():
+    with pytest.raises(ProtocolError):
+        FrameDecoder(max_payload=4).feed(HEADER.pack(FRAME_REQUEST, 1, 1, 5))
+
+
+def test_preamble_detection():
+    assert is_framed_preamble(MAGIC) is True
+    assert is_framed_preamble(MAGIC + b"rest") is True
+    assert is_framed_preamble(b"hello") is False
+    assert is_framed_preamble(b"DX") is False
+    # A prefix of MAGIC can't be decided yet; the server settles it with a timeout
+    assert is_framed_preamble(b"D") is None
+    assert is_framed_preamble(b"DTL") is None
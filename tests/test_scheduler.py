@@ -0,0 +1,104 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import httpx
+from anthropic import RateLimitError
+
+from scheduler import LLMScheduler, TokenBucket, PRIORITY_INTERACTIVE, PRIORITY_BACKGROUND
+
+
+def usage(input_tokens=0, output_tokens=0, cache_creation_input_tokens=0):
+    return SimpleNamespace(input_tokens=input_tokens, output_tokens=output_tokens,
+                           cache_creation_input_tokens=cache_creation_input_tokens, cache_read_input_tokens=0)
+
+
+class StubMessages:
+    # Answers every request after `delay` seconds, failing with the queued errors first
+    def __init__(self, delay=0.0, errors=()):
+        self.delay = delay
+        self.errors = list(errors)
+        self.calls = []
+
+    async def create(self, **kwargs):
+        self.calls.append((kwargs.get('metadata'), time.monotonic()))
+        await asyncio.sleep(self.delay)
+        if self.errors:
+            raise self.errors.pop(0)
+        return SimpleNamespace(usage=usage(10, 10))
+
+
+def make_scheduler(messages, **kwargs):
+    client = SimpleNamespace(messages=messages)
+    return LLMScheduler(lambda: client, **kwargs)
+
+
+def rate_limited(retry_after):
+    request = httpx.Request("POST", "https://api.anthropic.com/v1/messages")
+    response = httpx.Response(429, headers={"retry-after": str(retry_after)}, request=request)
+    return RateLimitError("rate limited", response=response, body=None)
+
+
+def test_waiting_calls_are_served_by_priority():
+    messages = StubMessages(delay=0.05)
+    scheduler = make_scheduler(messages, max_in_flight=1)
+
+    async def scenario():
+        first = asyncio.ensure_future(scheduler.create(metadata="first", max_tokens=1))
+        await asyncio.sleep(0)
+        # Queued behind "first" while it holds the only slot
+        calls = [scheduler.create(PRIORITY_BACKGROUND, metadata="background", max_tokens=1),
+                 scheduler.create(PRIORITY_INTERACTIVE, metadata="interactive-1", max_tokens=1),
+                 scheduler.create(PRIORITY_INTERACTIVE, metadata="interactive-2", max_tokens=1)]
+        tasks = [asyncio.ensure_future(call) for call in calls]
+        await asyncio.sleep(0)
+        assert scheduler.queue_depth == 3
+        await asyncio.gather(first, *tasks)
+    asyncio.run(scenario())
+    assert [name for name, _ in messages.calls] == ["first", "interactive-1", "interactive-2", "background"]
+    assert scheduler.in_flight == 0
+
+
+def test_empty_bucket_delays_the_next_call():
+    bucket = TokenBucket(10, 100)
+    bucket.consume(10)
+    assert 0.04 < bucket.delay_for(5) <= 0.05
+    # More than the capacity only waits for a full bucket
+    assert bucket.delay_for(50) <= 0.1
+
+    messages = StubMessages()
+    scheduler = make_scheduler(messages, requests_per_minute=60)
+    scheduler.request_bucket = TokenBucket(1, 10)
+
+    async def scenario():
+        await scheduler.create(max_tokens=1)
+        await scheduler.create(max_tokens=1)
+    asyncio.run(scenario())
+    (_, first), (_, second) = messages.calls
+    assert second - first >= 0.08
+
+
+def test_usage_settles_the_token_bucket_with_cache_writes():
+    scheduler = make_scheduler(StubMessages(), tokens_per_minute=60000)
+    scheduler.token_bucket.tokens = 1000
+    scheduler._settle(500, SimpleNamespace(usage=usage(100, 100, cache_creation_input_tokens=250)))
+    # 500 estimated, 450 billed: 50 comes back
+    assert 1049 < scheduler.token_bucket.tokens < 1052
+
+
+def test_retry_after_pauses_every_caller():
+    messages = StubMessages(errors=[rate_limited(0.2)])
+    scheduler = make_scheduler(messages, max_in_flight=2, base_delay=0.01)
+
+    async def scenario():
+        failing = asyncio.ensure_future(scheduler.create(metadata="limited", max_tokens=1))
+        await asyncio.sleep(0.05)
+        # Arrives during the pause, so it has to wait it out as well
+        await scheduler.create(metadata="other", max_tokens=1)
+        await failing
+    started = time.monotonic()
+    asyncio.run(scenario())
+    other = next(at for name, at in messages.calls if name == "other")
+    assert other - started >= 0.19
+    assert [name for name, _ in messages.calls].count("limited") == 2
+    assert scheduler.retries == 1
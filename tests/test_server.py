@@ -0,0 +1,28 @@
+import asyncio
+
+from server import ChatServer
+
+
+def test_recv_timeout_keeps_unread_data():
+    async def scenario():
+        received = []
+
+        async def handler(connection):
+            received.append(await connection.recv(4096))
+            received.append(await connection.recv(4096, timeout=0.05))
+            received.append(await connection.recv(4096, timeout=1))
+
+        server = ChatServer(handler, host='127.0.0.1', port=0)
+        await server.start()
+        reader, writer = await asyncio.open_connection('127.0.0.1', server.port)
+        writer.write(b"D")
+        await writer.drain()
+        await asyncio.sleep(0.2)
+        writer.write(b"ata")
+        await writer.drain()
+        await asyncio.sleep(0.1)
+        writer.close()
+        await server.shutdown()
+        return received
+
+    assert asyncio.run(scenario()) == [b"D", None, b"ata"]
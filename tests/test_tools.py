@@ -0,0 +1,47 @@
+import asyncio
+
+from tools import ToolDispatcher, build_tool
+
+
+def tool_use(name, i, **arguments):
+    return {"type": "tool_use", "id": f"call-{i}", "name": name, "input": arguments}
+
+
+def test_usage_string_becomes_a_schema():
+    tool = build_tool({"name": "launch_program", "description": "Launch", "usage": "launch_program program_name [file_path]"})
+    assert tool["input_schema"]["required"] == ["program_name"]
+    assert sorted(tool["input_schema"]["properties"]) == ["file_path", "program_name"]
+
+
+def test_exclusive_calls_run_one_at_a_time():
+    dispatcher = ToolDispatcher(max_concurrency=4)
+    running = {"shared": 0, "free": 0}
+    peak = {"shared": 0, "free": 0}
+
+    def handler(kind):
+        async def run(n):
+            running[kind] += 1
+            peak[kind] = max(peak[kind], running[kind])
+            await asyncio.sleep(0.02)
+            running[kind] -= 1
+            return f"{kind} {n}"
+        return run
+
+    dispatcher.register("shared", handler("shared"), exclusive=True)
+    dispatcher.register("free", handler("free"))
+    calls = [tool_use(name, i, n=str(i)) for i, name in enumerate(["shared", "free"] * 3)]
+    results = asyncio.run(dispatcher.dispatch(calls))
+    assert [result["content"] for result in results] == ["shared 0", "free 1", "shared 2", "free 3", "shared 4", "free 5"]
+    assert peak == {"shared": 1, "free": 3}
+
+
+def test_failures_come_back_as_error_results():
+    dispatcher = ToolDispatcher()
+
+    async def broken():
+        raise OSError("disk on fire")
+    dispatcher.register("broken", broken)
+    missing, failed = asyncio.run(dispatcher.dispatch([tool_use("missing", 0), tool_use("broken", 1)]))
+    assert missing["is_error"] and "Unknown tool" in missing["content"]
+    assert failed["is_error"] and "disk on fire" in failed["content"]
+    assert (dispatcher.calls, dispatcher.errors) == (1, 2)
@@ -0,0 +1,86 @@
+import numpy as np
+
+from vector_memory import HashingEmbedder, VectorMemory
+
+NOTES = [
+    "the user prefers pytest over unittest",
+    "chrome runs headless in the browser pool",
+    "numpy is installed in the data science environment",
+    "the chat server listens on port 9999",
+]
+
+
+def make_memory(tmp_path, entries=(), **kwargs):
+    memory = VectorMemory(str(tmp_path / "vectors"), load_memory=lambda: list(entries), **kwargs)
+    memory.sync()
+    return memory
+
+
+def test_embeddings_are_unit_length():
+    vectors = HashingEmbedder(dimensions=64).embed(["some words here", ""])
+    assert vectors.shape == (2, 64)
+    assert abs(float(np.linalg.norm(vectors[0])) - 1.0) < 1e-5
+    assert not vectors[1].any()
+
+
+def test_search_finds_the_closest_entry(tmp_path):
+    memory = make_memory(tmp_path)
+    memory.add(NOTES)
+    hits = memory.search("which test runner does the user like, pytest?", k=2)
+    assert hits[0].text == NOTES[0]
+    assert hits[0].entry == 0
+    assert hits[0].score > hits[-1].score or len(hits) == 1
+    assert memory.search("port of the chat server", k=1, min_score=0.99) == []
+    memory.close()
+
+
+def test_store_grows_past_its_capacity(tmp_path):
+    memory = make_memory(tmp_path, initial_capacity=2)
+    memory.add([f"note number {i} about topic{i}" for i in range(9)])
+    assert memory.count == 9
+    assert len(memory.vectors) == 16
+    assert memory.search("topic7", k=1)[0].entry == 7
+    memory.close()
+
+
+def test_reopened_store_keeps_vectors_and_syncs_new_entries(tmp_path):
+    entries = list(NOTES[:2])
+    memory = make_memory(tmp_path, entries)
+    assert memory.count == 2
+    memory.close()
+
+    entries.extend(NOTES[2:])
+    reopened = make_memory(tmp_path, entries)
+    # Only the entries written while it was closed are embedded again
+    assert reopened.count == 4
+    assert [reopened.text(i) for i in range(4)] == NOTES
+    assert reopened.search("headless chrome", k=1)[0].entry == 1
+    reopened.close()
+
+
+def test_other_embedder_rebuilds_the_store(tmp_path):
+    memory = make_memory(tmp_path, NOTES)
+    memory.close()
+    rebuilt = make_memory(tmp_path, NOTES[:1], embedder=HashingEmbedder(dimensions=128))
+    assert rebuilt.count == 1
+    assert rebuilt.vectors.shape[1] == 128
+    rebuilt.close()
+
+
+def test_quantizer_is_built_and_reloaded(tmp_path):
+    notes = [f"entry {i} is about topic{i}" for i in range(60)]
+    memory = make_memory(tmp_path, index_threshold=50, nprobe=64)
+    memory.add(notes)
+    assert memory.quantizer is not None
+    assert memory.quantizer["built_at"] == 60
+    assert memory.search("topic42", k=1)[0].entry == 42
+    memory.close()
+
+    # Entries added after the quantizer was saved are assigned on load
+    reopened = make_memory(tmp_path, index_threshold=1000, nprobe=64)
+    reopened.add("a late entry about keywordlate")
+    reopened.close()
+    again = make_memory(tmp_path, index_threshold=1000, nprobe=64)
+    assert again.quantizer is not None
+    assert again.search("keywordlate", k=1)[0].entry == 60
+    again.close()